@@ -32,7 +32,7 @@ else:
 
 
 from cps import create_app
-from cps import web_server
+from cps import web_server, cli
 from cps.opds import opds
 from cps.web import web
 from cps.jinjia import jinjia
@@ -60,6 +60,9 @@ except ImportError:
 
 def main():
     app = create_app()
+    if cli.import_path:
+        from cps.bulk_import import import_directory
+        sys.exit(0 if import_directory(cli.import_path) else 1)
 
     init_errorhandler()
 
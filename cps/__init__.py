@@ -36,6 +36,7 @@ from flask_principal import Principal
 from . import config_sql, logger, cache_buster, cli, ub, db
 from .reverseproxy import ReverseProxied
 from .server import WebServer
+from .staging import UploadRequest
 
 
 mimetypes.init()
@@ -58,6 +59,7 @@ mimetypes.add_type('application/ogg', '.ogg')
 mimetypes.add_type('application/ogg', '.oga')
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config.update(
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE='Lax',
@@ -82,6 +84,7 @@ _BABEL_TRANSLATIONS = set()
 log = logger.create()
 
 from . import services
+from .services.worker import WorkerThread, LANE_CONVERT
 
 db.CalibreDB.update_config(config)
 db.CalibreDB.setup_db(config.config_calibre_dir, cli.settingspath)
@@ -89,6 +92,14 @@ db.CalibreDB.setup_db(config.config_calibre_dir, cli.settingspath)
 
 calibre_db = db.CalibreDB()
 
+
+# each request has its own database sessions, their connections return to the pools afterwards
+@app.teardown_appcontext
+def remove_sessions(exception=None):
+    db.CalibreDB.remove_session()
+    ub.remove_session()
+
+
 def create_app():
     app.wsgi_app = ReverseProxied(app.wsgi_app)
     # For python2 convert path to unicode
@@ -109,6 +120,7 @@ def create_app():
     app.secret_key = os.getenv('SECRET_KEY', config_sql.get_flask_session_key(ub.session))
 
     web_server.init_app(app, config)
+    WorkerThread.set_workers(LANE_CONVERT, config.config_converter_workers or 1)
 
     babel.init_app(app)
     _BABEL_TRANSLATIONS.update(str(item) for item in babel.list_translations())
@@ -34,17 +34,19 @@ from babel.dates import format_datetime
 from flask import Blueprint, flash, redirect, url_for, abort, request, make_response, send_from_directory, g, Response
 from flask_login import login_required, current_user, logout_user, confirm_login
 from flask_babel import gettext as _
+from werkzeug.local import LocalProxy
 from sqlalchemy import and_
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.exc import IntegrityError, OperationalError, InvalidRequestError
 from sqlalchemy.sql.expression import func, or_, text
 
-from . import constants, logger, helper, services
+from . import constants, logger, helper, services, file_hash, user_cache
 # from .cli import filepicker
 from . import db, calibre_db, ub, web_server, get_locale, config, updater_thread, babel, gdriveutils
 from .helper import check_valid_domain, send_test_mail, reset_password, generate_password_hash, check_email, \
     valid_email, check_username
 from .gdriveutils import is_gdrive_ready, gdrive_support
+from .services.worker import WorkerThread, LANE_CONVERT
 from .render_template import render_title_template, get_sidebar_config
 from . import debug_info, _BABEL_TRANSLATIONS
 
@@ -108,8 +110,11 @@ def before_request():
     g.allow_upload = config.config_uploading
     g.current_theme = config.config_theme
     g.config_authors_max = config.config_authors_max
-    g.shelves_access = ub.session.query(ub.Shelf).filter(
-        or_(ub.Shelf.is_public == 1, ub.Shelf.user_id == current_user.id)).order_by(ub.Shelf.name).all()
+    # the shelves are only loaded by the pages showing them
+    g.shelves_access = LocalProxy(user_cache.shelves)
+    # changes of the library reported by the watcher, e.g. by calibre, become visible to the session
+    if config.db_configured and '/static/' not in request.path:
+        calibre_db.refresh_library(config, ub.app_DB_path)
     if '/static/' not in request.path and not config.db_configured and \
         request.endpoint not in ('admin.ajax_db_config',
                                  'admin.simulatedbchange',
@@ -1192,6 +1197,7 @@ def _db_configuration_update_helper():
 
 def _configuration_update_helper():
     reboot_required = False
+    reconnect_required = False
     to_save = request.form.to_dict()
     try:
         reboot_required |= _config_int(to_save, "config_port")
@@ -1205,6 +1211,12 @@ def _configuration_update_helper():
             return _configuration_result(_('Certfile Location is not Valid, Please Enter Correct Path'))
 
         _config_checkbox_int(to_save, "config_uploading")
+        _config_string(to_save, "config_import_dir")
+        if config.config_import_dir and not os.path.isdir(config.config_import_dir):
+            return _configuration_result(_('Import Directory is not Valid, Please Enter Correct Path'))
+        _config_string(to_save, "config_staging_dir")
+        if config.config_staging_dir and not os.path.isdir(config.config_staging_dir):
+            return _configuration_result(_('Upload Staging Directory is not Valid, Please Enter Correct Path'))
         # Reboot on config_anonbrowse with enabled ldap, as decoraters are changed in this case
         reboot_required |= (_config_checkbox_int(to_save, "config_anonbrowse")
                              and config.config_login_type == constants.LOGIN_LDAP)
@@ -1223,6 +1235,10 @@ def _configuration_update_helper():
         _config_string(to_save, "config_calibre")
         _config_string(to_save, "config_converterpath")
         _config_string(to_save, "config_kepubifypath")
+        _config_int(to_save, "config_converter_workers")
+        _config_int(to_save, "config_converter_timeout")
+        _config_int(to_save, "config_converter_nice")
+        WorkerThread.set_workers(LANE_CONVERT, config.config_converter_workers)
 
         reboot_required |= _config_int(to_save, "config_login_type")
 
@@ -1238,6 +1254,12 @@ def _configuration_update_helper():
         if not config.config_remote_login:
             ub.session.query(ub.RemoteAuthToken).filter(ub.RemoteAuthToken.token_type == 0).delete()
 
+        # Full-text search index is attached to the calibre database connection
+        reconnect_required |= _config_checkbox(to_save, "config_use_search_index")
+        # Journal mode and pool of the database connections
+        reconnect_required |= _config_checkbox(to_save, "config_db_wal")
+        reconnect_required |= _config_int(to_save, "config_db_pool_size")
+
         # Goodreads configuration
         _config_checkbox(to_save, "config_use_goodreads")
         _config_string(to_save, "config_goodreads_api_key")
@@ -1273,6 +1295,8 @@ def _configuration_update_helper():
         _configuration_result(_("Settings DB is not Writeable"))
 
     config.save()
+    if reconnect_required:
+        calibre_db.reconnect_db(config, ub.app_DB_path)
     if reboot_required:
         web_server.stop(True)
 
@@ -1601,6 +1625,23 @@ def view_logfile():
                                  page="logfile")
 
 
+@admi.route("/admin/duplicates")
+@login_required
+@admin_required
+def show_duplicates():
+    # the report is complete once the files of the library are hashed
+    helper.build_hash_index(current_user.name)
+    groups = list()
+    for group in file_hash.duplicates(ub.session):
+        books = dict((book.id, book) for book in calibre_db.session.query(db.Books)
+                     .filter(db.Books.id.in_([book_id for book_id, __ in group])))
+        entries = [(books[book_id], book_format) for book_id, book_format in group if book_id in books]
+        if len(entries) > 1:
+            groups.append(entries)
+    return render_title_template("duplicates.html", groups=groups, index_built=file_hash.index_built,
+                                 title=_(u"Duplicate Files"), page="duplicates")
+
+
 @admi.route("/ajax/log/<int:logtype>")
 @login_required
 @admin_required
@@ -1639,6 +1680,36 @@ def download_debug():
     return debug_info.send_debug()
 
 
+@admi.route("/admin/convert_library", methods=['POST'])
+@login_required
+@admin_required
+def convert_library():
+    showtext = {}
+    if not config.config_kepubifypath:
+        showtext['text'] = _(u'Kepubify is not configured')
+        return json.dumps(showtext), 400
+    count = helper.convert_library_format('EPUB', 'KEPUB', current_user.name)
+    if count:
+        showtext['text'] = _(u'Conversion of %(count)d books to KEPUB queued, see Tasks for the progress', count=count)
+    else:
+        showtext['text'] = _(u'All books are already converted to KEPUB')
+    return json.dumps(showtext)
+
+
+@admi.route("/admin/import_books", methods=['POST'])
+@login_required
+@admin_required
+def import_books():
+    showtext = {}
+    if not config.config_uploading or not config.config_import_dir or not os.path.isdir(config.config_import_dir):
+        showtext['text'] = _(u'Import directory is not configured')
+        return json.dumps(showtext), 400
+    helper.import_books(config.config_import_dir, current_user.name)
+    showtext['text'] = _(u'Import of %(directory)s queued, see Tasks for the progress',
+                         directory=config.config_import_dir)
+    return json.dumps(showtext)
+
+
 @admi.route("/get_update_status", methods=['GET'])
 @login_required
 @admin_required
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function, unicode_literals
+import os
+import re
+import shutil
+import tempfile
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy.exc import OperationalError, IntegrityError
+
+from . import logger, config, constants, db, ub, helper, isoLanguages, staging, file_hash
+
+log = logger.create()
+
+try:
+    import unidecode
+    use_unidecode = True
+except ImportError:
+    use_unidecode = False
+
+# number of books inserted into the database with one transaction
+BATCH_SIZE = 100
+# files handed to the metadata extraction pool in advance per process
+QUEUE_FACTOR = 4
+
+
+def scan(directory):
+    """Returns all files below directory with an extension allowed for uploading"""
+    files = list()
+    for dir_name, __, file_list in os.walk(directory):
+        for file_name in sorted(file_list):
+            ext = os.path.splitext(file_name)[1].lower()[1:]
+            if ext and (ext in constants.EXTENSIONS_UPLOAD or '' in constants.EXTENSIONS_UPLOAD):
+                files.append(os.path.join(dir_name, file_name))
+    return files
+
+
+def _normalize(value):
+    value = value.lower()
+    if use_unidecode:
+        value = unidecode.unidecode(value)
+    return re.sub(r'\W+', '', value, flags=re.UNICODE)
+
+
+def duplicate_key(title, author):
+    return _normalize(title), _normalize(author)
+
+
+def _link(source, target):
+    try:
+        os.link(source, target)
+    except (OSError, AttributeError):
+        shutil.copyfile(source, target)
+
+
+def extract_metadata(path):
+    """Extracts metadata and cover of the file, runs in the import pool.
+    Returns the path, the working directory holding the extracted cover and the metadata or the error"""
+    from . import app, uploader
+    work_dir = tempfile.mkdtemp(prefix='import-', dir=staging.staging_dir())
+    file_root, file_extension = os.path.splitext(os.path.basename(path))
+    # covers are extracted next to the processed file, so it's processed as link in the working directory
+    work_file = os.path.join(work_dir, 'book' + file_extension.lower())
+    try:
+        _link(path, work_file)
+        # the metadata parsers translate default values
+        with app.test_request_context():
+            meta = uploader.process(work_file, file_root, file_extension, config.config_rarfile_location)
+        return path, work_dir, meta._replace(file_path=path, file_hash=file_hash.hash_file(path)), None
+    except Exception as ex:
+        return path, work_dir, None, str(ex)
+
+
+class BookImporter(object):
+    """Imports files into the library, the metadata is extracted in parallel, books are inserted in batches.
+    With processes the metadata is extracted by forked processes, otherwise by threads"""
+
+    def __init__(self, calibre_db, workers=None, progress=None, cancelled=None, processes=False):
+        self.calibre_db = calibre_db
+        self.session = calibre_db.session
+        self.workers = workers or multiprocessing.cpu_count()
+        self.processes = processes
+        self.progress = progress
+        self.cancelled = cancelled or (lambda: False)
+        self.imported = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.start_time = None
+        self._index = set()
+        self._hashes = set()
+        self._objects = dict()
+        self._batch_dirs = list()
+        self._batch_hashes = list()
+        self._batch_keys = list()
+        self._new_objects = list()
+        self._hash_session = None
+        self._pending = 0
+
+    @property
+    def processed(self):
+        return self.imported + self._pending + self.duplicates + self.failed
+
+    @property
+    def rate(self):
+        runtime = time.time() - self.start_time if self.start_time else 0
+        return self.processed / runtime if runtime else 0
+
+    def _build_index(self):
+        for title, author in self.session.query(db.Books.title, db.Authors.name) \
+                .join(db.books_authors_link, db.books_authors_link.c.book == db.Books.id) \
+                .join(db.Authors, db.Authors.id == db.books_authors_link.c.author):
+            self._index.add(duplicate_key(title, author))
+        self._hashes = set((book_format, book_hash) for book_format, book_hash in
+                           self._hash_session.query(ub.BookFileHash.format, ub.BookFileHash.hash))
+
+    def _executor(self):
+        # forked processes inherit the configuration and the database setup, without fork the parsing runs in threads.
+        # Forking the threaded server could deadlock the children on locks held by other threads, so only the command
+        # line import uses processes
+        if self.processes and self.workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+        return ThreadPoolExecutor(self.workers)
+
+    def run(self, files):
+        self.start_time = time.time()
+        self._hash_session = ub.get_new_session_instance()
+        try:
+            self._build_index()
+            conn = self.session.connection().connection.connection
+            self.calibre_db.update_title_sort(config, conn)
+            conn.create_function('uuid4', 0, lambda: str(uuid4()))
+            files = list(files)
+            with self._executor() as executor:
+                queued = list()
+                position = 0
+                while position < len(files) or queued:
+                    # only a limited number of files is queued in advance, so cancelling doesn't wait for all of them
+                    while position < len(files) and len(queued) < self.workers * QUEUE_FACTOR \
+                            and not self.cancelled():
+                        queued.append(executor.submit(extract_metadata, files[position]))
+                        position += 1
+                    if not queued:
+                        break
+                    self._add(*queued.pop(0).result())
+                    if self.progress:
+                        self.progress(self.processed, len(files))
+            self._commit()
+        finally:
+            self._hash_session.close()
+        db.CalibreDB.invalidate_visible_books()
+        return self.imported
+
+    def _add(self, path, work_dir, meta, error):
+        try:
+            if error or self.cancelled():
+                if error:
+                    log.error("Metadata of %s could not be extracted: %s", path, error)
+                    self.failed += 1
+                return
+            key = duplicate_key(meta.title, meta.author.split('&')[0])
+            hash_key = (meta.extension.upper()[1:], meta.file_hash)
+            if hash_key in self._hashes:
+                log.info("%s exists in library, not imported", path)
+                self.duplicates += 1
+                return
+            if key in self._index:
+                log.info("%s probably exists in library, not imported", path)
+                self.duplicates += 1
+                return
+            try:
+                book_id, size = self._insert(meta)
+            except (OSError, ValueError) as ex:
+                log.error("%s could not be imported: %s", path, ex)
+                self.failed += 1
+                return
+            except (OperationalError, IntegrityError) as ex:
+                # the session can't be used further without rollback, the books of the batch are lost as well
+                log.error("%s could not be imported: %s", path, ex)
+                self.failed += 1
+                self._rollback(ex)
+                return
+            self._index.add(key)
+            self._hashes.add(hash_key)
+            self._batch_keys.append(key)
+            self._batch_hashes.append((book_id, hash_key, size))
+            self._pending += 1
+            if self._pending >= BATCH_SIZE:
+                self._commit()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _commit(self):
+        if not self._pending:
+            return
+        try:
+            self.session.commit()
+            self.imported += self._pending
+            for book_id, (book_format, book_hash), size in self._batch_hashes:
+                file_hash.add(self._hash_session, book_id, book_format, book_hash, size, commit=False)
+            file_hash.commit_session(self._hash_session)
+        except (OperationalError, IntegrityError) as ex:
+            self._rollback(ex)
+            return
+        self._reset_batch()
+
+    def _rollback(self, ex):
+        self.session.rollback()
+        log.error("Database error while importing: %s", ex)
+        self.failed += self._pending
+        # files of books which aren't in the database are removed again, later files of them are no duplicates
+        for book_dir in self._batch_dirs:
+            shutil.rmtree(book_dir, ignore_errors=True)
+        self._index.difference_update(self._batch_keys)
+        self._hashes.difference_update(hash_key for __, hash_key, __ in self._batch_hashes)
+        self._objects.clear()
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self._pending = 0
+        self._batch_dirs = list()
+        self._batch_hashes = list()
+        self._batch_keys = list()
+
+    # returns the existing or a new database object of the given name, objects are cached during the import
+    def _get_object(self, db_class, name, create):
+        key = (db_class, name)
+        if key not in self._objects:
+            if db_class == db.Languages:
+                column = db_class.lang_code
+            else:
+                column = db_class.name
+            self._objects[key] = self.session.query(db_class).filter(column == name).first()
+            if not self._objects[key]:
+                self._objects[key] = create()
+                self._new_objects.append(key)
+        return self._objects[key]
+
+    def _insert(self, meta):
+        self._new_objects = list()
+        title = meta.title.strip()
+        authors = helper.uniq([author.strip().replace(',', '|') for author in meta.author.split('&')
+                               if author.strip()]) or [u'Unknown']
+        db_authors = [self._get_object(db.Authors, name,
+                                       lambda: db.Authors(name, helper.get_sorted_author(name), ""))
+                      for name in authors]
+        author_dir = helper.get_valid_filename(db_authors[0].name)
+        file_name = helper.get_valid_filename(title) + ' - ' + author_dir
+        series_index = meta.series_id or '1'
+        if not series_index.replace('.', '', 1).isdigit():
+            series_index = '1'
+
+        now = datetime.utcnow()
+        book = db.Books(title, "", ' & '.join(author.sort for author in db_authors), now, datetime(101, 1, 1),
+                        series_index, now, "", meta.cover, db_authors, [])
+        book.authors = db_authors
+        book.tags = [self._get_object(db.Tags, tag, lambda: db.Tags(tag))
+                     for tag in helper.uniq([tag.strip() for tag in (meta.tags or '').split(',') if tag.strip()])]
+        series = (meta.series or '').strip()
+        if series:
+            book.series = [self._get_object(db.Series, series, lambda: db.Series(series, series))]
+        publisher = (meta.publisher or '').strip()
+        if publisher:
+            book.publishers = [self._get_object(db.Publishers, publisher, lambda: db.Publishers(publisher, None))]
+        languages = isoLanguages.get_valid_language_codes('en', (meta.languages or '').split(','))
+        book.languages = [self._get_object(db.Languages, lang, lambda: db.Languages(lang))
+                          for lang in helper.uniq(languages)]
+        self.session.add(book)
+        # the path contains the book id
+        self.session.flush()
+
+        title_dir = helper.get_valid_filename(title) + " (" + str(book.id) + ")"
+        book.path = author_dir + '/' + title_dir
+        book_dir = os.path.join(config.config_calibre_dir, author_dir, title_dir)
+        book_file = os.path.join(book_dir, file_name + meta.extension.lower())
+        created = not os.path.isdir(book_dir)
+        try:
+            if created:
+                os.makedirs(book_dir)
+            shutil.copyfile(meta.file_path, book_file)
+            if meta.cover:
+                shutil.move(meta.cover, os.path.join(book_dir, "cover.jpg"))
+        except OSError:
+            if created:
+                shutil.rmtree(book_dir, ignore_errors=True)
+            # authors, tags and so on created for the book aren't kept without it
+            self.session.delete(book)
+            for key in self._new_objects:
+                self.session.delete(self._objects.pop(key))
+            self.session.flush()
+            raise
+        if created:
+            self._batch_dirs.append(book_dir)
+        size = os.path.getsize(book_file)
+        book.data.append(db.Data(book.id, meta.extension.upper()[1:], size, file_name))
+        if meta.description:
+            book.comments.append(db.Comments(text=meta.description, book=book.id))
+        return book.id, size
+
+
+def import_directory(directory, workers=None):
+    """Imports all books of the directory from the command line and prints the progress"""
+    files = scan(directory)
+    print("Importing {} files from {}".format(len(files), directory))
+
+    def progress(done, total):
+        if done % BATCH_SIZE == 0 or done == total:
+            print("{}/{} files processed, {:.1f} files/s".format(done, total, importer.rate))
+
+    importer = BookImporter(db.CalibreDB(expire_on_commit=False), workers, progress, processes=True)
+    try:
+        importer.run(files)
+    finally:
+        importer.session.close()
+    print("{} books imported, {} duplicates skipped, {} files failed".format(
+        importer.imported, importer.duplicates, importer.failed))
+    return importer.failed == 0
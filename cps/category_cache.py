@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Aggregates of the category lists (authors, series, tags, ...) shown in the sidebar pages and the OPDS index feeds.
+# They are cached per list, sort direction and visibility of the books for the user. The visibility signature
+# contains the library stamp, so each change of the calibre database, by Calibre-Web or by calibre, starts a new cache
+from __future__ import division, print_function, unicode_literals
+import threading
+
+from flask_login import current_user
+from sqlalchemy.sql.expression import text, func
+
+from . import db, ub, calibre_db, get_locale
+
+# the cache is cleared if it grows above this number of lists, e.g. after many users with different restrictions
+MAX_ENTRIES = 256
+
+# column for the first letters of a category and the link table to the books
+_LETTER_COLUMNS = {
+    'author': (db.Authors.sort, db.books_authors_link),
+    'publisher': (db.Publishers.name, db.books_publishers_link),
+    'series': (db.Series.sort, db.books_series_link),
+    'category': (db.Tags.name, db.books_tags_link),
+}
+
+_lock = threading.Lock()
+_entries = dict()
+_library_stamp = None
+
+
+class CachedEntity(object):
+    """Copy of the loaded attributes of a database object, independent of the session it was loaded with"""
+
+    def __init__(self, instance, relations=()):
+        mapper = instance._sa_instance_state.mapper
+        for column in mapper.column_attrs:
+            setattr(self, column.key, getattr(instance, column.key))
+        # values set on the object after loading, like the translated language name
+        for key, value in instance.__dict__.items():
+            if not key.startswith('_') and key not in mapper.relationships:
+                setattr(self, key, value)
+        for relation in relations:
+            setattr(self, relation, [CachedEntity(child) for child in getattr(instance, relation)])
+
+
+class CachedRow(tuple):
+    """Copy of a result row, the values are accessible by index and by label like in the original row"""
+
+    def __new__(cls, row, relations=()):
+        values = [_detach(value, relations) for value in row]
+        self = tuple.__new__(cls, values)
+        # attributes in __dict__ take precedence over the tuple methods, e.g. for the label count
+        self.__dict__.update(zip(row.keys(), values))
+        return self
+
+
+def _detach(value, relations=()):
+    if hasattr(value, '_sa_instance_state'):
+        return CachedEntity(value, relations)
+    return value
+
+
+def _archive_signature():
+    # archived books are hidden only for the user who archived them, users without archived books share the lists
+    if current_user.is_anonymous:
+        return None
+    count, last_modified = ub.session.query(func.count(ub.ArchivedBook.id), func.max(ub.ArchivedBook.last_modified))\
+        .filter(ub.ArchivedBook.user_id == int(current_user.id))\
+        .filter(ub.ArchivedBook.is_archived == True).one()
+    return (int(current_user.id), count, last_modified) if count else None
+
+
+def _cached(name, build, *args):
+    global _library_stamp
+    signature = calibre_db.visibility_signature()
+    key = (name, args, signature, _archive_signature())
+    with _lock:
+        if _library_stamp != signature[-1]:
+            _entries.clear()
+            _library_stamp = signature[-1]
+        if key in _entries:
+            return _entries[key]
+    value = build(*args)
+    with _lock:
+        if _library_stamp == signature[-1]:
+            if len(_entries) >= MAX_ENTRIES:
+                _entries.clear()
+            _entries[key] = value
+    return value
+
+
+def _order(column, descending):
+    return column.desc() if descending else column.asc()
+
+
+def _letters(kind):
+    column, link = _LETTER_COLUMNS[kind]
+    first_letter = func.upper(func.substr(column, 1, 1))
+    return [CachedRow(row) for row in calibre_db.session.query(first_letter.label('char'))
+            .join(link).join(db.Books).filter(calibre_db.common_filters())
+            .group_by(first_letter).all()]
+
+
+# Upper case first letters of the category names of the visible books
+def letters(kind):
+    return _cached('letters', _letters, kind)
+
+
+def _authors(descending):
+    entries = [CachedRow(row) for row in
+               calibre_db.session.query(db.Authors, func.count('books_authors_link.book').label('count'))
+               .join(db.books_authors_link).join(db.Books).filter(calibre_db.common_filters())
+               .group_by(text('books_authors_link.author')).order_by(_order(db.Authors.sort, descending)).all()]
+    # names are changed on the copies, so read-only databases don't start a change session
+    for entry in entries:
+        entry.Authors.name = entry.Authors.name.replace('|', ',')
+    return entries
+
+
+def authors(descending):
+    return _cached('authors', _authors, descending)
+
+
+def _publishers(descending):
+    return [CachedRow(row) for row in
+            calibre_db.session.query(db.Publishers, func.count('books_publishers_link.book').label('count'))
+            .join(db.books_publishers_link).join(db.Books).filter(calibre_db.common_filters())
+            .group_by(text('books_publishers_link.publisher')).order_by(_order(db.Publishers.name, descending)).all()]
+
+
+def publishers(descending):
+    return _cached('publishers', _publishers, descending)
+
+
+def _series(descending):
+    return [CachedRow(row) for row in
+            calibre_db.session.query(db.Series, func.count('books_series_link.book').label('count'))
+            .join(db.books_series_link).join(db.Books).filter(calibre_db.common_filters())
+            .group_by(text('books_series_link.series')).order_by(_order(db.Series.sort, descending)).all()]
+
+
+def series(descending):
+    return _cached('series', _series, descending)
+
+
+def _series_books(descending):
+    return [CachedRow(row, ('series',)) for row in
+            calibre_db.session.query(db.Books, func.count('books_series_link').label('count'))
+            .join(db.books_series_link).join(db.Series).filter(calibre_db.common_filters())
+            .group_by(text('books_series_link.series')).order_by(_order(db.Series.sort, descending)).all()]
+
+
+# One book of each series with the number of books in the series for the grid view
+def series_books(descending):
+    return _cached('series_books', _series_books, descending)
+
+
+def _ratings(descending):
+    return [CachedRow(row) for row in
+            calibre_db.session.query(db.Ratings, func.count('books_ratings_link.book').label('count'),
+                                     (db.Ratings.rating / 2).label('name'))
+            .join(db.books_ratings_link).join(db.Books).filter(calibre_db.common_filters())
+            .group_by(text('books_ratings_link.rating')).order_by(_order(db.Ratings.rating, descending)).all()]
+
+
+def ratings(descending):
+    return _cached('ratings', _ratings, descending)
+
+
+def _formats(descending):
+    return [CachedRow(row) for row in
+            calibre_db.session.query(db.Data, func.count('data.book').label('count'), db.Data.format.label('format'))
+            .join(db.Books).filter(calibre_db.common_filters())
+            .group_by(db.Data.format).order_by(_order(db.Data.format, descending)).all()]
+
+
+def formats(descending):
+    return _cached('formats', _formats, descending)
+
+
+def _tags(descending):
+    return [CachedRow(row) for row in
+            calibre_db.session.query(db.Tags, func.count('books_tags_link.book').label('count'))
+            .join(db.books_tags_link).join(db.Books).order_by(_order(db.Tags.name, descending))
+            .filter(calibre_db.common_filters()).group_by(text('books_tags_link.tag')).all()]
+
+
+def tags(descending):
+    return _cached('tags', _tags, descending)
+
+
+def _languages(__):
+    if current_user.filter_language() == u"all":
+        languages = calibre_db.speaking_language()
+    else:
+        languages = calibre_db.speaking_language(calibre_db.session.query(db.Languages).filter(
+            db.Languages.lang_code == current_user.filter_language()).all())
+    lang_counter = [CachedRow(row) for row in
+                    calibre_db.session.query(db.books_languages_link,
+                                             func.count('books_languages_link.book').label('bookcount'))
+                    .group_by(text('books_languages_link.lang_code')).all()]
+    return [_detach(language) for language in languages], lang_counter
+
+
+# Returns the languages of the visible books with their names in the current locale and the book counts per language
+def languages():
+    return _cached('languages', _languages, str(get_locale()))
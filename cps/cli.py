@@ -45,6 +45,7 @@ parser.add_argument('-v', '--version', action='version', help='Shows version num
                     version=version_info())
 parser.add_argument('-i', metavar='ip-address', help='Server IP-Address to listen')
 parser.add_argument('-s', metavar='user:pass', help='Sets specific username to new password')
+parser.add_argument('-b', metavar='path', help='Imports all books of the directory into the library and exits')
 args = parser.parse_args()
 
 if sys.version_info < (3, 0):
@@ -58,6 +59,8 @@ if sys.version_info < (3, 0):
         args.c = args.c.decode('utf-8')
     if args.s:
         args.s = args.s.decode('utf-8')
+    if args.b:
+        args.b = args.b.decode('utf-8')
 
 
 settingspath = args.p or os.path.join(_CONFIG_DIR, "app.db")
@@ -108,6 +111,12 @@ if ip_address:
         print(ip_address, ':', err)
         sys.exit(1)
 
+# handle and check bulk import argument
+import_path = args.b or None
+if import_path and not os.path.isdir(import_path):
+    print("Import path is invalid. Exiting...")
+    sys.exit(1)
+
 # handle and check user password argument
 user_credentials = args.s or None
 if user_credentials and ":" not in user_credentials:
@@ -56,7 +56,7 @@ NO_JPEG_EXTENSIONS = ['.png', '.webp', '.bmp']
 COVER_EXTENSIONS = ['.png', '.webp', '.bmp', '.jpg', '.jpeg']
 
 def _cover_processing(tmp_file_name, img, extension):
-    tmp_cover_name = os.path.join(os.path.dirname(tmp_file_name), 'cover.jpg')
+    tmp_cover_name = os.path.splitext(tmp_file_name)[0] + '.cover.jpg'
     if use_IM:
         # convert to jpg because calibre only supports jpg
         if extension in NO_JPEG_EXTENSIONS:
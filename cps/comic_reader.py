@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function, unicode_literals
+import os
+import re
+import threading
+import zipfile
+import tarfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import logger, config
+
+log = logger.create()
+
+try:
+    import rarfile
+    use_rarfile = True
+except (ImportError, SyntaxError) as e:
+    log.debug('Cannot import rarfile, reading pages of rar files on the server will not work: %s', e)
+    use_rarfile = False
+
+try:
+    from wand.image import Image
+    use_IM = True
+except (ImportError, RuntimeError) as e:
+    use_IM = False
+
+COMIC_FORMATS = ('cbz', 'cbt', 'cbr')
+PAGE_MIME_TYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif',
+                   'webp': 'image/webp', 'bmp': 'image/bmp'}
+# number of books whose page list is kept in memory
+INDEX_CACHE_SIZE = 64
+# number of archives kept open, every open archive holds a file handle
+ARCHIVE_POOL_SIZE = 8
+# pages the reader requests ahead of the current page
+PREFETCH_PAGES = 3
+# downsized pages are rendered in steps of this size to limit the number of variants cached by the clients
+SIZE_STEP = 100
+MAX_SIZE = 4000
+
+
+class LRUCache(object):
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        evicted = []
+        with self._lock:
+            replaced = self._data.pop(key, None)
+            if replaced is not None and replaced is not value:
+                evicted.append(replaced)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False)[1])
+        if self.on_evict:
+            for item in evicted:
+                self.on_evict(item)
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._data.values())
+            self._data.clear()
+        if self.on_evict:
+            for item in evicted:
+                self.on_evict(item)
+
+
+# "page 10" is sorted after "page 9"
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+def _is_page(name):
+    if '__MACOSX' in name.split('/') or os.path.basename(name).startswith('.'):
+        return False
+    return name.rpartition('.')[-1].lower() in PAGE_MIME_TYPES
+
+
+class _Archive(object):
+    """Open archive, reading from zip/tar/rar files isn't thread safe, so every read is done under the lock.
+    Readers acquire the archive, an archive evicted from the pool is closed after its last reader released it"""
+
+    def __init__(self, path, book_format):
+        self.lock = threading.Lock()
+        self._users_lock = threading.Lock()
+        self._users = 0
+        self._retired = False
+        if book_format == 'cbz':
+            self.handle = zipfile.ZipFile(path)
+            self.names = [info.filename for info in self.handle.infolist() if not info.is_dir()]
+            self._read = self.handle.read
+        elif book_format == 'cbt':
+            self.handle = tarfile.TarFile(path)
+            self.names = [member.name for member in self.handle.getmembers() if member.isfile()]
+            self._read = lambda name: self.handle.extractfile(name).read()
+        elif book_format == 'cbr' and use_rarfile:
+            rarfile.UNRAR_TOOL = config.config_rarfile_location
+            self.handle = rarfile.RarFile(path)
+            self.names = [info.filename for info in self.handle.infolist() if not info.isdir()]
+            self._read = self.handle.read
+        else:
+            raise ValueError('Unsupported comic format {}'.format(book_format))
+
+    def read(self, name):
+        with self.lock:
+            return self._read(name)
+
+    # fails for an evicted archive, the reader has to open the archive again
+    def acquire(self):
+        with self._users_lock:
+            if self._retired:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        with self._users_lock:
+            self._users -= 1
+            close = self._retired and not self._users
+        if close:
+            self.close()
+
+    def retire(self):
+        with self._users_lock:
+            self._retired = True
+            close = not self._users
+        if close:
+            self.close()
+
+    def close(self):
+        with self.lock:
+            try:
+                self.handle.close()
+            except Exception as ex:
+                log.debug_or_exception(ex)
+
+
+_archives = LRUCache(ARCHIVE_POOL_SIZE, on_evict=lambda archive: archive.retire())
+_page_index = LRUCache(INDEX_CACHE_SIZE)
+_open_lock = threading.Lock()
+
+
+def supported(book_format):
+    book_format = book_format.lower()
+    return book_format in COMIC_FORMATS and (book_format != 'cbr' or use_rarfile) \
+        and not config.config_use_google_drive
+
+
+# Yields the acquired archive from the pool, opening it if needed
+@contextmanager
+def _open_archive(path, book_format, mtime):
+    key = (path, mtime)
+    archive = _archives.get(key)
+    if archive is None or not archive.acquire():
+        with _open_lock:
+            archive = _archives.get(key)
+            if archive is None or not archive.acquire():
+                archive = _Archive(path, book_format)
+                archive.acquire()
+                _archives.put(key, archive)
+    try:
+        yield archive
+    finally:
+        archive.release()
+
+
+def get_pages(book_id, path, book_format):
+    """Returns the naturally sorted names of the pages of the comic, the list is cached per book, format and file
+    modification time, so a replaced file is read again"""
+    book_format = book_format.lower()
+    mtime = os.path.getmtime(path)
+    key = (book_id, book_format, mtime)
+    pages = _page_index.get(key)
+    if pages is None:
+        with _open_archive(path, book_format, mtime) as archive:
+            pages = sorted((name for name in archive.names if _is_page(name)), key=_natural_key)
+        _page_index.put(key, pages)
+    return pages
+
+
+def read_page(book_id, path, book_format, page):
+    """Returns the name and the content of the page, or None if the page doesn't exist"""
+    pages = get_pages(book_id, path, book_format)
+    if not 0 <= page < len(pages):
+        return None
+    with _open_archive(path, book_format.lower(), os.path.getmtime(path)) as archive:
+        return pages[page], archive.read(pages[page])
+
+
+def page_mimetype(name):
+    return PAGE_MIME_TYPES.get(name.rpartition('.')[-1].lower(), 'application/octet-stream')
+
+
+def snap_size(value):
+    return min(max(SIZE_STEP, -(-int(value) // SIZE_STEP) * SIZE_STEP), MAX_SIZE)
+
+
+# shrinks the page to fit into width x height, returns the new content and its mimetype
+def resize_page(data, name, width, height):
+    if not use_IM or page_mimetype(name) == 'image/gif':
+        return data, page_mimetype(name)
+    try:
+        with Image(blob=data) as img:
+            if img.width <= width and img.height <= height:
+                return data, page_mimetype(name)
+            img.transform(resize='{}x{}>'.format(width, height))
+            img.format = 'jpeg'
+            img.compression_quality = 85
+            return img.make_blob(), 'image/jpeg'
+    except Exception as ex:
+        log.error("Page %s could not be resized: %s", name, ex)
+        return data, page_mimetype(name)
+
+
+def close_archives():
+    _archives.clear()
+    _page_index.clear()
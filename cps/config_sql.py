@@ -84,10 +84,15 @@ class _Settings(_Base):
     config_access_logfile = Column(String)
 
     config_uploading = Column(SmallInteger, default=0)
+    config_import_dir = Column(String, default=None)
+    config_staging_dir = Column(String, default=None)
     config_anonbrowse = Column(SmallInteger, default=0)
     config_public_reg = Column(SmallInteger, default=0)
     config_remote_login = Column(Boolean, default=False)
     config_kobo_sync = Column(Boolean, default=False)
+    config_use_search_index = Column(Boolean, default=False)
+    config_db_wal = Column(Boolean, default=False)
+    config_db_pool_size = Column(Integer, default=5)
 
     config_default_role = Column(SmallInteger, default=0)
     config_default_show = Column(SmallInteger, default=constants.ADMIN_USER_SIDEBAR)
@@ -130,6 +135,9 @@ class _Settings(_Base):
 
     config_kepubifypath = Column(String, default=None)
     config_converterpath = Column(String, default=None)
+    config_converter_workers = Column(Integer, default=1)
+    config_converter_timeout = Column(Integer, default=60)
+    config_converter_nice = Column(Integer, default=10)
     config_calibre = Column(String)
     config_rarfile_location = Column(String, default=None)
     config_upload_formats = Column(String, default=','.join(constants.EXTENSIONS_UPLOAD))
@@ -152,7 +152,9 @@ def selected_roles(dictionary):
 
 # :rtype: BookMeta
 BookMeta = namedtuple('BookMeta', 'file_path, extension, title, author, cover, description, tags, series, '
-                                  'series_id, languages, publisher')
+                                  'series_id, languages, publisher, file_hash')
+# the content hash is only known for uploaded files
+BookMeta.__new__.__defaults__ = (None,)
 
 STABLE_VERSION = {'version': '0.6.13 Beta'}
 
@@ -20,13 +20,18 @@
 from __future__ import division, print_function, unicode_literals
 import sys
 import os
+import threading
 import re
 import ast
 import json
+import base64
+import hashlib
+import sqlite3
+import tempfile
 from datetime import datetime
 
-from sqlalchemy import create_engine
-from sqlalchemy import Table, Column, ForeignKey, CheckConstraint
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy import Table, Column, ForeignKey, CheckConstraint, MetaData
 from sqlalchemy import String, Integer, Boolean, TIMESTAMP, Float
 from sqlalchemy.orm import relationship, sessionmaker, scoped_session
 from sqlalchemy.orm.collections import InstrumentedList
@@ -38,7 +43,8 @@ try:
 except ImportError:
     from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.pool import StaticPool
-from sqlalchemy.sql.expression import and_, true, false, text, func, or_
+from sqlalchemy.sql.expression import and_, true, false, text, func, or_, distinct, select, literal, case, collate, \
+    type_coerce
 from sqlalchemy.ext.associationproxy import association_proxy
 from flask_login import current_user
 from babel import Locale as LC
@@ -46,8 +52,11 @@ from babel.core import UnknownLocaleError
 from flask_babel import gettext as _
 from flask import flash
 
-from . import logger, ub, isoLanguages
+from . import logger, ub, isoLanguages, db_pool
 from .pagination import Pagination
+from .search_index import search_index
+from .library_watcher import library_watcher, database_version
+from . import search_cache
 
 from weakref import WeakSet
 
@@ -94,6 +103,14 @@ books_publishers_link = Table('books_publishers_link', Base.metadata,
                               Column('publisher', Integer, ForeignKey('publishers.id'), primary_key=True)
                               )
 
+# Materialised ids of all books visible to a user with language, tag or custom column restrictions, lives in an
+# own database in the temp directory which is attached to all connections to the calibre database
+visible_books = Table('visible_books', MetaData(),
+                      Column('user_id', Integer, primary_key=True),
+                      Column('book_id', Integer, primary_key=True),
+                      schema='visibility'
+                      )
+
 
 class Identifiers(Base):
     __tablename__ = 'identifiers'
@@ -433,24 +450,46 @@ class CalibreDB():
     _init = False
     engine = None
     config = None
+    # Sessions of the requests are scoped by session_factory, other sessions are created by session_maker
     session_factory = None
+    session_maker = None
+    # The visible_books table is shared by all connections, visible_books_state stores the restriction signature
+    # per user it's filled for. Increasing the generation invalidates the table for all users
+    visible_books_generation = 0
+    visible_books_state = dict()
+    # restriction relevant content of the library at the last change reported by the watcher
+    restriction_fingerprint = None
+    # Counts changes written to the calibre database by Calibre-Web
+    library_changes = 0
+    # database version of the calibre database and file/custom column signature at the last refresh
+    data_version = None
+    library_signature = None
+    # library version of the watcher at the last refresh of the sessions
+    watched_version = None
+    # serializes refreshing and reconnecting, requests check the versions again after waiting for it
+    refresh_lock = threading.RLock()
+    search_index_attached = False
+    visible_books_attached = False
     # This is a WeakSet so that references here don't keep other CalibreDB
     # instances alive once they reach the end of their respective scopes
     instances = WeakSet()
 
     def __init__(self, expire_on_commit=True):
-        """ Initialize a new CalibreDB session
+        """ Initialize a new CalibreDB session, with expire_on_commit the session of the current request is used,
+        otherwise (e.g. for background tasks) an own session
         """
         self.session = None
+        self.expire_on_commit = expire_on_commit
         if self._init:
-            self.initSession(expire_on_commit)
+            self.initSession()
 
         self.instances.add(self)
 
-    def initSession(self, expire_on_commit=True):
-        self.session = self.session_factory()
-        self.session.expire_on_commit = expire_on_commit
-        self.update_title_sort(self.config)
+    def initSession(self):
+        if self.expire_on_commit:
+            self.session = self.session_factory
+        else:
+            self.session = self.session_maker(expire_on_commit=False)
 
     @classmethod
     def setup_db_cc_classes(self, cc):
@@ -564,16 +603,22 @@ class CalibreDB():
             cls.config.invalidate()
             return False
 
+        cls.search_index_attached = bool(cls.config.config_use_search_index) \
+            and search_index.setup(app_db_path, dbpath)
+        attached = [(dbpath, 'calibre'), (app_db_path, 'app_settings')]
+        if cls.search_index_attached:
+            attached.append((search_index.path, 'search_index'))
         try:
-            cls.engine = create_engine('sqlite://',
-                                       echo=False,
-                                       isolation_level="SERIALIZABLE",
-                                       connect_args={'check_same_thread': False},
-                                       poolclass=StaticPool)
-            with cls.engine.begin() as connection:
-                connection.execute(text("attach database '{}' as calibre;".format(dbpath)))
-                connection.execute(text("attach database '{}' as app_settings;".format(app_db_path)))
-
+            attached.append((cls.setup_visible_books(app_db_path), 'visibility'))
+            cls.visible_books_attached = True
+        except (OSError, sqlite3.Error) as ex:
+            log.error("Database for the visible books could not be created: %s", ex)
+            cls.visible_books_attached = False
+        try:
+            cls.engine = db_pool.create_engine('sqlite://',
+                                               on_connect=lambda conn, __: cls.init_connection(conn, attached),
+                                               pool_size=max(1, cls.config.config_db_pool_size or db_pool.POOL_SIZE),
+                                               isolation_level="SERIALIZABLE")
             conn = cls.engine.connect()
             # conn.text_factory = lambda b: b.decode(errors = 'ignore') possible fix for #1302
         except Exception as ex:
@@ -582,22 +627,84 @@ class CalibreDB():
 
         cls.config.db_configured = True
 
-        if not cc_classes:
-            try:
-                cc = conn.execute("SELECT id, datatype FROM custom_columns")
-                cls.setup_db_cc_classes(cc)
-            except OperationalError as e:
-                log.debug_or_exception(e)
-
-        cls.session_factory = scoped_session(sessionmaker(autocommit=False,
-                                                          autoflush=True,
-                                                          bind=cls.engine))
+        with conn:
+            cls.set_journal_mode(conn, [schema for __, schema in attached], cls.config.config_db_wal)
+            if not cc_classes:
+                try:
+                    cc = conn.execute("SELECT id, datatype FROM custom_columns")
+                    cls.setup_db_cc_classes(cc)
+                except OperationalError as e:
+                    log.debug_or_exception(e)
+            cls.library_signature = cls.get_library_signature(conn, dbpath)
+        cls.data_version = cls.get_data_version(dbpath)
+        library_watcher.subscribe(cls.library_version_changed)
+        library_watcher.watch(dbpath)
+        cls.watched_version = library_watcher.version
+
+        cls.session_maker = sessionmaker(autocommit=False, autoflush=True, bind=cls.engine)
+        event.listen(cls.session_maker, 'after_flush', cls.library_changed)
+        event.listen(cls.session_maker, 'after_bulk_update', cls.library_bulk_changed)
+        event.listen(cls.session_maker, 'after_bulk_delete', cls.library_bulk_changed)
+        cls.session_factory = scoped_session(cls.session_maker, scopefunc=db_pool.session_scope)
         for inst in cls.instances:
             inst.initSession()
 
         cls._init = True
         return True
 
+    # The visible books are written by an own connection while the sessions read them, so the database is kept in
+    # WAL mode in the local temp directory, it's emptied as the library or the restrictions may have changed
+    @classmethod
+    def setup_visible_books(cls, app_db_path):
+        path = os.path.join(tempfile.gettempdir(), 'calibre_web')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        name = hashlib.sha1(os.path.abspath(app_db_path).encode('utf-8')).hexdigest()[:16]
+        path = os.path.join(path, 'visible_books-{}.db'.format(name))
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("PRAGMA journal_mode=wal")
+            conn.execute("CREATE TABLE IF NOT EXISTS visible_books "
+                         "(user_id INTEGER, book_id INTEGER, PRIMARY KEY (user_id, book_id)) WITHOUT ROWID")
+            conn.execute("DELETE FROM visible_books")
+            conn.commit()
+        finally:
+            conn.close()
+        cls.visible_books_state = dict()
+        return path
+
+    # Attaches the databases to each new connection of the pool, the main database is an own in-memory database per
+    # connection
+    @classmethod
+    def init_connection(cls, conn, attached):
+        for path, schema in attached:
+            conn.execute("attach database '{}' as {};".format(path, schema))
+        conn.create_function("title_sort", 1, title_sort_function(cls.config))
+
+    # The journal mode is stored in the database files, so calibre and all connections use it. WAL lets readers
+    # continue while another connection writes, it doesn't work for databases on network shares
+    @staticmethod
+    def set_journal_mode(conn, schemas, wal):
+        for schema in schemas:
+            try:
+                mode = conn.execute(text("PRAGMA {}.journal_mode".format(schema))).scalar().lower()
+                if wal and mode != 'wal':
+                    conn.execute(text("PRAGMA {}.journal_mode=wal".format(schema)))
+                elif not wal and mode == 'wal':
+                    conn.execute(text("PRAGMA {}.journal_mode=delete".format(schema)))
+            except OperationalError as ex:
+                log.error("Journal mode of %s could not be changed: %s", schema, ex)
+
+    # Returns the connection of the session of the current request to the pool
+    @classmethod
+    def remove_session(cls):
+        if cls.session_factory:
+            cls.session_factory.remove()
+
+    @classmethod
+    def pool_stats(cls):
+        return db_pool.stats(cls.engine)
+
     def get_book(self, book_id):
         return self.session.query(Books).filter(Books.id == book_id).first()
 
@@ -611,68 +718,263 @@ class CalibreDB():
     def get_book_format(self, book_id, file_format):
         return self.session.query(Data).filter(Data.book == book_id).filter(Data.format == file_format).first()
 
-    # Language and content filters for displaying in the UI
-    def common_filters(self, allow_show_archived=False):
-        if not allow_show_archived:
-            archived_books = (
-                ub.session.query(ub.ArchivedBook)
-                    .filter(ub.ArchivedBook.user_id == int(current_user.id))
-                    .filter(ub.ArchivedBook.is_archived == True)
-                    .all()
-            )
-            archived_book_ids = [archived_book.book_id for archived_book in archived_books]
-            archived_filter = Books.id.notin_(archived_book_ids)
-        else:
-            archived_filter = true()
+    # Called after each flush, the visible books only need to be evaluated again if a book was added or deleted or
+    # tags, languages or custom columns the restrictions depend on changed
+    @classmethod
+    def library_changed(cls, session=None, *__):
+        cls.library_changes += 1
+        if session is None or cls.restriction_changed(session):
+            cls.invalidate_visible_books()
+
+    @classmethod
+    def library_bulk_changed(cls, update_context):
+        cls.library_changes += 1
+        if cls.restricts_visibility(update_context.mapper.class_):
+            cls.invalidate_visible_books()
+
+    @staticmethod
+    def restricts_visibility(model):
+        return issubclass(model, (Books, Tags, Languages)) or \
+            getattr(model, '__tablename__', '').startswith(('custom_column_', 'books_custom_column_'))
+
+    @classmethod
+    def restriction_changed(cls, session):
+        if any(cls.restricts_visibility(type(obj)) for obj in list(session.new) + list(session.deleted)):
+            return True
+        for obj in session.dirty:
+            if isinstance(obj, Books):
+                if any((attr.key in ('tags', 'languages') or attr.key.startswith('custom_column_'))
+                       and attr.history.has_changes() for attr in inspect(obj).attrs):
+                    return True
+            elif cls.restricts_visibility(type(obj)) and session.is_modified(obj):
+                return True
+        return False
+
+    # Content of the library the restrictions depend on, book ids, tags, languages and the restricted custom column
+    @classmethod
+    def get_restriction_fingerprint(cls):
+        queries = [select([Books.id]).order_by(Books.id),
+                   select([Tags.id, Tags.name]).order_by(Tags.id),
+                   select([books_tags_link.c.book, books_tags_link.c.tag])
+                   .order_by(books_tags_link.c.book, books_tags_link.c.tag),
+                   select([Languages.id, Languages.lang_code]).order_by(Languages.id),
+                   select([books_languages_link.c.book, books_languages_link.c.lang_code])
+                   .order_by(books_languages_link.c.book, books_languages_link.c.lang_code)]
+        restricted = cls.config.config_restricted_column
+        if restricted in cc_classes:
+            for table in (cc_classes[restricted].__table__,
+                          Base.metadata.tables.get('books_custom_column_{}_link'.format(restricted))):
+                if table is not None:
+                    queries.append(select(list(table.c)).order_by(*table.primary_key.columns))
+        digest = hashlib.sha1()
+        with cls.engine.connect() as conn:
+            for query in queries:
+                for row in conn.execute(query):
+                    digest.update(repr(tuple(row)).encode('utf-8'))
+                digest.update(b'\0')
+        return restricted, digest.digest()
+
+    # Called from the library watcher thread, also for the changes of Calibre-Web. The visible books are evaluated
+    # again only if the restriction relevant content changed, the search index is updated before the next search
+    # needs it
+    @classmethod
+    def library_version_changed(cls, version):
+        try:
+            fingerprint = cls.get_restriction_fingerprint()
+        except Exception as ex:
+            log.debug("Library content could not be read: %s", ex)
+            fingerprint = None
+        if fingerprint is None or fingerprint != cls.restriction_fingerprint:
+            cls.restriction_fingerprint = fingerprint
+            cls.invalidate_visible_books()
+        if cls.search_index_attached:
+            search_index.refresh((cls.library_changes, version))
 
+    @classmethod
+    def invalidate_visible_books(cls):
+        cls.visible_books_generation += 1
+
+    # Language, tag and custom column restrictions of the current user, returns None for unrestricted users and
+    # whether the restriction could be resolved for materialising it
+    def restriction_filters(self):
         if current_user.filter_language() != "all":
             lang_filter = Books.languages.any(Languages.lang_code == current_user.filter_language())
         else:
-            lang_filter = true()
+            lang_filter = None
         negtags_list = current_user.list_denied_tags()
         postags_list = current_user.list_allowed_tags()
-        neg_content_tags_filter = false() if negtags_list == [''] else Books.tags.any(Tags.name.in_(negtags_list))
-        pos_content_tags_filter = true() if postags_list == [''] else Books.tags.any(Tags.name.in_(postags_list))
+        neg_content_tags_filter = None if negtags_list == [''] else Books.tags.any(Tags.name.in_(negtags_list))
+        pos_content_tags_filter = None if postags_list == [''] else Books.tags.any(Tags.name.in_(postags_list))
+        pos_content_cc_filter = neg_content_cc_filter = None
+        valid = True
         if self.config.config_restricted_column:
             try:
                 pos_cc_list = current_user.allowed_column_value.split(',')
-                pos_content_cc_filter = true() if pos_cc_list == [''] else \
+                pos_content_cc_filter = None if pos_cc_list == [''] else \
                     getattr(Books, 'custom_column_' + str(self.config.config_restricted_column)). \
                         any(cc_classes[self.config.config_restricted_column].value.in_(pos_cc_list))
                 neg_cc_list = current_user.denied_column_value.split(',')
-                neg_content_cc_filter = false() if neg_cc_list == [''] else \
+                neg_content_cc_filter = None if neg_cc_list == [''] else \
                     getattr(Books, 'custom_column_' + str(self.config.config_restricted_column)). \
                         any(cc_classes[self.config.config_restricted_column].value.in_(neg_cc_list))
             except (KeyError, AttributeError):
                 pos_content_cc_filter = false()
-                neg_content_cc_filter = true()
+                neg_content_cc_filter = None
+                valid = False
                 log.error(u"Custom Column No.%d is not existing in calibre database",
                           self.config.config_restricted_column)
                 flash(_("Custom Column No.%(column)d is not existing in calibre database",
                         column=self.config.config_restricted_column),
                       category="error")
+        filters = [f for f in (lang_filter, pos_content_tags_filter, pos_content_cc_filter) if f is not None]
+        filters.extend(~f for f in (neg_content_tags_filter, neg_content_cc_filter) if f is not None)
+        if not filters:
+            return None, valid
+        return and_(*filters), valid
+
+    # Changes whenever Calibre-Web or another program (watcher version or data_version) changed the calibre database
+    def library_stamp(self):
+        if library_watcher.running:
+            return self.library_changes, library_watcher.version
+        return self.library_changes, self.get_data_version(os.path.join(self.config.config_calibre_dir, "metadata.db"))
+
+    def visibility_signature(self):
+        return self.restriction_signature() + (self.library_stamp(),)
+
+    # Changes if the restrictions of the user or the restriction relevant content of the library changed. Without the
+    # watcher every change of the database by another program counts
+    def restriction_signature(self):
+        if library_watcher.running:
+            changes = self.visible_books_generation
+        else:
+            changes = self.visible_books_generation, \
+                self.get_data_version(os.path.join(self.config.config_calibre_dir, "metadata.db"))
+        return (current_user.filter_language(), current_user.denied_tags, current_user.allowed_tags,
+                current_user.denied_column_value, current_user.allowed_column_value,
+                self.config.config_restricted_column, changes)
+
+    # Filters for the books visible to the current user, restrictions are evaluated once per user and restriction
+    # change into the visible_books table, afterwards each query only needs an indexed lookup
+    def visibility_filter(self):
+        restriction, valid = self.restriction_filters()
+        if restriction is None or not valid or not self.visible_books_attached:
+            return true() if restriction is None else restriction
+        user_id = int(current_user.id)
+        try:
+            signature = self.restriction_signature()
+            if self.visible_books_state.get(user_id) != signature:
+                self.fill_visible_books(user_id, restriction)
+                self.visible_books_state[user_id] = signature
+        except OperationalError as e:
+            log.debug_or_exception(e)
+            return restriction
+        return Books.id.in_(select([visible_books.c.book_id]).where(visible_books.c.user_id == user_id))
+
+    # The table is written in an own transaction of another connection, the session's transaction and its pending
+    # changes stay untouched. The committed content of the library is evaluated
+    @classmethod
+    def fill_visible_books(cls, user_id, restriction):
+        with cls.engine.connect() as conn:
+            with conn.begin():
+                conn.execute(visible_books.delete().where(visible_books.c.user_id == user_id))
+                conn.execute(visible_books.insert().from_select(['user_id', 'book_id'],
+                                                                select([literal(user_id), Books.id])
+                                                                .where(restriction)))
 
+    # Language and content filters for displaying in the UI
+    def common_filters(self, allow_show_archived=False):
+        if not allow_show_archived:
+            archived_books = select([ub.ArchivedBook.book_id]) \
+                .where(ub.ArchivedBook.user_id == int(current_user.id)) \
+                .where(ub.ArchivedBook.is_archived == True)
+            archived_filter = Books.id.notin_(archived_books)
         else:
-            pos_content_cc_filter = true()
-            neg_content_cc_filter = false()
-        return and_(lang_filter, pos_content_tags_filter, ~neg_content_tags_filter,
-                    pos_content_cc_filter, ~neg_content_cc_filter, archived_filter)
+            archived_filter = true()
+        return and_(self.visibility_filter(), archived_filter)
 
+    # Sorts the selected books first in the order of selection followed by the other books, ascending reverses all
     @staticmethod
-    def get_checkbox_sorted(inputlist, state, offset, limit, order):
-        outcome = list()
-        elementlist = {ele.id: ele for ele in inputlist}
-        for entry in state:
-            try:
-                outcome.append(elementlist[entry])
-            except KeyError:
-                pass
-            del elementlist[entry]
-        for entry in elementlist:
-            outcome.append(elementlist[entry])
+    def checkbox_order(state, order):
+        if not state:
+            position = literal(0)
+        else:
+            position = case(dict((book_id, index) for index, book_id in enumerate(state)), value=Books.id,
+                            else_=len(state))
         if order == "asc":
-            outcome.reverse()
-        return outcome[offset:offset + limit]
+            return [position.desc(), Books.id.desc()]
+        return [position, Books.id]
+
+    # The value books are compared by for keyset pagination, dates are compared as stored, missing strings as empty
+    @staticmethod
+    def keyset_key(order_column):
+        if isinstance(order_column.type, TIMESTAMP):
+            return type_coerce(order_column, String)
+        if getattr(order_column.type, 'collation', None):
+            return collate(func.coalesce(order_column, ''), order_column.type.collation)
+        return order_column
+
+    # cursors address the page after the book, or with before set the page before it
+    @staticmethod
+    def keyset_cursor(order_column, descending, value, book_id, before=False):
+        data = [order_column.key, bool(descending), value, book_id]
+        if before:
+            data.append(True)
+        return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii').rstrip('=')
+
+    # returns the sort value and the id of the book the page starts after (or ends before) and whether the page is
+    # before the book, None for invalid cursors
+    @staticmethod
+    def parse_keyset_cursor(cursor, order_column, descending):
+        if not cursor:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)).decode('utf-8'))
+            key, desc, value, book_id = data[:4]
+            if key != order_column.key or desc != bool(descending):
+                return None
+            return value, int(book_id), bool(data[4:] and data[4])
+        except (ValueError, TypeError):
+            return None
+
+    # Fills a page of books ordered by the column and the id, starting after (or ending before) the book the cursor
+    # points to. Unlike offsets, deep pages cost the same as the first one. Returns the entries and the cursors of the
+    # next and the previous page
+    def fill_keyset_page(self, pagesize, db_filter, order_column, descending=False, cursor=None):
+        pagesize = int(pagesize or self.config.config_books_per_page)
+        key = self.keyset_key(order_column)
+        query = self.session.query(Books, key.label('keyset_value')).filter(db_filter) \
+            .filter(self.common_filters())
+        last = self.parse_keyset_cursor(cursor, order_column, descending)
+        before = bool(last and last[2])
+        if last:
+            value, book_id, __ = last
+            # the previous page is read backwards from the book
+            if descending != before:
+                query = query.filter(or_(key < value, and_(key == value, Books.id < book_id)))
+            else:
+                query = query.filter(or_(key > value, and_(key == value, Books.id > book_id)))
+        order = [key.desc(), Books.id.desc()] if descending != before else [key, Books.id]
+        rows = query.order_by(*order).limit(pagesize + 1).all()
+        more = len(rows) > pagesize
+        rows = rows[:pagesize]
+        if before:
+            if not more:
+                # no books before the page, it's the first page
+                return self.fill_keyset_page(pagesize, db_filter, order_column, descending)
+            rows.reverse()
+        next_cursor = previous_cursor = None
+        if rows and (more or before):
+            next_cursor = self.keyset_cursor(order_column, descending, rows[-1].keyset_value, rows[-1].Books.id)
+        if rows and (last and not before or more and before):
+            previous_cursor = self.keyset_cursor(order_column, descending, rows[0].keyset_value, rows[0].Books.id,
+                                                 True)
+        return [row.Books for row in rows], next_cursor, previous_cursor
+
+    # Counts the rows of a (joined) query in the database without loading them, joins can duplicate rows, so only
+    # distinct ids are counted
+    @staticmethod
+    def count_entries(query, database):
+        return query.with_entities(func.count(distinct(database.id))).order_by(None).scalar() or 0
 
     # Fill indexpage with all requested data from database
     def fill_indexpage(self, page, pagesize, database, db_filter, order, *join):
@@ -702,7 +1004,7 @@ class CalibreDB():
         pagination = list()
         try:
             pagination = Pagination(page, pagesize,
-                                    len(query.all()))
+                                    self.count_entries(query, database))
             entries = query.order_by(*order).offset(off).limit(pagesize).all()
         except Exception as ex:
             log.debug_or_exception(ex)
@@ -747,44 +1049,91 @@ class CalibreDB():
         return self.session.query(Books) \
             .filter(and_(Books.authors.any(and_(*q)), func.lower(Books.title).ilike("%" + title + "%"))).first()
 
+    # Subquery with ids and rank of the books matching the fts5 expression, None if the search index can't be used
+    def fts_matches(self, expression):
+        if not expression or not self.search_index_attached or not search_index.refresh(self.library_stamp()):
+            return None
+        return search_index.matches(expression)
+
     def search_query(self, term, *join):
+        return self.search_query_ranked(term, *join)[0]
+
+    # returns the search query and the rank column of the search index to order by (None if searched without index)
+    def search_query_ranked(self, term, *join):
         term.strip().lower()
-        self.session.connection().connection.connection.create_function("lower", 1, lcase)
-        q = list()
-        authorterms = re.split("[, ]+", term)
-        for authorterm in authorterms:
-            q.append(Books.authors.any(func.lower(Authors.name).ilike("%" + authorterm + "%")))
+        matches = self.fts_matches(search_index.match_expression(term))
         query = self.session.query(Books)
+        if matches is not None:
+            query = query.join(matches, Books.id == matches.c.rowid)
         if len(join) == 3:
             query = query.outerjoin(join[0], join[1]).outerjoin(join[2])
         elif len(join) == 2:
             query = query.outerjoin(join[0], join[1])
         elif len(join) == 1:
             query = query.outerjoin(join[0])
+        if matches is not None:
+            return query.filter(self.common_filters(True)), matches.c.rank
+        self.session.connection().connection.connection.create_function("lower", 1, lcase)
+        q = list()
+        authorterms = re.split("[, ]+", term)
+        for authorterm in authorterms:
+            q.append(Books.authors.any(func.lower(Authors.name).ilike("%" + authorterm + "%")))
         return query.filter(self.common_filters(True)).filter(
             or_(Books.tags.any(func.lower(Tags.name).ilike("%" + term + "%")),
                 Books.series.any(func.lower(Series.name).ilike("%" + term + "%")),
                 Books.authors.any(and_(*q)),
                 Books.publishers.any(func.lower(Publishers.name).ilike("%" + term + "%")),
                 func.lower(Books.title).ilike("%" + term + "%")
-                ))
+                )), None
 
     # read search results from calibre-database and return it (function is used for feed and simple search
     def get_search_results(self, term, offset=None, order=None, limit=None, *join):
-        order = order or [Books.sort]
+        query, rank = self.search_query_ranked(term, *join)
+        order = list(order or ([Books.sort] if rank is None else []))
+        # the best matches first, the chosen order decides between equally ranked books
+        if rank is not None:
+            order.insert(0, rank)
+        key = ('search', term.strip().lower(), tuple(str(element) for element in order))
+        return self.get_search_page(key, query.order_by(*order), offset, limit)
+
+    # Returns the books of the page, the number of results and the pagination of the ordered query. The ids of all
+    # results are cached, so the query runs only once while paging through the results
+    def get_search_page(self, key, query, offset=None, limit=None):
+        key = (int(current_user.id), key, self.visibility_signature())
+        ids = search_cache.get(key, lambda: search_cache.ordered_ids(query.with_entities(Books.id)))
+        ub.searched_ids[current_user.id] = ids
+        result_count = len(ids)
         pagination = None
-        result = self.search_query(term, *join).order_by(*order).all()
-        result_count = len(result)
         if offset != None and limit != None:
             offset = int(offset)
-            limit_all = offset + int(limit)
             pagination = Pagination((offset / (int(limit)) + 1), limit, result_count)
-        else:
-            offset = 0
-            limit_all = result_count
-
-        ub.store_ids(result)
-        return result[offset:limit_all], result_count, pagination
+            ids = ids[offset:offset + int(limit)]
+        return self.get_books_by_ids(ids), result_count, pagination
+
+    # Returns the visible books of the page of the most downloaded books and the number of downloaded books
+    def get_hot_books(self, offset, limit):
+        book_ids = [book_id for book_id, in ub.session.query(ub.DownloadCount.book_id)
+                    .order_by(ub.DownloadCount.count.desc(), ub.DownloadCount.book_id).offset(offset).limit(limit)]
+        if not book_ids:
+            return [], ub.session.query(ub.DownloadCount).count()
+        books = dict((book.id, book) for book in self.session.query(Books).filter(Books.id.in_(book_ids))
+                     .filter(self.common_filters()))
+        missing = [book_id for book_id in book_ids if book_id not in books]
+        if missing:
+            # downloads of books deleted from the library
+            existing = set(book_id for book_id, in self.session.query(Books.id).filter(Books.id.in_(missing)))
+            for book_id in missing:
+                if book_id not in existing:
+                    ub.delete_download(book_id)
+        return [books[book_id] for book_id in book_ids if book_id in books], ub.session.query(ub.DownloadCount).count()
+
+    # Returns the books in the order of the ids
+    def get_books_by_ids(self, book_ids):
+        books = dict()
+        for start in range(0, len(book_ids), 500):
+            for book in self.session.query(Books).filter(Books.id.in_(list(book_ids[start:start + 500]))):
+                books[book.id] = book
+        return [books[book_id] for book_id in book_ids if book_id in books]
 
     # Creates for all stored languages a translated speaking name in the array for the UI
     def speaking_language(self, languages=None):
@@ -805,22 +1154,14 @@ class CalibreDB():
         return languages
 
     def update_title_sort(self, config, conn=None):
-        # user defined sort function for calibre databases (Series, etc.)
-        def _title_sort(title):
-            # calibre sort stuff
-            title_pat = re.compile(config.config_title_regex, re.IGNORECASE)
-            match = title_pat.search(title)
-            if match:
-                prep = match.group(1)
-                title = title[len(prep):] + ', ' + prep
-            return title.strip()
-
         conn = conn or self.session.connection().connection.connection
-        conn.create_function("title_sort", 1, _title_sort)
+        conn.create_function("title_sort", 1, title_sort_function(config))
 
     @classmethod
     def dispose(cls):
-        # global session
+        # global session, the library stamp changes as another library may be opened
+        library_watcher.stop()
+        cls.library_changed()
 
         for inst in cls.instances:
             old_session = inst.session
@@ -830,11 +1171,12 @@ class CalibreDB():
                     old_session.close()
                 except Exception:
                     pass
-                if old_session.bind:
-                    try:
-                        old_session.bind.dispose()
-                    except Exception:
-                        pass
+        cls.remove_session()
+        if cls.engine:
+            try:
+                cls.engine.dispose()
+            except Exception:
+                pass
 
         for attr in list(Books.__dict__.keys()):
             if attr.startswith("custom_column_"):
@@ -850,11 +1192,70 @@ class CalibreDB():
                 if table is not None:
                     Base.metadata.remove(table)
 
+    @staticmethod
+    def get_library_signature(conn, dbpath):
+        try:
+            cc = sorted(tuple(row) for row in conn.execute(text("SELECT id, datatype FROM calibre.custom_columns")))
+        except OperationalError:
+            cc = []
+        return os.stat(dbpath).st_ino, cc
+
+    # Increases with every change of the database by another connection, also of Calibre-Web's own connections
+    @staticmethod
+    def get_data_version(dbpath):
+        return database_version.get(dbpath)
+
+    # Makes changes of other processes (e.g. calibre) to the library visible without reconnecting. Only a replaced
+    # database file or changed custom columns need the ORM classes rebuilt, which disposes all sessions
+    def refresh_library(self, config, app_db_path):
+        # nothing to do as long as the watcher reports no change
+        if library_watcher.running and library_watcher.version == self.watched_version:
+            return False
+        with self.refresh_lock:
+            return self._refresh_library(config, app_db_path)
+
+    def _refresh_library(self, config, app_db_path):
+        if library_watcher.running:
+            if library_watcher.version == self.watched_version:
+                return False
+            CalibreDB.watched_version = library_watcher.version
+        dbpath = os.path.join(config.config_calibre_dir, "metadata.db")
+        data_version = self.get_data_version(dbpath)
+        try:
+            if data_version == self.data_version and os.stat(dbpath).st_ino == self.library_signature[0]:
+                return False
+            signature = self.get_library_signature(self.session, dbpath)
+        except (OSError, OperationalError, TypeError) as ex:
+            log.debug_or_exception(ex)
+            signature = None
+        if signature != self.library_signature:
+            log.info("Calibre library structure changed, reconnecting database")
+            self.reconnect_db(config, app_db_path)
+            return True
+        log.debug("Calibre library changed externally, refreshing session")
+        CalibreDB.data_version = data_version
+        self.session.expire_all()
+        return True
+
     def reconnect_db(self, config, app_db_path):
-        self.dispose()
-        self.engine.dispose()
-        self.setup_db(config.config_calibre_dir, app_db_path)
-        self.update_config(config)
+        with self.refresh_lock:
+            self.dispose()
+            self.engine.dispose()
+            self.setup_db(config.config_calibre_dir, app_db_path)
+            self.update_config(config)
+
+
+# user defined sort function for calibre databases (Series, etc.)
+def title_sort_function(config):
+    def _title_sort(title):
+        # calibre sort stuff
+        title_pat = re.compile(config.config_title_regex, re.IGNORECASE)
+        match = title_pat.search(title)
+        if match:
+            prep = match.group(1)
+            title = title[len(prep):] + ', ' + prep
+        return title.strip()
+    return _title_sort
 
 
 def lcase(s):
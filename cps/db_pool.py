@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Connection pools of the SQLite databases. Every request works with its own session, which takes a connection from a
+# bounded pool, so a long read of one request doesn't hold back the other requests
+from __future__ import division, print_function, unicode_literals
+import threading
+import time
+
+import sqlalchemy
+from flask import _app_ctx_stack
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+from . import logger
+
+log = logger.create()
+
+# connections kept open per database, connections opened additionally under load and seconds a request waits for a
+# free connection before failing
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30
+# seconds a connection waits for the lock of another connection (or calibre) before "database is locked" is raised
+BUSY_TIMEOUT = 30
+# waits for a connection longer than this number of seconds are logged
+SLOW_WAIT = 1
+
+
+class PoolStats(object):
+    """Number of checkouts and the time spent waiting for a connection of a pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, timeout=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait >= SLOW_WAIT:
+                self.waits += 1
+            if timeout:
+                self.timeouts += 1
+        if wait >= SLOW_WAIT:
+            log.warning("Waited %.1f seconds for a database connection", wait)
+
+    def as_dict(self):
+        with self._lock:
+            return {'checkouts': self.checkouts,
+                    'slow_waits': self.waits,
+                    'timeouts': self.timeouts,
+                    'wait_time': round(self.wait_time, 3),
+                    'average_wait': round(self.wait_time / self.checkouts, 6) if self.checkouts else 0,
+                    'max_wait': round(self.max_wait, 3)}
+
+
+class MeteredQueuePool(QueuePool):
+    """Queue pool recording the time needed to get a connection, including opening new connections"""
+
+    def __init__(self, creator, **kw):
+        QueuePool.__init__(self, creator, **kw)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            conn = QueuePool._do_get(self)
+        except exc.TimeoutError:
+            self.stats.record(time.time() - start, True)
+            raise
+        self.stats.record(time.time() - start)
+        return conn
+
+    # disposing the engine replaces the pool, the statistics are kept
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.stats = self.stats
+        return pool
+
+
+def create_engine(url, on_connect=None, pool_size=POOL_SIZE, **kwargs):
+    engine = sqlalchemy.create_engine(url,
+                                      echo=False,
+                                      connect_args={'check_same_thread': False, 'timeout': BUSY_TIMEOUT},
+                                      poolclass=MeteredQueuePool,
+                                      pool_size=pool_size,
+                                      max_overflow=MAX_OVERFLOW,
+                                      pool_timeout=POOL_TIMEOUT,
+                                      **kwargs)
+    if on_connect:
+        event.listen(engine, 'connect', on_connect)
+    return engine
+
+
+def stats(engine):
+    if engine is None:
+        return None
+    pool = engine.pool
+    result = pool.stats.as_dict() if isinstance(pool, MeteredQueuePool) else dict()
+    if isinstance(pool, QueuePool):
+        result.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+    return result
+
+
+# Scope of the sessions: the application context of the request, so each request has its own session also with the
+# greenlets of gevent. Outside of requests, e.g. in background tasks, the sessions belong to the thread
+def session_scope():
+    return _app_ctx_stack.top or threading.get_ident()
@@ -31,8 +31,9 @@ import os
 
 from flask import send_file
 
-from . import logger, config
+from . import logger, config, db, ub
 from .about import collect_stats
+from .usermanagement import credential_cache
 
 log = logger.create()
 
@@ -57,6 +58,8 @@ def send_debug():
     with zipfile.ZipFile(memory_zip, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
         zf.writestr('settings.txt', json.dumps(config.toDict()))
         zf.writestr('libs.txt', json.dumps(collect_stats()))
+        zf.writestr('auth_cache.txt', json.dumps(credential_cache.stats()))
+        zf.writestr('db_pool.txt', json.dumps({'calibre': db.CalibreDB.pool_stats(), 'app': ub.pool_stats()}))
         for fp in file_list:
             zf.write(fp, os.path.basename(fp))
     memory_zip.seek(0)
@@ -24,6 +24,7 @@ from __future__ import division, print_function, unicode_literals
 import os
 from datetime import datetime
 import json
+import shutil
 from shutil import copyfile
 from uuid import uuid4
 
@@ -44,7 +45,7 @@ from flask_login import current_user, login_required
 from sqlalchemy.exc import OperationalError, IntegrityError
 from sqlite3 import OperationalError as sqliteOperationalError
 from . import constants, logger, isoLanguages, gdriveutils, uploader, helper
-from . import config, get_locale, ub, db
+from . import config, get_locale, ub, db, thumbnails, staging, file_hash
 from . import calibre_db
 from .services.worker import WorkerThread
 from .tasks.upload import TaskUpload
@@ -60,6 +61,10 @@ except ImportError:
 editbook = Blueprint('editbook', __name__)
 log = logger.create()
 
+# columns of the books table which can be edited
+LIST_EDIT_PARAMS = ('title', 'sort', 'author_sort', 'authors', 'tags', 'series', 'series_index', 'languages',
+                    'publishers')
+
 
 def upload_required(f):
     @wraps(f)
@@ -292,6 +297,7 @@ def delete_whole_book(book_id, book):
             modify_database_object([u''], getattr(book, cc_string), db.cc_classes[c.id],
                                    calibre_db.session, 'custom')
     calibre_db.session.query(db.Books).filter(db.Books.id == book_id).delete()
+    thumbnails.clear(book_id)
 
 
 def render_delete_book_result(book_format, jsonResponse, warning, book_id):
@@ -345,6 +351,7 @@ def delete_book(book_id, book_format, jsonResponse):
                     calibre_db.session.query(db.Data).filter(db.Data.book == book.id).\
                         filter(db.Data.format == book_format).delete()
                 calibre_db.session.commit()
+                file_hash.remove(ub.session, book_id, book_format or None)
             except Exception as ex:
                 log.debug_or_exception(ex)
                 calibre_db.session.rollback()
@@ -630,7 +637,7 @@ def upload_single_file(request, book, book_id):
                     flash(_(u"Failed to create path %(path)s (Permission denied).", path=filepath), category="error")
                     return redirect(url_for('web.show_book', book_id=book.id))
             try:
-                requested_file.save(saved_filename)
+                uploaded_hash = staging.move(requested_file, saved_filename)
             except OSError:
                 flash(_(u"Failed to store file %(file)s.", file=saved_filename), category="error")
                 return redirect(url_for('web.show_book', book_id=book.id))
@@ -652,6 +659,7 @@ def upload_single_file(request, book, book_id):
                     log.error('Database error: %s', e)
                     flash(_(u"Database error: %(error)s.", error=e), category="error")
                     return redirect(url_for('web.show_book', book_id=book.id))
+            file_hash.add(ub.session, book_id, file_ext, uploaded_hash, file_size)
 
             # Queue uploader info
             uploadText=_(u"File format %(ext)s added to %(book)s", ext=file_ext.upper(), book=book.title)
@@ -744,7 +752,8 @@ def edit_book(book_id):
         return redirect(url_for("web.index"))
 
     meta = upload_single_file(request, book, book_id)
-    if upload_cover(request, book) is True:
+    cover_changed = upload_cover(request, book) is True
+    if cover_changed:
         book.has_cover = 1
         modif_date = True
     try:
@@ -780,6 +789,7 @@ def edit_book(book_id):
                         if result is True:
                             book.has_cover = 1
                             modif_date = True
+                            cover_changed = True
                         else:
                             flash(error, category="error")
 
@@ -818,6 +828,8 @@ def edit_book(book_id):
                 book.last_modified = datetime.utcnow()
             calibre_db.session.merge(book)
             calibre_db.session.commit()
+            if cover_changed:
+                helper.generate_cover_thumbnails([book.id], current_user.name)
             if config.config_use_google_drive:
                 gdriveutils.updateGdriveCalibreFromLocal()
             if "detail_view" in to_save:
@@ -970,6 +982,30 @@ def file_handling_on_upload(requested_file):
     return meta, None
 
 
+# identical files are not added a second time, the book containing the file is shown instead
+def reject_duplicate_file(meta):
+    for book_id in file_hash.find_books(ub.session, meta.file_hash, meta.extension[1:]):
+        if calibre_db.get_book(book_id):
+            log.info("Uploaded file %s already exists in library", meta.file_path)
+            # books hidden from the user by restrictions aren't revealed
+            entry = calibre_db.get_filtered_book(book_id, allow_show_archived=True)
+            if entry:
+                flash(_(u"Uploaded file already exists in the library: ")
+                      + Markup(render_title_template('book_exists_flash.html', entry=entry)), category="warning")
+            else:
+                flash(_(u"Uploaded file already exists in the library"), category="warning")
+            remove_staged_files(meta)
+            return True
+    return False
+
+
+# removes the staged upload and its extracted cover, if they weren't moved into the library
+def remove_staged_files(meta):
+    for path in (meta.file_path, meta.cover):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
 def move_coverfile(meta, db_book):
     # move cover to final directory, including book id
     if meta.cover:
@@ -978,9 +1014,10 @@ def move_coverfile(meta, db_book):
         coverfile = os.path.join(constants.STATIC_DIR, 'generic_cover.jpg')
     new_coverpath = os.path.join(config.config_calibre_dir, db_book.path, "cover.jpg")
     try:
-        copyfile(coverfile, new_coverpath)
         if meta.cover:
-            os.unlink(meta.cover)
+            shutil.move(coverfile, new_coverpath)
+        else:
+            copyfile(coverfile, new_coverpath)
     except OSError as e:
         log.error("Failed to move cover file %s: %s", new_coverpath, e)
         flash(_(u"Failed to Move Cover File %(file)s: %(error)s", file=new_coverpath,
@@ -996,6 +1033,7 @@ def upload():
         abort(404)
     if request.method == 'POST' and 'btn-upload' in request.files:
         for requested_file in request.files.getlist("btn-upload"):
+            meta = None
             try:
                 modif_date = False
                 # create the function for sorting...
@@ -1005,6 +1043,8 @@ def upload():
                 meta, error = file_handling_on_upload(requested_file)
                 if error:
                     return error
+                if reject_duplicate_file(meta):
+                    continue
 
                 db_book, input_authors, title_dir = create_book_on_upload(modif_date, meta)
 
@@ -1024,6 +1064,9 @@ def upload():
 
                 # save data to database, reread data
                 calibre_db.session.commit()
+                file_hash.add(ub.session, book_id, meta.extension[1:], meta.file_hash,
+                              db_book.data[0].uncompressed_size)
+                helper.build_hash_index(current_user.name)
 
                 if config.config_use_google_drive:
                     gdriveutils.updateGdriveCalibreFromLocal()
@@ -1032,6 +1075,7 @@ def upload():
                 uploadText=_(u"File %(file)s uploaded", file=title)
                 WorkerThread.add(current_user.name, TaskUpload(
                     "<a href=\"" + url_for('web.show_book', book_id=book_id) + "\">" + uploadText + "</a>"))
+                helper.generate_cover_thumbnails([book_id], current_user.name)
 
                 if len(request.files.getlist("btn-upload")) < 2:
                     if current_user.role_edit() or current_user.role_admin():
@@ -1044,6 +1088,9 @@ def upload():
                 calibre_db.session.rollback()
                 log.error("Database error: %s", e)
                 flash(_(u"Database error: %(error)s.", error=e), category="error")
+            finally:
+                if meta:
+                    remove_staged_files(meta)
         return Response(json.dumps({"location": url_for("web.index")}), mimetype='application/json')
 
 @editbook.route("/admin/book/convert/<int:book_id>", methods=['POST'])
@@ -1088,64 +1135,67 @@ def scholar_search(query):
     else:
         return []
 
-@editbook.route("/ajax/editbooks/<param>", methods=['POST'])
-@login_required_if_no_ano
-@edit_required
-def edit_list_book(param):
-    vals = request.form.to_dict()
-    book = calibre_db.get_book(vals['pk'])
-    ret = ""
-    if param =='series_index':
+# Applies the value of one column of the books table to the book, returns success and the new displayed value or
+# the error message, None for unknown columns. Books whose directory has to be renamed are collected in renames
+# (book id -> first author), so the directory is renamed once after all changes
+def edit_list_book_param(param, book, vals, renames):
+    if param == 'series_index':
         edit_book_series_index(vals['value'], book)
-        ret = Response(json.dumps({'success': True, 'newValue': book.series_index}), mimetype='application/json')
-    elif param =='tags':
+        return True, book.series_index
+    elif param == 'tags':
         edit_book_tags(vals['value'], book)
-        ret = Response(json.dumps({'success': True, 'newValue': ', '.join([tag.name for tag in book.tags])}),
-                       mimetype='application/json')
-    elif param =='series':
+        return True, ', '.join([tag.name for tag in book.tags])
+    elif param == 'series':
         edit_book_series(vals['value'], book)
-        ret = Response(json.dumps({'success': True, 'newValue':  ', '.join([serie.name for serie in book.series])}),
-                       mimetype='application/json')
-    elif param =='publishers':
+        return True, ', '.join([serie.name for serie in book.series])
+    elif param == 'publishers':
         edit_book_publisher(vals['value'], book)
-        ret =  Response(json.dumps({'success': True,
-                                    'newValue': ', '.join([publisher.name for publisher in book.publishers])}),
-                       mimetype='application/json')
-    elif param =='languages':
+        return True, ', '.join([publisher.name for publisher in book.publishers])
+    elif param == 'languages':
         invalid = list()
         edit_book_languages(vals['value'], book, invalid=invalid)
         if invalid:
-            ret = Response(json.dumps({'success': False,
-                                       'msg': 'Invalid languages in request: {}'.format(','.join(invalid))}),
-                           mimetype='application/json')
-        else:
-            lang_names = list()
-            for lang in book.languages:
-                try:
-                    lang_names.append(LC.parse(lang.lang_code).get_language_name(get_locale()))
-                except UnknownLocaleError:
-                    lang_names.append(_(isoLanguages.get(part3=lang.lang_code).name))
-            ret =  Response(json.dumps({'success': True, 'newValue':  ', '.join(lang_names)}),
-                            mimetype='application/json')
-    elif param =='author_sort':
+            return False, 'Invalid languages in request: {}'.format(','.join(invalid))
+        lang_names = list()
+        for lang in book.languages:
+            try:
+                lang_names.append(LC.parse(lang.lang_code).get_language_name(get_locale()))
+            except UnknownLocaleError:
+                lang_names.append(_(isoLanguages.get(part3=lang.lang_code).name))
+        return True, ', '.join(lang_names)
+    elif param == 'author_sort':
         book.author_sort = vals['value']
-        ret = Response(json.dumps({'success': True, 'newValue':  book.author_sort}),
-                       mimetype='application/json')
+        return True, book.author_sort
     elif param == 'title':
-        sort = book.sort
         handle_title_on_edit(book, vals.get('value', ""))
-        helper.update_dir_stucture(book.id, config.config_calibre_dir)
-        ret = Response(json.dumps({'success': True, 'newValue':  book.title}),
-                       mimetype='application/json')
-    elif param =='sort':
+        renames.setdefault(book.id, None)
+        return True, book.title
+    elif param == 'sort':
         book.sort = vals['value']
-        ret = Response(json.dumps({'success': True, 'newValue':  book.sort}),
-                       mimetype='application/json')
-    elif param =='authors':
+        return True, book.sort
+    elif param == 'authors':
         input_authors, __ = handle_author_on_edit(book, vals['value'], vals.get('checkA', None) == "true")
-        helper.update_dir_stucture(book.id, config.config_calibre_dir, input_authors[0])
-        ret = Response(json.dumps({'success': True,
-                                   'newValue':  ' & '.join([author.replace('|',',') for author in input_authors])}),
+        renames[book.id] = input_authors[0]
+        return True, ' & '.join([author.replace('|', ',') for author in input_authors])
+    return None
+
+
+@editbook.route("/ajax/editbooks/<param>", methods=['POST'])
+@login_required_if_no_ano
+@edit_required
+def edit_list_book(param):
+    vals = request.form.to_dict()
+    book = calibre_db.get_book(vals['pk'])
+    ret = ""
+    sort = book.sort
+    renames = dict()
+    result = edit_list_book_param(param, book, vals, renames)
+    for book_id, first_author in renames.items():
+        helper.update_dir_stucture(book_id, config.config_calibre_dir, first_author)
+    if result:
+        success, value = result
+        ret = Response(json.dumps({'success': True, 'newValue': value} if success else {'success': False,
+                                                                                        'msg': value}),
                        mimetype='application/json')
     book.last_modified = datetime.utcnow()
     try:
@@ -1160,6 +1210,93 @@ def edit_list_book(param):
     return ret
 
 
+# Returns the error message for values of the changes, which can't be applied to any book
+def validate_selected_changes(changes):
+    if 'languages' in changes:
+        invalid = list()
+        isoLanguages.get_language_codes(get_locale(), changes['languages'].split(','), invalid)
+        if invalid:
+            return 'Invalid languages in request: {}'.format(','.join(invalid))
+    if 'series_index' in changes:
+        series_index = changes['series_index'] or '1'
+        if not series_index.replace('.', '', 1).isdigit():
+            return _("%(seriesindex)s is not a valid number", seriesindex=series_index)
+    return None
+
+
+# Applies the same changes to all selected books of the books table in one transaction, the result of every book
+# is returned. The changes are validated before any book is changed. The book folders are only renamed after the
+# transaction is committed, the files of a failed rename are moved back
+@editbook.route("/ajax/editselectedbooks", methods=['POST'])
+@login_required_if_no_ano
+@edit_required
+def edit_selected_books():
+    data = request.get_json() or {}
+    changes = data.get('changes') or {}
+    vals = {'checkA': "true" if data.get('checkA', True) else "false"}
+    try:
+        book_ids = list(dict.fromkeys(int(book_id) for book_id in data.get('ids') or []))
+    except (TypeError, ValueError):
+        book_ids = None
+    if not changes or not book_ids or not all(param in LIST_EDIT_PARAMS for param in changes) \
+            or not all(isinstance(value, str) for value in changes.values()):
+        return json.dumps({'success': False, 'msg': _(u"Invalid request")})
+    error = validate_selected_changes(changes)
+    if error:
+        return json.dumps({'success': False, 'msg': error})
+    books = dict((book.id, book) for book in calibre_db.session.query(db.Books).filter(db.Books.id.in_(book_ids)))
+    results = dict()
+    renames = dict()
+    now = datetime.utcnow()
+    try:
+        for book_id in book_ids:
+            book = books.get(book_id)
+            if not book:
+                results[book_id] = {'id': book_id, 'success': False, 'msg': _(u"Book not found")}
+                continue
+            sort = book.sort
+            result = {'id': book_id, 'success': True, 'newValues': dict()}
+            for param, value in changes.items():
+                __, result['newValues'][param] = edit_list_book_param(param, book, dict(vals, value=value), renames)
+            book.last_modified = now
+            # title sort is updated by the database, it's reverted if automatic fields link is deactivated
+            calibre_db.session.flush()
+            if 'title' in changes and not data.get('checkT', True):
+                calibre_db.session.expire(book, ['sort'])
+                book.sort = sort
+            results[book_id] = result
+        calibre_db.session.commit()
+    except (OperationalError, IntegrityError) as e:
+        calibre_db.session.rollback()
+        log.error("Database error: %s", e)
+        return json.dumps({'success': False, 'msg': _(u"Database error: %(error)s.", error=e)})
+    for book_id, first_author in renames.items():
+        error = rename_book_files(book_id, first_author)
+        if error:
+            results[book_id] = {'id': book_id, 'success': False, 'msg': error}
+    if config.config_use_google_drive:
+        gdriveutils.updateGdriveCalibreFromLocal()
+    results = [results[book_id] for book_id in book_ids]
+    return json.dumps({'success': all(result['success'] for result in results), 'books': results})
+
+
+# Renames the folder and files of a book after its new title or author and stores the new path, if the rename or
+# storing the path fails the moved files are moved back
+def rename_book_files(book_id, first_author):
+    moves = list()
+    try:
+        error = helper.update_dir_stucture(book_id, config.config_calibre_dir, first_author, moves=moves)
+        if not error:
+            calibre_db.session.commit()
+    except (OperationalError, IntegrityError) as e:
+        log.error("Database error: %s", e)
+        error = _(u"Database error: %(error)s.", error=e)
+    if error:
+        calibre_db.session.rollback()
+        helper.revert_moves(moves)
+    return error
+
+
 @editbook.route("/ajax/sort_value/<field>/<int:bookid>")
 @login_required
 def get_sorted_entry(field, bookid):
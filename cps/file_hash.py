@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function, unicode_literals
+import os
+import hashlib
+from collections import defaultdict
+
+from sqlalchemy import exc
+from sqlalchemy.sql.expression import func
+
+from . import logger, ub
+from .staging import HASH_ALGORITHM
+
+log = logger.create()
+
+CHUNK_SIZE = 1024 * 1024
+
+# set once all files of the library are hashed, files added afterwards are hashed when they are added
+index_built = False
+
+
+def hash_file(path):
+    file_hash = hashlib.new(HASH_ALGORITHM)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# returns the ids of the books having a file of the format with the given hash
+def find_books(session, file_hash, book_format):
+    if not file_hash:
+        return []
+    return [book_id for book_id, in session.query(ub.BookFileHash.book_id)
+            .filter(ub.BookFileHash.hash == file_hash, ub.BookFileHash.format == book_format.upper())]
+
+
+def add(session, book_id, book_format, file_hash, size, commit=True):
+    session.query(ub.BookFileHash).filter(ub.BookFileHash.book_id == book_id,
+                                          ub.BookFileHash.format == book_format.upper()).delete()
+    session.add(ub.BookFileHash(book_id=book_id, format=book_format.upper(), hash=file_hash, size=size))
+    if commit:
+        commit_session(session)
+
+
+def add_file(session, book_id, book_format, path):
+    try:
+        add(session, book_id, book_format, hash_file(path), os.path.getsize(path))
+    except OSError as ex:
+        log.error("File %s could not be hashed: %s", path, ex)
+
+
+def remove(session, book_id, book_format=None, commit=True):
+    query = session.query(ub.BookFileHash).filter(ub.BookFileHash.book_id == book_id)
+    if book_format:
+        query = query.filter(ub.BookFileHash.format == book_format.upper())
+    query.delete()
+    if commit:
+        commit_session(session)
+
+
+def commit_session(session):
+    try:
+        session.commit()
+    except exc.OperationalError as ex:
+        session.rollback()
+        log.error("Hash index could not be updated: %s", ex)
+
+
+# returns dict of (book id, format) -> size of all hashed files
+def hashed_files(session):
+    return dict(((book_id, book_format), size) for book_id, book_format, size in
+                session.query(ub.BookFileHash.book_id, ub.BookFileHash.format, ub.BookFileHash.size))
+
+
+# returns lists of (book id, format) of identical files
+def duplicates(session):
+    duplicate_hashes = session.query(ub.BookFileHash.hash).group_by(ub.BookFileHash.hash) \
+        .having(func.count(ub.BookFileHash.id) > 1)
+    groups = defaultdict(list)
+    for book_id, book_format, file_hash in session.query(ub.BookFileHash.book_id, ub.BookFileHash.format,
+                                                         ub.BookFileHash.hash) \
+            .filter(ub.BookFileHash.hash.in_(duplicate_hashes)).order_by(ub.BookFileHash.book_id):
+        groups[file_hash].append((book_id, book_format))
+    return list(groups.values())
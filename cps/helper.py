@@ -32,11 +32,13 @@ from tempfile import gettempdir
 import requests
 from babel.dates import format_datetime
 from babel.units import format_unit
-from flask import send_from_directory, make_response, redirect, abort, url_for
+from flask import send_from_directory, make_response, redirect, abort, url_for, request, Response
 from flask_babel import gettext as _
 from flask_login import current_user
 from sqlalchemy.sql.expression import true, false, and_, text, func
 from werkzeug.datastructures import Headers
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
 from werkzeug.security import generate_password_hash
 
 try:
@@ -51,12 +53,16 @@ except ImportError:
     use_unidecode = False
 
 from . import calibre_db
-from .tasks.convert import TaskConvert
-from . import logger, config, get_locale, db, ub
+from .tasks.convert import TaskConvert, TaskConvertLibrary, reserve_conversion, conversion_pending, attach_mail
+from .tasks.thumbnail import TaskGenerateCoverThumbnails
+from .tasks.import_books import TaskImportBooks
+from .tasks.hash_library import TaskHashLibrary
+from . import logger, config, get_locale, db, ub, thumbnails, comic_reader, file_hash
 from . import gdriveutils as gd
 from .constants import STATIC_DIR as _STATIC_DIR
 from .subproc_wrapper import process_wait
-from .services.worker import WorkerThread, STAT_WAITING, STAT_FAIL, STAT_STARTED, STAT_FINISH_SUCCESS
+from .services.worker import WorkerThread, STAT_WAITING, STAT_FAIL, STAT_STARTED, STAT_FINISH_SUCCESS, \
+    STAT_CANCELLED
 from .tasks.mail import TaskEmail
 
 log = logger.create()
@@ -73,6 +79,10 @@ except (ImportError, RuntimeError) as e:
 
 # Convert existing book entry to new format
 def convert_book_format(book_id, calibrepath, old_book_format, new_book_format, user_id, kindle_mail=None):
+    # conversions without sending the result are only queued once
+    if not kindle_mail and conversion_pending(book_id, new_book_format):
+        log.debug("Conversion of book id %d to %s is already queued", book_id, new_book_format)
+        return None
     book = calibre_db.get_book(book_id)
     data = calibre_db.get_book_format(book.id, old_book_format)
     file_path = os.path.join(calibrepath, book.path, data.name)
@@ -103,10 +113,47 @@ def convert_book_format(book_id, calibrepath, old_book_format, new_book_format,
            "<a href=\"" + url_for('web.show_book', book_id=book.id) + "\">" + book.title + "</a>"))
     settings['old_book_format'] = old_book_format
     settings['new_book_format'] = new_book_format
-    WorkerThread.add(user_id, TaskConvert(file_path, book.id, txt, settings, kindle_mail, user_id))
+    # the book is sent once the conversion queued before is finished
+    if kindle_mail and attach_mail(book.id, new_book_format, user_id, kindle_mail, settings):
+        log.debug("Book id %d is sent after the pending conversion to %s", book.id, new_book_format)
+        return None
+    reserved = reserve_conversion(book.id, new_book_format)
+    WorkerThread.add(user_id, TaskConvert(file_path, book.id, txt, settings, kindle_mail, user_id, reserved))
     return None
 
 
+# queues the conversion of all books having the source format but not the target format in one background task
+def convert_library_format(old_book_format, new_book_format, user_id):
+    book_ids = [book_id for book_id, in calibre_db.session.query(db.Books.id)
+                .filter(db.Books.data.any(db.Data.format == old_book_format))
+                .filter(~db.Books.data.any(db.Data.format == new_book_format))
+                .order_by(db.Books.id)
+                if reserve_conversion(book_id, new_book_format)]
+    if book_ids:
+        settings = {'old_book_format': old_book_format, 'new_book_format': new_book_format}
+        txt = u"%s -> %s: %s" % (old_book_format, new_book_format,
+                                 _(u"%(count)d books", count=len(book_ids)))
+        WorkerThread.add(user_id, TaskConvertLibrary(book_ids, txt, settings, user_id))
+    return len(book_ids)
+
+
+_hash_task = None
+
+
+# hashes the files of the library in the background once, afterwards the hashes of new files are added as they come
+def build_hash_index(user_id):
+    global _hash_task
+    if file_hash.index_built or (_hash_task and not _hash_task.dead):
+        return
+    _hash_task = TaskHashLibrary(_(u"Find duplicate files"))
+    WorkerThread.add(user_id, _hash_task)
+
+
+# queues the import of all books in the directory
+def import_books(directory, user_id):
+    WorkerThread.add(user_id, TaskImportBooks(directory, _(u"Import from %(directory)s", directory=directory)))
+
+
 def send_test_mail(kindle_mail, user_name):
     WorkerThread.add(user_name, TaskEmail(_(u'Calibre-Web test e-mail'), None, None,
                      config.get_mail_settings(), kindle_mail, _(u"Test e-mail"),
@@ -337,7 +384,10 @@ def delete_book_file(book, calibrepath, book_format=None):
 
 
 # Moves files in file storage during author/title rename, or from temp dir to file storage
-def update_dir_structure_file(book_id, calibrepath, first_author, orignal_filepath, db_filename):
+# moves is a list receiving each (source, destination) moved, so the rename can be reverted by revert_moves
+def update_dir_structure_file(book_id, calibrepath, first_author, orignal_filepath, db_filename, moves=None):
+    if moves is None:
+        moves = list()
     # get book database entry from id, if original path overwrite source with original_filepath
     localbook = calibre_db.get_book(book_id)
     if orignal_filepath:
@@ -365,6 +415,7 @@ def update_dir_structure_file(book_id, calibrepath, first_author, orignal_filepa
                 if not os.path.isdir(new_path):
                     os.makedirs(new_path)
                 shutil.move(os.path.normcase(path), os.path.normcase(os.path.join(new_path, db_filename)))
+                moves.append((path, os.path.join(new_path, db_filename)))
                 log.debug("Moving title: %s to %s/%s", path, new_path, new_name)
                 # Check new path is not valid path
             else:
@@ -372,6 +423,7 @@ def update_dir_structure_file(book_id, calibrepath, first_author, orignal_filepa
                     # move original path to new path
                     log.debug("Moving title: %s to %s", path, new_path)
                     shutil.move(os.path.normcase(path), os.path.normcase(new_path))
+                    moves.append((path, new_path))
                 else: # path is valid copy only files to new location (merge)
                     log.info("Moving title: %s into existing: %s", path, new_path)
                     # Take all files and subfolder from old path (strange command)
@@ -379,6 +431,8 @@ def update_dir_structure_file(book_id, calibrepath, first_author, orignal_filepa
                         for file in file_list:
                             shutil.move(os.path.normcase(os.path.join(dir_name, file)),
                                             os.path.normcase(os.path.join(new_path + dir_name[len(path):], file)))
+                            moves.append((os.path.join(dir_name, file),
+                                          os.path.join(new_path + dir_name[len(path):], file)))
                             # os.unlink(os.path.normcase(os.path.join(dir_name, file)))
             # change location in database to new author/title path
             localbook.path = os.path.join(new_authordir, new_titledir).replace('\\','/')
@@ -394,6 +448,8 @@ def update_dir_structure_file(book_id, calibrepath, first_author, orignal_filepa
                 shutil.move(os.path.normcase(
                     os.path.join(new_path, file_format.name + '.' + file_format.format.lower())),
                     os.path.normcase(os.path.join(new_path, new_name + '.' + file_format.format.lower())))
+                moves.append((os.path.join(new_path, file_format.name + '.' + file_format.format.lower()),
+                              os.path.join(new_path, new_name + '.' + file_format.format.lower())))
                 file_format.name = new_name
             if not orignal_filepath and len(os.listdir(os.path.dirname(path))) == 0:
                 shutil.rmtree(os.path.dirname(path))
@@ -532,20 +588,83 @@ def valid_email(email):
 # ################################# External interface #################################
 
 
-def update_dir_stucture(book_id, calibrepath, first_author=None, orignal_filepath=None, db_filename=None):
+def update_dir_stucture(book_id, calibrepath, first_author=None, orignal_filepath=None, db_filename=None,
+                        moves=None):
     if config.config_use_google_drive:
         return update_dir_structure_gdrive(book_id, first_author)
     else:
-        return update_dir_structure_file(book_id, calibrepath, first_author, orignal_filepath, db_filename)
+        # open archives of the comic reader prevent renaming the files on windows
+        comic_reader.close_archives()
+        return update_dir_structure_file(book_id, calibrepath, first_author, orignal_filepath, db_filename, moves)
+
+
+# Moves the files and directories of a failed rename back, the emptied directories are removed
+def revert_moves(moves):
+    for source, destination in reversed(moves):
+        try:
+            if not os.path.isdir(os.path.dirname(source)):
+                os.makedirs(os.path.dirname(source))
+            shutil.move(os.path.normcase(destination), os.path.normcase(source))
+            directory = os.path.dirname(destination)
+            while directory and os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+        except OSError as ex:
+            log.error("Moving %s back to %s failed: %s", destination, source, ex)
 
 
 def delete_book(book, calibrepath, book_format):
     if config.config_use_google_drive:
         return delete_book_gdrive(book, book_format)
     else:
+        comic_reader.close_archives()
         return delete_book_file(book, calibrepath, book_format)
 
 
+# validators of a library file, computed from the database without touching the file itself
+def book_validators(book, book_format='cover', size=None):
+    last_modified = book.last_modified.replace(tzinfo=None) if book.last_modified else None
+    etag = '{}-{}-{}-{}'.format(book.id, book_format.lower(),
+                                last_modified.strftime('%Y%m%d%H%M%S%f') if last_modified else '', size or 0)
+    return etag, last_modified
+
+
+# answers If-None-Match/If-Modified-Since requests with 304 if the client's copy is still current
+def not_modified_response(etag, last_modified):
+    if request.method in ('GET', 'HEAD') and \
+            not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        return response
+    return None
+
+
+def add_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, max-age=0, must-revalidate"
+    return response
+
+
+# streams a file of the library, range requests are answered with partial content
+def send_library_file(path, etag, last_modified, mimetype=None):
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+    if not mimetype:
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    size = os.path.getsize(path)
+    response = Response(wrap_file(request.environ, open(path, 'rb')), mimetype=mimetype,
+                        direct_passthrough=True)
+    response.content_length = size
+    response.accept_ranges = "bytes"
+    add_validators(response, etag, last_modified)
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
 def get_cover_on_failure(use_generic_cover):
     if use_generic_cover:
         return send_from_directory(_STATIC_DIR, "generic_cover.jpg")
@@ -553,18 +672,48 @@ def get_cover_on_failure(use_generic_cover):
         return None
 
 
-def get_book_cover(book_id):
+def get_book_cover(book_id, resolution=None):
     book = calibre_db.get_filtered_book(book_id, allow_show_archived=True)
-    return get_book_cover_internal(book, use_generic_cover_on_failure=True)
+    return get_book_cover_internal(book, use_generic_cover_on_failure=True, resolution=resolution)
 
 
 def get_book_cover_with_uuid(book_uuid,
-                             use_generic_cover_on_failure=True):
+                             use_generic_cover_on_failure=True, resolution=None, greyscale=False):
     book = calibre_db.get_book_by_uuid(book_uuid)
-    return get_book_cover_internal(book, use_generic_cover_on_failure)
+    return get_book_cover_internal(book, use_generic_cover_on_failure, resolution, greyscale)
+
+
+# serves a cached thumbnail of the cover, None if the full cover has to be used
+def get_cover_thumbnail(book, resolution, greyscale=False):
+    if isinstance(resolution, tuple):
+        width, height = thumbnails.snap_size(*resolution)
+    elif resolution in thumbnails.RESOLUTIONS:
+        width, height = thumbnails.RESOLUTIONS[resolution]
+    else:
+        return None
+    image_format = 'jpeg'
+    # only clients explicitly asking for webp get it, */* is too vague for that
+    if thumbnails.webp_supported() and 'image/webp' in request.accept_mimetypes.values():
+        image_format = 'webp'
+    last_modified = thumbnails.cover_last_modified(book)
+    not_modified = not_modified_response(thumbnails.thumbnail_key(book, width, height, greyscale, image_format),
+                                          last_modified)
+    if not_modified:
+        not_modified.vary.add("Accept")
+        return not_modified
+    thumbnail = thumbnails.get_thumbnail(book, width, height, greyscale, image_format)
+    if not thumbnail:
+        return None
+    path, key = thumbnail
+    with open(path, 'rb') as f:
+        response = make_response(f.read())
+    response.headers["Content-Type"] = thumbnails.MIME_TYPES[image_format]
+    response.vary.add("Accept")
+    add_validators(response, key, last_modified)
+    return response.make_conditional(request)
 
 
-def get_book_cover_internal(book, use_generic_cover_on_failure):
+def get_book_cover_internal(book, use_generic_cover_on_failure, resolution=None, greyscale=False):
     if book and book.has_cover:
         if config.config_use_google_drive:
             try:
@@ -580,15 +729,25 @@ def get_book_cover_internal(book, use_generic_cover_on_failure):
                 log.debug_or_exception(ex)
                 return get_cover_on_failure(use_generic_cover_on_failure)
         else:
-            cover_file_path = os.path.join(config.config_calibre_dir, book.path)
-            if os.path.isfile(os.path.join(cover_file_path, "cover.jpg")):
-                return send_from_directory(cover_file_path, "cover.jpg")
+            if resolution:
+                response = get_cover_thumbnail(book, resolution, greyscale)
+                if response:
+                    return response
+            cover_file = os.path.join(config.config_calibre_dir, book.path, "cover.jpg")
+            if os.path.isfile(cover_file):
+                return send_library_file(cover_file, *book_validators(book), mimetype="image/jpeg")
             else:
                 return get_cover_on_failure(use_generic_cover_on_failure)
     else:
         return get_cover_on_failure(use_generic_cover_on_failure)
 
 
+# generates the cover thumbnails of the books in the background
+def generate_cover_thumbnails(book_ids, user_name):
+    if thumbnails.use_IM and not config.config_use_google_drive:
+        WorkerThread.add(user_name, TaskGenerateCoverThumbnails(book_ids))
+
+
 # saves book cover from url
 def save_cover_from_url(url, book_path):
     try:
@@ -672,12 +831,16 @@ def save_cover(img, book_path):
 
 
 def do_download_file(book, book_format, client, data, headers):
+    etag, last_modified = book_validators(book, book_format, data.uncompressed_size)
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
     if config.config_use_google_drive:
         startTime = time.time()
         df = gd.getFileFromEbooksFolder(book.path, data.name + "." + book_format)
         log.debug('%s', time.time() - startTime)
         if df:
-            return gd.do_gdrive_download(df, headers)
+            return add_validators(gd.do_gdrive_download(df, headers), etag, last_modified)
         else:
             abort(404)
     else:
@@ -685,11 +848,13 @@ def do_download_file(book, book_format, client, data, headers):
         if not os.path.isfile(os.path.join(filename, data.name + "." + book_format)):
             # ToDo: improve error handling
             log.error('File not found: %s', os.path.join(filename, data.name + "." + book_format))
+            abort(404)
 
         if client == "kobo" and book_format == "kepub":
             headers["Content-Disposition"] = headers["Content-Disposition"].replace(".kepub", ".kepub.epub")
 
-        response = make_response(send_from_directory(filename, data.name + "." + book_format))
+        response = send_library_file(os.path.join(filename, data.name + "." + book_format), etag, last_modified,
+                                     headers.get("Content-Type"))
         # ToDo Check headers parameter
         for element in headers:
             response.headers[element[0]] = element[1]
@@ -773,12 +938,16 @@ def render_task_status(tasklist):
                     ret['status'] = _(u'Started')
                 elif task.stat == STAT_FINISH_SUCCESS:
                     ret['status'] = _(u'Finished')
+                elif task.stat == STAT_CANCELLED:
+                    ret['status'] = _(u'Cancelled')
                 else:
                     ret['status'] = _(u'Unknown Status')
 
             ret['taskMessage'] = "{}: {}".format(_(task.name), task.message)
             ret['progress'] = "{} %".format(int(task.progress * 100))
             ret['user'] = user
+            ret['task_id'] = str(task.id)
+            ret['cancellable'] = task.cancellable
             renderedtasklist.append(ret)
 
     return renderedtasklist
@@ -833,9 +1002,6 @@ def get_download_link(book_id, book_format, client):
         log.error("Book id {} not found for downloading".format(book_id))
         abort(404)
     if data1:
-        # collect downloaded books only for registered user and not for anonymous user
-        if current_user.is_authenticated:
-            ub.update_download(book_id, int(current_user.id))
         file_name = book.title
         if len(book.authors) > 0:
             file_name = book.authors[0].name + '_' + file_name
@@ -844,6 +1010,12 @@ def get_download_link(book_id, book_format, client):
         headers["Content-Type"] = mimetypes.types_map.get('.' + book_format, "application/octet-stream")
         headers["Content-Disposition"] = "attachment; filename=%s.%s; filename*=UTF-8''%s.%s" % (
             quote(file_name.encode('utf-8')), book_format, quote(file_name.encode('utf-8')), book_format)
-        return do_download_file(book, book_format, client, data1, headers)
+        response = do_download_file(book, book_format, client, data1, headers)
+        # collect downloaded books only for registered user and not for anonymous user. Only sent files are counted,
+        # not revalidated ones or further parts of a resumed download
+        if current_user.is_authenticated and (response.status_code == 200 or response.status_code == 206
+                                              and response.content_range and response.content_range.start == 0):
+            ub.update_download(book_id, int(current_user.id))
+        return response
     else:
         abort(404)
@@ -41,8 +41,9 @@ from flask import (
 )
 from flask_login import current_user
 from werkzeug.datastructures import Headers
-from sqlalchemy import func
-from sqlalchemy.sql.expression import and_, or_
+from sqlalchemy import func, DateTime
+from sqlalchemy.orm import selectinload, joinedload
+from sqlalchemy.sql.expression import and_, or_, true, case, literal, select
 from sqlalchemy.exc import StatementError
 import requests
 
@@ -139,60 +140,24 @@ def HandleSyncRequest():
     if not current_app.wsgi_app.is_proxied:
         log.debug('Kobo: Received unproxied request, changed request port to external server port')
 
-    # TODO: Limit the number of books return per sync call, and rely on the sync-continuatation header
-    # instead so that the device triggers another sync.
-
     new_books_last_modified = sync_token.books_last_modified
     new_books_last_created = sync_token.books_last_created
     new_reading_state_last_modified = sync_token.reading_state_last_modified
     new_archived_last_modified = datetime.datetime.min
     sync_results = []
 
-    # We reload the book database so that the user get's a fresh view of the library
-    # in case of external changes (e.g: adding a book through Calibre).
-    calibre_db.reconnect_db(config, ub.app_DB_path)
-
     only_kobo_shelves = current_user.kobo_only_shelves_sync
-    # calibre_db.session.query(ub.Shelf).filter(ub.Shelf.user_id == current_user.id).filter(ub.Shelf.kobo_sync).count() > 0
-
-    if only_kobo_shelves:
-        changed_entries = (
-            calibre_db.session.query(db.Books,
-                                     ub.ArchivedBook.last_modified,
-                                     ub.BookShelf.date_added,
-                                     ub.ArchivedBook.is_archived)
-                .join(db.Data).outerjoin(ub.ArchivedBook, db.Books.id == ub.ArchivedBook.book_id)
-                .filter(or_(db.Books.last_modified > sync_token.books_last_modified,
-                            ub.BookShelf.date_added > sync_token.books_last_modified))
-                .filter(db.Data.format.in_(KOBO_FORMATS)).filter(calibre_db.common_filters())
-                .order_by(db.Books.id)
-                .order_by(ub.ArchivedBook.last_modified)
-                .join(ub.BookShelf, db.Books.id == ub.BookShelf.book_id)
-                .join(ub.Shelf)
-                .filter(ub.Shelf.kobo_sync)
-                .distinct()
-        )
-    else:
-        changed_entries = (
-            calibre_db.session.query(db.Books, ub.ArchivedBook.last_modified, ub.ArchivedBook.is_archived)
-                .join(db.Data).outerjoin(ub.ArchivedBook, db.Books.id == ub.ArchivedBook.book_id)
-                .filter(db.Books.last_modified > sync_token.books_last_modified)
-                .filter(calibre_db.common_filters())
-                .filter(db.Data.format.in_(KOBO_FORMATS))
-                .order_by(db.Books.last_modified)
-                .order_by(db.Books.id)
-        )
 
-    if sync_token.books_last_id > -1:
-        changed_entries = changed_entries.filter(db.Books.id > sync_token.books_last_id)
+    changed_entries, more_entries = get_changed_entries(sync_token, only_kobo_shelves)
 
+    kobo_reading_states = get_or_create_reading_states([book.Books.id for book in changed_entries])
     reading_states_in_new_entitlements = []
-    for book in changed_entries.limit(SYNC_ITEM_LIMIT):
+    for book in changed_entries:
         formats = [data.format for data in book.Books.data]
         if not 'KEPUB' in formats and config.config_kepubifypath and 'EPUB' in formats:
             helper.convert_book_format(book.Books.id, config.config_calibre_dir, 'EPUB', 'KEPUB', current_user.name)
 
-        kobo_reading_state = get_or_create_reading_state(book.Books.id)
+        kobo_reading_state = kobo_reading_states[book.Books.id]
         entitlement = {
             "BookEntitlement": create_book_entitlement(book.Books, archived=(book.is_archived == True)),
             "BookMetadata": get_metadata(book.Books),
@@ -204,41 +169,30 @@ def HandleSyncRequest():
             reading_states_in_new_entitlements.append(book.Books.id)
 
         ts_created = book.Books.timestamp
-
-        try:
+        if book.date_added:
             ts_created = max(ts_created, book.date_added)
-        except AttributeError:
-            pass
 
         if ts_created > sync_token.books_last_created:
             sync_results.append({"NewEntitlement": entitlement})
         else:
             sync_results.append({"ChangedEntitlement": entitlement})
 
-        new_books_last_modified = max(
-            book.Books.last_modified, new_books_last_modified
-        )
-        try:
-            new_books_last_modified = max(
-                new_books_last_modified, book.date_added
-            )
-        except AttributeError:
-            pass
-
-        new_books_last_created = max(ts_created, new_books_last_created)
-
-    max_change = changed_entries.from_self().filter(ub.ArchivedBook.is_archived)\
-        .order_by(func.datetime(ub.ArchivedBook.last_modified).desc()).first()
-
-    max_change = max_change.last_modified if max_change else new_archived_last_modified
-
-    new_archived_last_modified = max(new_archived_last_modified, max_change)
-
-    # no. of books returned
-    book_count = changed_entries.count()
-
-    # last entry:
-    books_last_id = changed_entries.all()[-1].Books.id or -1 if book_count else -1
+    if changed_entries:
+        # the watermarks are computed over all changed books, not only over the returned page
+        last_entry = changed_entries[-1]
+        new_archived_last_modified = max(new_archived_last_modified,
+                                         last_entry.max_archive_modified or datetime.datetime.min)
+        if more_entries:
+            # the device requests the next page with the same watermarks, continuing after the last book id
+            books_last_id = last_entry.Books.id
+        else:
+            new_books_last_modified = max(new_books_last_modified, last_entry.max_last_modified,
+                                          last_entry.max_date_added or datetime.datetime.min)
+            new_books_last_created = max(new_books_last_created, last_entry.max_timestamp,
+                                         last_entry.max_date_added or datetime.datetime.min)
+            books_last_id = -1
+    else:
+        books_last_id = -1
 
     # generate reading state data
     changed_reading_states = ub.session.query(ub.KoboReadingState)
@@ -260,8 +214,11 @@ def HandleSyncRequest():
         and_(ub.KoboReadingState.user_id == current_user.id,
              ub.KoboReadingState.book_id.notin_(reading_states_in_new_entitlements)))
 
-    for kobo_reading_state in changed_reading_states.all():
-        book = calibre_db.session.query(db.Books).filter(db.Books.id == kobo_reading_state.book_id).one_or_none()
+    changed_reading_states = changed_reading_states.options(*reading_state_load_options()).all()
+    books = dict((book.id, book) for book in calibre_db.session.query(db.Books).filter(
+        db.Books.id.in_([kobo_reading_state.book_id for kobo_reading_state in changed_reading_states])))
+    for kobo_reading_state in changed_reading_states:
+        book = books.get(kobo_reading_state.book_id)
         if book:
             sync_results.append({
                 "ChangedReadingState": {
@@ -278,7 +235,68 @@ def HandleSyncRequest():
     sync_token.reading_state_last_modified = new_reading_state_last_modified
     sync_token.books_last_id = books_last_id
 
-    return generate_sync_response(sync_token, sync_results, book_count)
+    return generate_sync_response(sync_token, sync_results, more_entries)
+
+
+# Returns the next page of books changed since the sync token, and if there are more pages. All books changed since
+# the token are selected once in a common table expression, the page is fetched by book id after the last synced book
+# together with the watermarks over all changed books
+def get_changed_entries(sync_token, only_kobo_shelves):
+    archived_book = and_(db.Books.id == ub.ArchivedBook.book_id, ub.ArchivedBook.user_id == current_user.id)
+    if only_kobo_shelves:
+        changed = (
+            calibre_db.session.query(db.Books.id.label('book_id'),
+                                     db.Books.last_modified.label('last_modified'),
+                                     db.Books.timestamp.label('timestamp'),
+                                     func.max(ub.BookShelf.date_added).label('date_added'),
+                                     ub.ArchivedBook.last_modified.label('archive_last_modified'),
+                                     ub.ArchivedBook.is_archived.label('is_archived'))
+                .outerjoin(ub.ArchivedBook, archived_book)
+                .join(ub.BookShelf, db.Books.id == ub.BookShelf.book_id)
+                .join(ub.Shelf)
+                .filter(ub.Shelf.kobo_sync, ub.Shelf.user_id == current_user.id)
+                .filter(or_(db.Books.last_modified > sync_token.books_last_modified,
+                            ub.BookShelf.date_added > sync_token.books_last_modified))
+                .group_by(db.Books.id)
+        )
+    else:
+        changed = (
+            calibre_db.session.query(db.Books.id.label('book_id'),
+                                     db.Books.last_modified.label('last_modified'),
+                                     db.Books.timestamp.label('timestamp'),
+                                     literal(None, DateTime).label('date_added'),
+                                     ub.ArchivedBook.last_modified.label('archive_last_modified'),
+                                     ub.ArchivedBook.is_archived.label('is_archived'))
+                .outerjoin(ub.ArchivedBook, archived_book)
+                .filter(db.Books.last_modified > sync_token.books_last_modified)
+        )
+    changed = changed.filter(db.Books.data.any(db.Data.format.in_(KOBO_FORMATS))) \
+        .filter(calibre_db.common_filters()).cte('changed_books')
+
+    def maximum(column):
+        return select([func.max(column)]).select_from(changed).as_scalar()
+
+    entries = (
+        calibre_db.session.query(db.Books,
+                                 changed.c.date_added,
+                                 changed.c.is_archived,
+                                 maximum(changed.c.last_modified).label('max_last_modified'),
+                                 maximum(changed.c.timestamp).label('max_timestamp'),
+                                 maximum(changed.c.date_added).label('max_date_added'),
+                                 maximum(case([(changed.c.is_archived == true(), changed.c.archive_last_modified)]))
+                                 .label('max_archive_modified'))
+            .join(changed, db.Books.id == changed.c.book_id)
+            .filter(changed.c.book_id > sync_token.books_last_id)
+            .order_by(changed.c.book_id)
+            .options(selectinload(db.Books.data),
+                     selectinload(db.Books.authors),
+                     selectinload(db.Books.series),
+                     selectinload(db.Books.publishers),
+                     selectinload(db.Books.comments))
+            .limit(SYNC_ITEM_LIMIT + 1)
+            .all()
+    )
+    return entries[:SYNC_ITEM_LIMIT], len(entries) > SYNC_ITEM_LIMIT
 
 
 def generate_sync_response(sync_token, sync_results, set_cont=False):
@@ -799,18 +817,49 @@ def get_ub_read_status(kobo_read_status):
 
 
 def get_or_create_reading_state(book_id):
-    book_read = ub.session.query(ub.ReadBook).filter(ub.ReadBook.book_id == book_id,
-                                                          ub.ReadBook.user_id == current_user.id).one_or_none()
-    if not book_read:
-        book_read = ub.ReadBook(user_id=current_user.id, book_id=book_id)
-    if not book_read.kobo_reading_state:
-        kobo_reading_state = ub.KoboReadingState(user_id=book_read.user_id, book_id=book_id)
-        kobo_reading_state.current_bookmark = ub.KoboBookmark()
-        kobo_reading_state.statistics = ub.KoboStatistics()
-        book_read.kobo_reading_state = kobo_reading_state
-    ub.session.add(book_read)
-    ub.session_commit()
-    return book_read.kobo_reading_state
+    return get_or_create_reading_states([book_id])[book_id]
+
+
+# reading states are always used together with the read status, the bookmark and the statistics
+def reading_state_load_options():
+    return (joinedload(ub.KoboReadingState.book_read_link),
+            joinedload(ub.KoboReadingState.current_bookmark),
+            joinedload(ub.KoboReadingState.statistics))
+
+
+# Returns the reading states of the current user for all books, missing states are created with bulk inserts
+def get_or_create_reading_states(book_ids):
+    if not book_ids:
+        return dict()
+
+    def query_reading_states():
+        return ub.session.query(ub.KoboReadingState)\
+            .filter(ub.KoboReadingState.user_id == current_user.id, ub.KoboReadingState.book_id.in_(book_ids))\
+            .options(*reading_state_load_options())
+
+    existing_states = dict((state.book_id, state) for state in query_reading_states())
+    missing = [book_id for book_id in book_ids if book_id not in existing_states
+               or not (existing_states[book_id].book_read_link and existing_states[book_id].current_bookmark
+                       and existing_states[book_id].statistics)]
+    if missing:
+        read_books = set(book_id for book_id, in ub.session.query(ub.ReadBook.book_id)
+                         .filter(ub.ReadBook.user_id == current_user.id, ub.ReadBook.book_id.in_(missing)))
+        ub.session.bulk_insert_mappings(ub.ReadBook, [dict(user_id=current_user.id, book_id=book_id)
+                                                      for book_id in missing if book_id not in read_books])
+        ub.session.bulk_insert_mappings(ub.KoboReadingState, [dict(user_id=current_user.id, book_id=book_id)
+                                                              for book_id in missing
+                                                              if book_id not in existing_states])
+        states = ub.session.query(ub.KoboReadingState.id, ub.KoboReadingState.book_id)\
+            .filter(ub.KoboReadingState.user_id == current_user.id, ub.KoboReadingState.book_id.in_(missing)).all()
+        ub.session.bulk_insert_mappings(ub.KoboBookmark, [dict(kobo_reading_state_id=state.id) for state in states
+                                                          if not existing_states.get(state.book_id)
+                                                          or not existing_states[state.book_id].current_bookmark])
+        ub.session.bulk_insert_mappings(ub.KoboStatistics, [dict(kobo_reading_state_id=state.id) for state in states
+                                                            if not existing_states.get(state.book_id)
+                                                            or not existing_states[state.book_id].statistics])
+        ub.session_commit()
+        existing_states = dict((state.book_id, state) for state in query_reading_states().populate_existing())
+    return existing_states
 
 
 def get_kobo_reading_state_response(book, kobo_reading_state):
@@ -868,8 +917,13 @@ def get_current_bookmark_response(current_bookmark):
 @kobo.route("/<book_uuid>/<width>/<height>/<Quality>/<isGreyscale>/image.jpg")
 @requires_kobo_auth
 def HandleCoverImageRequest(book_uuid, width, height,Quality, isGreyscale):
+    try:
+        resolution = (int(width), int(height))
+    except ValueError:
+        resolution = None
     book_cover = helper.get_book_cover_with_uuid(
-        book_uuid, use_generic_cover_on_failure=False
+        book_uuid, use_generic_cover_on_failure=False, resolution=resolution,
+        greyscale=isGreyscale.lower() == 'true'
     )
     if not book_cover:
         if config.config_kobo_proxy:
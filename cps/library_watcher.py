@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function, unicode_literals
+import os
+import select
+import sqlite3
+import struct
+import threading
+import time
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+from . import logger
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    use_inotify = hasattr(_libc, 'inotify_init1')
+except (ImportError, OSError, TypeError):
+    use_inotify = False
+
+log = logger.create()
+
+# seconds between two checks of the database if inotify is not available
+POLL_INTERVAL = 2
+# with inotify the database is checked anyway after this number of seconds, e.g. for network file systems
+INOTIFY_TIMEOUT = 60
+# seconds to wait for further writes after an event, calibre writes a change in several transactions
+SETTLE_TIME = 0.5
+# seconds between checks for stopping while waiting for inotify events
+STOP_INTERVAL = 0.5
+# seconds stop waits for the watcher thread to finish
+STOP_TIMEOUT = 5
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class LibraryWatcher(object):
+    """Watches the metadata.db of the library for changes by Calibre-Web and other programs like calibre.
+    Each change increases the library version and is reported to the subscribers from the watcher thread"""
+
+    def __init__(self):
+        self.version = 0
+        self.dbpath = None
+        self._subscribers = list()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def subscribe(self, callback):
+        """callback is called with the new library version after each change"""
+        with self._lock:
+            if callback not in self._subscribers:
+                self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def watch(self, dbpath):
+        self.stop()
+        self.dbpath = dbpath
+        # another library counts as change as well
+        self.changed()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(dbpath, self._stop), name="LibraryWatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._stop:
+            self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(STOP_TIMEOUT)
+            if self._thread.is_alive():
+                log.warning("Library watcher didn't stop within %d seconds", STOP_TIMEOUT)
+        self._thread = None
+        self._stop = None
+
+    def changed(self):
+        with self._lock:
+            self.version += 1
+            version = self.version
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(version)
+            except Exception as ex:
+                log.error("Library change could not be processed: %s", ex)
+        return version
+
+    # The path is quoted for the URI, otherwise e.g. '?', '#' or '%' in it would be parsed
+    @staticmethod
+    def _connect(dbpath):
+        conn = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(dbpath)), uri=True, check_same_thread=False)
+        return conn, os.stat(dbpath).st_ino
+
+    @staticmethod
+    def _inotify(directory):
+        if not use_inotify:
+            return None
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            log.debug("inotify not available: %s", os.strerror(ctypes.get_errno()))
+            return None
+        # the directory is watched, calibre replaces metadata.db e.g. when restoring the database
+        if _libc.inotify_add_watch(fd, os.fsencode(directory), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            log.debug("Library directory can't be watched: %s", os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return None
+        return fd
+
+    @staticmethod
+    def _read_events(fd):
+        names = set()
+        try:
+            while True:
+                data = os.read(fd, 4096)
+                offset = 0
+                while offset < len(data):
+                    __, __, __, length = _EVENT_HEADER.unpack_from(data, offset)
+                    offset += _EVENT_HEADER.size
+                    names.add(data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace'))
+                    offset += length
+        except BlockingIOError:
+            pass
+        return names
+
+    def _wait(self, fd, stop):
+        # returns after the database (or its journal) was written or the timeout
+        if fd is None:
+            stop.wait(POLL_INTERVAL)
+            return
+        database = os.path.basename(self.dbpath)
+        timeout = time.time() + INOTIFY_TIMEOUT
+        while not stop.is_set():
+            if not select.select([fd], [], [], STOP_INTERVAL)[0]:
+                if time.time() >= timeout:
+                    return
+                continue
+            if any(name.startswith(database) for name in self._read_events(fd)):
+                stop.wait(SETTLE_TIME)
+                self._read_events(fd)
+                return
+
+    def _run(self, dbpath, stop):
+        fd = self._inotify(os.path.dirname(dbpath))
+        log.debug("Watching %s %s", dbpath, "with inotify" if fd is not None else "by polling")
+        conn = None
+        try:
+            conn, inode = self._connect(dbpath)
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            while not stop.is_set():
+                self._wait(fd, stop)
+                if stop.is_set():
+                    break
+                try:
+                    if os.stat(dbpath).st_ino != inode:
+                        conn.close()
+                        conn, inode = self._connect(dbpath)
+                        data_version = None
+                    current = conn.execute("PRAGMA data_version").fetchone()[0]
+                except (OSError, sqlite3.Error) as ex:
+                    # e.g. the database is replaced right now
+                    log.debug("Library database could not be checked: %s", ex)
+                    continue
+                if current != data_version:
+                    data_version = current
+                    log.debug("Library changed, version %d", self.changed())
+        except (OSError, sqlite3.Error) as ex:
+            log.error("Library database can't be watched: %s", ex)
+        finally:
+            if conn:
+                conn.close()
+            if fd is not None:
+                os.close(fd)
+
+
+class DatabaseVersion(object):
+    """Version of the database, which increases with every change by another connection. PRAGMA data_version of one
+    dedicated connection is used, unlike modification time and size of the file it can't repeat"""
+
+    def __init__(self):
+        self.version = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._dbpath = None
+        self._inode = None
+        self._data_version = None
+
+    def get(self, dbpath):
+        with self._lock:
+            try:
+                if self._conn is None or dbpath != self._dbpath or os.stat(dbpath).st_ino != self._inode:
+                    self._close()
+                    self._conn, self._inode = LibraryWatcher._connect(dbpath)
+                    self._dbpath = dbpath
+                current = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            except (OSError, sqlite3.Error) as ex:
+                # an unknown state counts as change
+                log.debug("Library database version could not be read: %s", ex)
+                self._close()
+                self.version += 1
+                return self.version
+            if current != self._data_version:
+                self._data_version = current
+                self.version += 1
+            return self.version
+
+    def _close(self):
+        if self._conn:
+            self._conn.close()
+        self._conn = None
+        self._data_version = None
+
+
+library_watcher = LibraryWatcher()
+database_version = DatabaseVersion()
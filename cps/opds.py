@@ -28,16 +28,13 @@ from functools import wraps
 from flask import Blueprint, request, render_template, Response, g, make_response, abort
 from flask_login import current_user
 from sqlalchemy.sql.expression import func, text, or_, and_, true
-from werkzeug.security import check_password_hash
 
-from . import constants, logger, config, db, calibre_db, ub, services, get_locale, isoLanguages
+from . import constants, logger, config, db, calibre_db, ub, services, category_cache
 from .helper import get_download_link, get_book_cover
-from .pagination import Pagination
+from .pagination import Pagination, KeysetPagination
 from .web import render_read_books
-from .usermanagement import load_user_from_request
+from .usermanagement import load_user_from_request, check_basic_auth_password
 from flask_babel import gettext as _
-from babel import Locale as LC
-from babel.core import UnknownLocaleError
 
 opds = Blueprint('opds', __name__)
 
@@ -97,6 +94,21 @@ def feed_normal_search():
     return feed_search(request.args.get("query", "").strip())
 
 
+# Books of acquisition feeds are paged by the sort column and the id, deep pages cost the same as the first one.
+# Offsets of links from older feeds are still served
+def fill_feed_page(db_filter, order_column, descending=False):
+    off = int(request.args.get("offset") or 0)
+    cursor = request.args.get("cursor")
+    if off and not cursor:
+        entries, __, pagination = calibre_db.fill_indexpage((off / (int(config.config_books_per_page)) + 1), 0,
+                                                            db.Books, db_filter,
+                                                            [order_column.desc() if descending else order_column])
+        return entries, pagination
+    entries, next_cursor, previous_cursor = calibre_db.fill_keyset_page(0, db_filter, order_column, descending,
+                                                                        cursor)
+    return entries, KeysetPagination(next_cursor, previous_cursor)
+
+
 @opds.route("/opds/books")
 @requires_basic_auth_if_no_ano
 def feed_booksindex():
@@ -125,12 +137,8 @@ def feed_booksindex():
 @opds.route("/opds/books/letter/<book_id>")
 @requires_basic_auth_if_no_ano
 def feed_letter_books(book_id):
-    off = request.args.get("offset") or 0
     letter = true() if book_id == "00" else func.upper(db.Books.sort).startswith(book_id)
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        letter,
-                                                        [db.Books.sort])
+    entries, pagination = fill_feed_page(letter, db.Books.sort)
 
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
@@ -138,9 +146,7 @@ def feed_letter_books(book_id):
 @opds.route("/opds/new")
 @requires_basic_auth_if_no_ano
 def feed_new():
-    off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books, True, [db.Books.timestamp.desc()])
+    entries, pagination = fill_feed_page(True, db.Books.timestamp, True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -156,10 +162,7 @@ def feed_discover():
 @opds.route("/opds/rated")
 @requires_basic_auth_if_no_ano
 def feed_best_rated():
-    off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books, db.Books.ratings.any(db.Ratings.rating > 9),
-                                                        [db.Books.timestamp.desc()])
+    entries, pagination = fill_feed_page(db.Books.ratings.any(db.Ratings.rating > 9), db.Books.timestamp, True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -167,19 +170,7 @@ def feed_best_rated():
 @requires_basic_auth_if_no_ano
 def feed_hot():
     off = request.args.get("offset") or 0
-    all_books = ub.session.query(ub.Downloads, func.count(ub.Downloads.book_id)).order_by(
-        func.count(ub.Downloads.book_id).desc()).group_by(ub.Downloads.book_id)
-    hot_books = all_books.offset(off).limit(config.config_books_per_page)
-    entries = list()
-    for book in hot_books:
-        downloadBook = calibre_db.get_book(book.Downloads.book_id)
-        if downloadBook:
-            entries.append(
-                calibre_db.get_filtered_book(book.Downloads.book_id)
-            )
-        else:
-            ub.delete_download(book.Downloads.book_id)
-    numBooks = entries.__len__()
+    entries, numBooks = calibre_db.get_hot_books(int(off), config.config_books_per_page)
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1),
                             config.config_books_per_page, numBooks)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
@@ -190,9 +181,7 @@ def feed_hot():
 def feed_authorindex():
     shift = 0
     off = int(request.args.get("offset") or 0)
-    entries = calibre_db.session.query(func.upper(func.substr(db.Authors.sort, 1, 1)).label('id'))\
-        .join(db.books_authors_link).join(db.Books).filter(calibre_db.common_filters())\
-        .group_by(func.upper(func.substr(db.Authors.sort, 1, 1))).all()
+    entries = category_cache.letters('author')
 
     elements = []
     if off == 0:
@@ -201,7 +190,7 @@ def feed_authorindex():
     for entry in entries[
                  off + shift - 1:
                  int(off + int(config.config_books_per_page) - shift)]:
-        elements.append({'id': entry.id, 'name': entry.id})
+        elements.append({'id': entry.char, 'name': entry.char})
 
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
                             len(entries) + 1)
@@ -229,11 +218,7 @@ def feed_letter_author(book_id):
 @opds.route("/opds/author/<int:book_id>")
 @requires_basic_auth_if_no_ano
 def feed_author(book_id):
-    off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.authors.any(db.Authors.id == book_id),
-                                                        [db.Books.timestamp.desc()])
+    entries, pagination = fill_feed_page(db.Books.authors.any(db.Authors.id == book_id), db.Books.timestamp, True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -255,11 +240,7 @@ def feed_publisherindex():
 @opds.route("/opds/publisher/<int:book_id>")
 @requires_basic_auth_if_no_ano
 def feed_publisher(book_id):
-    off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.publishers.any(db.Publishers.id == book_id),
-                                                        [db.Books.timestamp.desc()])
+    entries, pagination = fill_feed_page(db.Books.publishers.any(db.Publishers.id == book_id), db.Books.timestamp, True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -268,9 +249,7 @@ def feed_publisher(book_id):
 def feed_categoryindex():
     shift = 0
     off = int(request.args.get("offset") or 0)
-    entries = calibre_db.session.query(func.upper(func.substr(db.Tags.name, 1, 1)).label('id'))\
-        .join(db.books_tags_link).join(db.Books).filter(calibre_db.common_filters())\
-        .group_by(func.upper(func.substr(db.Tags.name, 1, 1))).all()
+    entries = category_cache.letters('category')
     elements = []
     if off == 0:
         elements.append({'id': "00", 'name':_("All")})
@@ -278,7 +257,7 @@ def feed_categoryindex():
     for entry in entries[
                  off + shift - 1:
                  int(off + int(config.config_books_per_page) - shift)]:
-        elements.append({'id': entry.id, 'name': entry.id})
+        elements.append({'id': entry.char, 'name': entry.char})
 
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
                             len(entries) + 1)
@@ -307,11 +286,7 @@ def feed_letter_category(book_id):
 @opds.route("/opds/category/<int:book_id>")
 @requires_basic_auth_if_no_ano
 def feed_category(book_id):
-    off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.tags.any(db.Tags.id == book_id),
-                                                        [db.Books.timestamp.desc()])
+    entries, pagination = fill_feed_page(db.Books.tags.any(db.Tags.id == book_id), db.Books.timestamp, True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -320,9 +295,7 @@ def feed_category(book_id):
 def feed_seriesindex():
     shift = 0
     off = int(request.args.get("offset") or 0)
-    entries = calibre_db.session.query(func.upper(func.substr(db.Series.sort, 1, 1)).label('id'))\
-        .join(db.books_series_link).join(db.Books).filter(calibre_db.common_filters())\
-        .group_by(func.upper(func.substr(db.Series.sort, 1, 1))).all()
+    entries = category_cache.letters('series')
     elements = []
     if off == 0:
         elements.append({'id': "00", 'name':_("All")})
@@ -330,7 +303,7 @@ def feed_seriesindex():
     for entry in entries[
                  off + shift - 1:
                  int(off + int(config.config_books_per_page) - shift)]:
-        elements.append({'id': entry.id, 'name': entry.id})
+        elements.append({'id': entry.char, 'name': entry.char})
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
                             len(entries) + 1)
     return render_xml_template('feed.xml',
@@ -358,11 +331,7 @@ def feed_letter_series(book_id):
 @opds.route("/opds/series/<int:book_id>")
 @requires_basic_auth_if_no_ano
 def feed_series(book_id):
-    off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.series.any(db.Series.id == book_id),
-                                                        [db.Books.series_index])
+    entries, pagination = fill_feed_page(db.Books.series.any(db.Series.id == book_id), db.Books.series_index)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -370,14 +339,7 @@ def feed_series(book_id):
 @requires_basic_auth_if_no_ano
 def feed_ratingindex():
     off = request.args.get("offset") or 0
-    entries = calibre_db.session.query(db.Ratings, func.count('books_ratings_link.book').label('count'),
-                               (db.Ratings.rating / 2).label('name')) \
-        .join(db.books_ratings_link)\
-        .join(db.Books)\
-        .filter(calibre_db.common_filters()) \
-        .group_by(text('books_ratings_link.rating'))\
-        .order_by(db.Ratings.rating).all()
-
+    entries = category_cache.ratings(False)
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
                             len(entries))
     element = list()
@@ -389,11 +351,7 @@ def feed_ratingindex():
 @opds.route("/opds/ratings/<book_id>")
 @requires_basic_auth_if_no_ano
 def feed_ratings(book_id):
-    off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.ratings.any(db.Ratings.id == book_id),
-                                                        [db.Books.timestamp.desc()])
+    entries, pagination = fill_feed_page(db.Books.ratings.any(db.Ratings.id == book_id), db.Books.timestamp, True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -401,10 +359,7 @@ def feed_ratings(book_id):
 @requires_basic_auth_if_no_ano
 def feed_formatindex():
     off = request.args.get("offset") or 0
-    entries = calibre_db.session.query(db.Data).join(db.Books)\
-        .filter(calibre_db.common_filters()) \
-        .group_by(db.Data.format)\
-        .order_by(db.Data.format).all()
+    entries = category_cache.formats(False)
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
                             len(entries))
 
@@ -417,11 +372,7 @@ def feed_formatindex():
 @opds.route("/opds/formats/<book_id>")
 @requires_basic_auth_if_no_ano
 def feed_format(book_id):
-    off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.data.any(db.Data.format == book_id.upper()),
-                                                        [db.Books.timestamp.desc()])
+    entries, pagination = fill_feed_page(db.Books.data.any(db.Data.format == book_id.upper()), db.Books.timestamp, True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -430,19 +381,7 @@ def feed_format(book_id):
 @requires_basic_auth_if_no_ano
 def feed_languagesindex():
     off = request.args.get("offset") or 0
-    if current_user.filter_language() == u"all":
-        languages = calibre_db.speaking_language()
-    else:
-        try:
-            cur_l = LC.parse(current_user.filter_language())
-        except UnknownLocaleError:
-            cur_l = None
-        languages = calibre_db.session.query(db.Languages).filter(
-            db.Languages.lang_code == current_user.filter_language()).all()
-        if cur_l:
-            languages[0].name = cur_l.get_language_name(get_locale())
-        else:
-            languages[0].name = _(isoLanguages.get(part3=languages[0].lang_code).name)
+    languages = category_cache.languages()[0]
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
                             len(languages))
     return render_xml_template('feed.xml', listelements=languages, folder='opds.feed_languages', pagination=pagination)
@@ -451,11 +390,7 @@ def feed_languagesindex():
 @opds.route("/opds/language/<int:book_id>")
 @requires_basic_auth_if_no_ano
 def feed_languages(book_id):
-    off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.languages.any(db.Languages.id == book_id),
-                                                        [db.Books.timestamp.desc()])
+    entries, pagination = fill_feed_page(db.Books.languages.any(db.Languages.id == book_id), db.Books.timestamp, True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -543,7 +478,7 @@ def check_auth(username, password):
             username = username.encode('utf-8')
     user = ub.session.query(ub.User).filter(func.lower(ub.User.name) ==
                                             username.decode('utf-8').lower()).first()
-    if bool(user and check_password_hash(str(user.password), password)):
+    if bool(user and check_basic_auth_password(user, password)):
         return True
     else:
         ip_Address = request.headers.get('X-Forwarded-For', request.remote_addr)
@@ -567,9 +502,14 @@ def render_xml_template(*args, **kwargs):
     return response
 
 
-@opds.route("/opds/thumb_240_240/<book_id>")
-@opds.route("/opds/cover_240_240/<book_id>")
-@opds.route("/opds/cover_90_90/<book_id>")
+@opds.route("/opds/thumb_240_240/<book_id>", defaults={'width': 240, 'height': 240})
+@opds.route("/opds/cover_240_240/<book_id>", defaults={'width': 240, 'height': 240})
+@opds.route("/opds/cover_90_90/<book_id>", defaults={'width': 90, 'height': 90})
+@requires_basic_auth_if_no_ano
+def feed_get_cover_thumbnail(book_id, width, height):
+    return get_book_cover(book_id, (width, height))
+
+
 @opds.route("/opds/cover/<book_id>")
 @requires_basic_auth_if_no_ano
 def feed_get_cover(book_id):
@@ -74,3 +74,19 @@ class Pagination(object):
                     yield None
                 yield num
                 last = num
+
+
+# Pagination of keyset pages, instead of offsets the next and the previous page are addressed by the cursors of the
+# last and the first entry
+class KeysetPagination(object):
+    def __init__(self, next_cursor, previous_cursor=None):
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.previous_cursor is not None
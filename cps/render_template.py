@@ -22,7 +22,7 @@ from flask import g
 from werkzeug.local import LocalProxy
 from flask_login import current_user
 
-from . import config, constants, ub, logger, db, calibre_db
+from . import config, constants, ub, logger, db, calibre_db, user_cache, get_locale
 from .ub import User
 
 
@@ -35,6 +35,13 @@ def get_sidebar_config(kwargs=None):
         content = isinstance(content, (User, LocalProxy)) and not content.role_anonymous()
     else:
         content = 'conf' in kwargs
+    # the entries only depend on the locale and a few properties of the user
+    key = ('sidebar', str(get_locale()), current_user.role_admin(), g.user.is_anonymous,
+           g.user.filter_language() == 'all', content)
+    return user_cache.cached(key, None, lambda: _build_sidebar(content))
+
+
+def _build_sidebar(content):
     sidebar = list()
     sidebar.append({"glyph": "glyphicon-book", "text": _('Books'), "link": 'web.index', "id": "new",
                     "visibility": constants.SIDEBAR_RECENT, 'public': True, "page": "root",
@@ -100,19 +107,30 @@ def get_sidebar_config(kwargs=None):
 
     return sidebar
 
+def _read_book_ids(user_id):
+    return frozenset(book_id for book_id, in ub.session.query(ub.ReadBook.book_id)
+                     .filter(ub.ReadBook.user_id == user_id)
+                     .filter(ub.ReadBook.read_status == ub.ReadBook.STATUS_FINISHED))
+
+
+def _read_column_ids(read_column):
+    try:
+        return frozenset(book_id for book_id, in calibre_db.session.query(db.cc_classes[read_column].book)
+                         .filter(db.cc_classes[read_column].value == True))
+    except (KeyError, AttributeError):
+        log.error("Custom Column No.%d is not existing in calibre database", read_column)
+        return frozenset()
+
+
+# Ids of the books read by the current user, cached until the read status or the library changes
 def get_readbooks_ids():
     if not config.config_read_column:
-        readBooks = ub.session.query(ub.ReadBook).filter(ub.ReadBook.user_id == int(current_user.id))\
-            .filter(ub.ReadBook.read_status == ub.ReadBook.STATUS_FINISHED).all()
-        return frozenset([x.book_id for x in readBooks])
-    else:
-        try:
-            readBooks = calibre_db.session.query(db.cc_classes[config.config_read_column])\
-                .filter(db.cc_classes[config.config_read_column].value == True).all()
-            return frozenset([x.book for x in readBooks])
-        except (KeyError, AttributeError):
-            log.error("Custom Column No.%d is not existing in calibre database", config.config_read_column)
-            return []
+        user_id = int(current_user.id)
+        return user_cache.cached((user_cache.READ_BOOKS, user_id), user_cache.version(user_cache.READ_BOOKS),
+                                 lambda: _read_book_ids(user_id))
+    read_column = config.config_read_column
+    return user_cache.cached((user_cache.READ_BOOKS, 'column', read_column), calibre_db.library_stamp(),
+                             lambda: _read_column_ids(read_column))
 
 # Returns the template for rendering and includes the instance name
 def render_title_template(*args, **kwargs):
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Ordered book ids of recent search results. Paging through the results only loads the books of the page, the
+# search itself runs once per query, user visibility and library version
+from __future__ import division, print_function, unicode_literals
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# number of cached results and seconds a result is kept
+MAX_ENTRIES = 64
+TTL = 600
+# rows fetched at once while reading the ids of the results
+FETCH_SIZE = 1000
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+
+
+def ordered_ids(query):
+    """Returns the distinct ids of the rows of query (selecting book ids) in the order of the first occurrence"""
+    return array('I', OrderedDict.fromkeys(book_id for book_id, in query.yield_per(FETCH_SIZE)))
+
+
+def get(key, build):
+    """Returns the cached ids for key, or the ids returned by build(), which are cached afterwards"""
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry and entry[0] > now:
+            _entries.move_to_end(key)
+            return entry[1]
+    ids = build()
+    with _lock:
+        _entries[key] = (now + TTL, ids)
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+    return ids
+
+
+def clear():
+    with _lock:
+        _entries.clear()
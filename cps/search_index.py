@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function, unicode_literals
+import os
+import re
+import sqlite3
+import threading
+
+from sqlalchemy import Table, Column, MetaData, Integer, Float, String
+from sqlalchemy.sql.expression import select
+
+from . import logger, search_cache
+
+try:
+    import unidecode
+    use_unidecode = True
+except ImportError:
+    use_unidecode = False
+
+log = logger.create()
+
+INDEX_FILE = "search_index.db"
+INDEX_COLUMNS = ('title', 'authors', 'tags', 'series', 'publishers', 'comments')
+# columns of the simple search, comments are only searched by the advanced search
+SEARCH_COLUMNS = ('title', 'authors', 'tags', 'series', 'publishers')
+# number of book ids updated with one statement
+CHUNK_SIZE = 500
+
+# The fts5 table as seen from the calibre database connection, where the index is attached as search_index
+book_fts = Table('book_fts', MetaData(),
+                 Column('rowid', Integer),
+                 Column('rank', Float),
+                 Column('book_fts', String),
+                 schema='search_index'
+                 )
+
+_INSERT_BOOKS = """INSERT INTO book_fts(rowid, title, authors, tags, series, publishers, comments)
+SELECT b.id, normalize(b.title),
+    normalize((SELECT group_concat(a.name, ' ') FROM calibre.books_authors_link AS l
+               JOIN calibre.authors AS a ON a.id = l.author WHERE l.book = b.id)),
+    normalize((SELECT group_concat(t.name, ' ') FROM calibre.books_tags_link AS l
+               JOIN calibre.tags AS t ON t.id = l.tag WHERE l.book = b.id)),
+    normalize((SELECT group_concat(s.name, ' ') FROM calibre.books_series_link AS l
+               JOIN calibre.series AS s ON s.id = l.series WHERE l.book = b.id)),
+    normalize((SELECT group_concat(p.name, ' ') FROM calibre.books_publishers_link AS l
+               JOIN calibre.publishers AS p ON p.id = l.publisher WHERE l.book = b.id)),
+    normalize_html((SELECT c.text FROM calibre.comments AS c WHERE c.book = b.id))
+FROM calibre.books AS b WHERE b.id IN ({})"""
+
+
+# Same normalisation as the lcase function used for the ilike searches in the calibre database
+def normalize(text):
+    if text is None:
+        return ""
+    try:
+        return unidecode.unidecode(text.lower()) if use_unidecode else text.lower()
+    except Exception as ex:
+        log.debug_or_exception(ex)
+        return text.lower()
+
+
+def normalize_html(text):
+    return normalize(re.sub(r'<[^>]*>', ' ', text or ""))
+
+
+def _chunks(elements):
+    elements = list(elements)
+    for i in range(0, len(elements), CHUNK_SIZE):
+        yield elements[i:i + CHUNK_SIZE]
+
+
+class SearchIndex(object):
+    """Full text index of the calibre library in a sqlite database next to app.db"""
+
+    def __init__(self):
+        self.path = None
+        self.metadata_path = None
+        self.ready = False
+        self.library_stamp = None
+        self._lock = threading.Lock()
+        self._builder = None
+
+    def setup(self, app_db_path, metadata_path):
+        self.path = os.path.join(os.path.dirname(os.path.abspath(app_db_path)), INDEX_FILE)
+        self.metadata_path = metadata_path
+        self.ready = False
+        self.library_stamp = None
+        try:
+            conn = sqlite3.connect(self.path)
+            try:
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5({}, "
+                             "tokenize='unicode61 remove_diacritics 2')".format(', '.join(INDEX_COLUMNS)))
+                conn.execute("CREATE TABLE IF NOT EXISTS index_state (key TEXT PRIMARY KEY, value TEXT)")
+                conn.commit()
+                # index belongs to another library, it's rebuild on first use
+                self.ready = self._get_state(conn, 'library') == self.metadata_path
+            finally:
+                conn.close()
+        except sqlite3.Error as ex:
+            log.error("Search index could not be created, fts5 is possibly not supported: %s", ex)
+            self.path = None
+            return False
+        return True
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.create_function("normalize", 1, normalize)
+        conn.create_function("normalize_html", 1, normalize_html)
+        conn.execute("attach database ? as calibre", (self.metadata_path,))
+        return conn
+
+    @staticmethod
+    def _get_state(conn, key):
+        result = conn.execute("SELECT value FROM index_state WHERE key = ?", (key,)).fetchone()
+        return result[0] if result else None
+
+    @staticmethod
+    def _set_state(conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO index_state (key, value) VALUES (?, ?)", (key, value))
+
+    def _update(self):
+        conn = self._connect()
+        try:
+            if self._get_state(conn, 'library') != self.metadata_path:
+                conn.execute("DELETE FROM book_fts")
+                self._set_state(conn, 'last_modified', '')
+            watermark = self._get_state(conn, 'last_modified') or ''
+            # books changed at the watermark time are indexed again, timestamps of calibre and Calibre-Web differ in
+            # their precision
+            changed = set(r[0] for r in conn.execute("SELECT id FROM calibre.books WHERE last_modified >= ?",
+                                                     (watermark,)))
+            indexed = set(r[0] for r in conn.execute("SELECT rowid FROM book_fts"))
+            existing = set(r[0] for r in conn.execute("SELECT id FROM calibre.books"))
+            outdated = (indexed - existing) | (changed & indexed)
+            for chunk in _chunks(outdated):
+                conn.execute("DELETE FROM book_fts WHERE rowid IN ({})".format(','.join('?' * len(chunk))), chunk)
+            for chunk in _chunks((existing - indexed) | changed):
+                conn.execute(_INSERT_BOOKS.format(','.join('?' * len(chunk))), chunk)
+            max_modified = conn.execute("SELECT max(last_modified) FROM calibre.books").fetchone()[0]
+            self._set_state(conn, 'last_modified', max_modified or '')
+            self._set_state(conn, 'library', self.metadata_path)
+            conn.commit()
+            log.debug("Search index updated, %d books removed, %d books (re)indexed",
+                      len(indexed - existing), len((existing - indexed) | changed))
+        finally:
+            conn.close()
+
+    def _build(self, library_stamp):
+        try:
+            with self._lock:
+                self._update()
+                self.library_stamp = library_stamp
+                # results found with the outdated index were cached for the current library version
+                search_cache.clear()
+                if not self.ready:
+                    self.ready = True
+                    log.info("Search index for %s built", self.metadata_path)
+        except sqlite3.Error as ex:
+            log.error("Search index could not be built: %s", ex)
+
+    def _start_builder(self, library_stamp):
+        if not self._builder or not self._builder.is_alive():
+            self._builder = threading.Thread(target=self._build, args=(library_stamp,), name="SearchIndex")
+            self._builder.daemon = True
+            self._builder.start()
+
+    def refresh(self, library_stamp):
+        """Brings the index up to date with the library, library_stamp changes whenever the library changed.
+        Returns if the index can be used for searching. The index is built and updated in the background, till an
+        update is finished the index of the previous state of the library is used"""
+        if not self.path:
+            return False
+        if not self.ready or library_stamp != self.library_stamp:
+            self._start_builder(library_stamp)
+        return self.ready
+
+    @staticmethod
+    def match_expression(term, column=None):
+        """Converts a search term to a fts5 query matching all words of the term as prefix in the column, or in the
+        columns of the simple search"""
+        words = re.findall(r'\w+', normalize(term), re.UNICODE)
+        columns = column or '{{{}}}'.format(' '.join(SEARCH_COLUMNS))
+        return ' AND '.join(u'{} : "{}"*'.format(columns, word) for word in words)
+
+    @staticmethod
+    def matches(expression):
+        """Subquery returning the ids and the rank of all books matching the fts5 expression"""
+        return select([book_fts.c.rowid, book_fts.c.rank]) \
+            .where(book_fts.c.book_fts.match(expression)) \
+            .alias('fts_matches')
+
+
+search_index = SearchIndex()
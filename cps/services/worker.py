@@ -3,7 +3,6 @@ from __future__ import division, print_function, unicode_literals
 import threading
 import abc
 import uuid
-import time
 
 try:
     import queue
@@ -12,7 +11,7 @@ except ImportError:
 from datetime import datetime
 from collections import namedtuple
 
-from cps import logger
+from cps import logger, ub, db
 
 log = logger.create()
 
@@ -21,10 +20,19 @@ STAT_WAITING = 0
 STAT_FAIL = 1
 STAT_STARTED = 2
 STAT_FINISH_SUCCESS = 3
+STAT_CANCELLED = 4
 
 # Only retain this many tasks in dequeued list
 TASK_CLEANUP_TRIGGER = 20
 
+# Tasks are executed in lanes, each lane has its own queue and workers, so long running conversions don't block
+# sending e-mails
+LANE_DEFAULT = 'default'
+LANE_CONVERT = 'convert'
+LANE_EMAIL = 'email'
+# lane for tasks working through many books, e.g. converting the whole library
+LANE_BULK = 'bulk'
+
 QueuedTask = namedtuple('QueuedTask', 'num, user, added, task')
 
 
@@ -36,18 +44,20 @@ def _get_main_thread():
 
 
 
-class ImprovedQueue(queue.Queue):
+class ImprovedQueue(queue.PriorityQueue):
     def to_list(self):
         """
         Returns a copy of all items in the queue without removing them.
         """
 
         with self.mutex:
-            return list(self.queue)
+            return [item[-1] for item in self.queue]
 
 # Class for all worker tasks in the background
-class WorkerThread(threading.Thread):
+class WorkerThread(object):
     _instance = None
+    # number of tasks executed in parallel per lane, lanes not listed here have one worker
+    lane_workers = {LANE_DEFAULT: 1, LANE_CONVERT: 1, LANE_EMAIL: 1}
 
     @classmethod
     def getInstance(cls):
@@ -56,33 +66,68 @@ class WorkerThread(threading.Thread):
         return cls._instance
 
     def __init__(self):
-        threading.Thread.__init__(self)
-
         self.dequeued = list()
 
         self.doLock = threading.Lock()
-        self.queue = ImprovedQueue()
+        self.queues = dict()
+        self.workers = dict()
         self.num = 0
-        self.start()
+        self.main_thread = _get_main_thread()
 
     @classmethod
     def add(cls, user, task):
         ins = cls.getInstance()
-        ins.num += 1
+        with ins.doLock:
+            ins.num += 1
+            num = ins.num
+            lane_queue = ins._get_lane(task.lane)
         log.debug("Add Task for user: {}: {}".format(user, task))
-        ins.queue.put(QueuedTask(
-            num=ins.num,
+        # lower priorities are executed first, tasks of the same priority in the order they were added
+        lane_queue.put((task.priority, num, QueuedTask(
+            num=num,
             user=user,
             added=datetime.now(),
             task=task,
-        ))
+        )))
+
+    # returns the queue of the lane and starts the workers of the lane on first use, needs doLock
+    def _get_lane(self, lane):
+        if lane not in self.queues:
+            self.queues[lane] = ImprovedQueue()
+            self.workers[lane] = list()
+        self._start_workers(lane)
+        return self.queues[lane]
+
+    def _start_workers(self, lane):
+        workers = self.workers[lane]
+        workers[:] = [worker for worker in workers if worker.is_alive()]
+        for index in range(len(workers), self.lane_workers.get(lane, 1)):
+            worker = threading.Thread(target=self.run, args=(lane, index), name="Worker-{}-{}".format(lane, index))
+            worker.start()
+            workers.append(worker)
+
+    @classmethod
+    def set_workers(cls, lane, count):
+        """Changes the number of parallel tasks of a lane, surplus workers stop after their current task"""
+        cls.lane_workers[lane] = max(1, count)
+        if cls._instance is not None:
+            with cls._instance.doLock:
+                if lane in cls._instance.queues:
+                    cls._instance._start_workers(lane)
 
     @property
     def tasks(self):
         with self.doLock:
-            tasks = self.queue.to_list() + self.dequeued
+            tasks = [task for lane_queue in self.queues.values() for task in lane_queue.to_list()] + self.dequeued
             return sorted(tasks, key=lambda x: x.num)
 
+    def cancel(self, task_id, user=None):
+        """Cancels the task with the given id, if user is given only tasks of this user are cancelled"""
+        for queued in self.tasks:
+            if str(queued.task.id) == str(task_id) and (user is None or queued.user == user):
+                return queued.task.cancel()
+        return False
+
     def cleanup_tasks(self):
         with self.doLock:
             dead = []
@@ -100,19 +145,18 @@ class WorkerThread(threading.Thread):
 
             self.dequeued = sorted(ret, key=lambda x: x.num)
 
-    # Main thread loop starting the different tasks
-    def run(self):
-        main_thread = _get_main_thread()
-        while main_thread.is_alive():
+    # Worker loop of one lane starting the different tasks
+    def run(self, lane, index):
+        lane_queue = self.queues[lane]
+        while self.main_thread.is_alive() and index < self.lane_workers.get(lane, 1):
             try:
                 # this blocks until something is available. This can cause issues when the main thread dies - this
                 # thread will remain alive. We implement a timeout to unblock every second which allows us to check if
                 # the main thread is still alive.
                 # We don't use a daemon here because we don't want the tasks to just be abruptly halted, leading to
                 # possible file / database corruption
-                item = self.queue.get(timeout=1)
+                item = lane_queue.get(timeout=1)[-1]
             except queue.Empty:
-                time.sleep(1)
                 continue
 
             with self.doLock:
@@ -123,16 +167,23 @@ class WorkerThread(threading.Thread):
             if len(self.dequeued) > TASK_CLEANUP_TRIGGER:
                 self.cleanup_tasks()
 
-            # sometimes tasks (like Upload) don't actually have work to do and are created as already finished
+            # sometimes tasks (like Upload) don't actually have work to do and are created as already finished,
+            # cancelled tasks are skipped
             if item.task.stat is STAT_WAITING:
                 # CalibreTask.start() should wrap all exceptions in it's own error handling
                 item.task.start(self)
+                # sessions the task used from this thread return their connections to the pools
+                db.CalibreDB.remove_session()
+                ub.remove_session()
 
-            self.queue.task_done()
+            lane_queue.task_done()
 
 
 class CalibreTask:
     __metaclass__ = abc.ABCMeta
+    # lane the task is executed in and priority within the lane, lower priorities are executed first
+    lane = LANE_DEFAULT
+    priority = 0
 
     def __init__(self, message):
         self._progress = 0
@@ -142,6 +193,7 @@ class CalibreTask:
         self.end_time = None
         self.message = message
         self.id = uuid.uuid4()
+        self.cancelled = False
 
     @abc.abstractmethod
     def run(self, worker_thread):
@@ -154,6 +206,8 @@ class CalibreTask:
         raise NotImplementedError
 
     def start(self, *args):
+        if self.cancelled:
+            return
         self.start_time = datetime.now()
         self.stat = STAT_STARTED
 
@@ -164,6 +218,9 @@ class CalibreTask:
             self._handleError(str(ex))
             log.debug_or_exception(ex)
 
+        # the task stopped or failed after being cancelled
+        if self.cancelled and self.stat in (STAT_STARTED, STAT_FAIL):
+            self._handleCancel()
         self.end_time = datetime.now()
 
     @property
@@ -203,7 +260,20 @@ class CalibreTask:
         We have a separate dictating this because there may be certain tasks that want to override this
         """
         # By default, we're good to clean a task if it's "Done"
-        return self.stat in (STAT_FINISH_SUCCESS, STAT_FAIL)
+        return self.stat in (STAT_FINISH_SUCCESS, STAT_FAIL, STAT_CANCELLED)
+
+    @property
+    def cancellable(self):
+        return self.stat in (STAT_WAITING, STAT_STARTED) and not self.cancelled
+
+    def cancel(self):
+        """Cancels a waiting task, running tasks are asked to stop by the cancelled flag which they have to check"""
+        if not self.cancellable:
+            return False
+        self.cancelled = True
+        if self.stat == STAT_WAITING:
+            self._handleCancel()
+        return True
 
     @progress.setter
     def progress(self, x):
@@ -218,3 +288,9 @@ class CalibreTask:
     def _handleSuccess(self):
         self.stat = STAT_FINISH_SUCCESS
         self.progress = 1
+
+    def _handleCancel(self):
+        self.stat = STAT_CANCELLED
+        self.end_time = datetime.now()
+        if not self.start_time:
+            self.start_time = self.end_time
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function, unicode_literals
+import os
+import shutil
+import hashlib
+import tempfile
+
+from flask import Request
+
+from . import logger
+
+log = logger.create()
+
+HASH_ALGORITHM = 'sha256'
+
+
+# Uploads are staged in the configured directory, if it's on the file system of the library the staged file is
+# renamed into the library instead of being copied. Without one the temp dir is used
+def staging_dir():
+    from . import config
+    if config.config_staging_dir and os.path.isdir(config.config_staging_dir):
+        return config.config_staging_dir
+    tmp_dir = os.path.join(tempfile.gettempdir(), 'calibre_web')
+    if not os.path.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+class StagedFile(object):
+    """Uniquely named file in the staging directory, the content hash is calculated while the file is written"""
+
+    def __init__(self, suffix=''):
+        fd, self.name = tempfile.mkstemp(prefix='upload-', suffix=suffix, dir=staging_dir())
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.new(HASH_ALGORITHM)
+        self.size = 0
+        self.claimed = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    @property
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def claim(self):
+        """Closes the file and takes it over, it's no longer removed at the end of the request"""
+        self._file.close()
+        self.claimed = True
+        return self.name
+
+    def discard(self):
+        self._file.close()
+        if not self.claimed:
+            try:
+                os.remove(self.name)
+            except OSError:
+                pass
+
+
+class UploadRequest(Request):
+    # uploaded files are written to the staging directory while the request is parsed, instead of to an anonymous
+    # temp file which has to be copied again afterwards
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename:
+            return StagedFile(os.path.splitext(filename)[1].lower())
+        return super(UploadRequest, self)._get_file_stream(total_content_length, content_type, filename,
+                                                           content_length)
+
+    def close(self):
+        files = self.__dict__.get("files")
+        super(UploadRequest, self).close()
+        for _key, value in (files.items(multi=True) if files else ()):
+            if isinstance(value.stream, StagedFile):
+                value.stream.discard()
+
+
+def stage(uploadfile):
+    """Returns the path and the content hash of the uploaded file in the staging directory, the caller is
+    responsible for moving or deleting the file"""
+    if isinstance(uploadfile.stream, StagedFile):
+        return uploadfile.stream.claim(), uploadfile.stream.hexdigest
+    staged = StagedFile(os.path.splitext(uploadfile.filename)[1].lower())
+    try:
+        shutil.copyfileobj(uploadfile.stream, staged)
+    finally:
+        staged.claim()
+    return staged.name, staged.hexdigest
+
+
+def move(uploadfile, destination):
+    """Moves the uploaded file to its destination, returns the content hash"""
+    path, file_hash = stage(uploadfile)
+    try:
+        try:
+            # replaces an existing file also on windows
+            os.replace(path, destination)
+        except OSError:
+            shutil.move(path, destination)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return file_hash
@@ -16,7 +16,7 @@
 
 */
 /* global screenfull, bitjs, Uint8Array, opera, loadArchiveFormats, archiveOpenFile */
-/* exported init, event */
+/* exported init, initPages, event */
 
 
 if (window.opera) {
@@ -62,6 +62,9 @@ var currentImage = 0;
 var imageFiles = [];
 var imageFilenames = [];
 var totalImages = 0;
+var streamedPages = false;
+var prefetchCount = 0;
+var prefetched = [];
 
 var settings = {
     hflip: false,
@@ -246,6 +249,9 @@ function updatePage() {
 
     if (imageFiles[currentImage]) {
         setImage(imageFiles[currentImage].dataURI);
+        if (streamedPages) {
+            prefetchPages();
+        }
     } else {
         setImage("loading");
     }
@@ -547,6 +553,49 @@ function init(filename) {
         }
     });
     request.send();
+    initReader();
+}
+
+// Reads the comic page by page from the server instead of downloading and uncompressing the whole archive
+function initPages(pagesUrl) {
+    $.getJSON(pagesUrl, function(data) {
+        var ratio = window.devicePixelRatio || 1;
+        var size = "?width=" + Math.round(screen.width * ratio) + "&height=" + Math.round(screen.height * ratio);
+        streamedPages = true;
+        prefetchCount = data.prefetch;
+        totalImages = data.pages.length;
+        data.pages.forEach(function(name, i) {
+            var url = pagesUrl + "/" + i;
+            imageFilenames.push(name);
+            imageFiles.push({filename: name, dataURI: url + size});
+            $("#thumbnails").append(
+                "<li>" +
+                "<a data-page='" + (i + 1) + "'>" +
+                "<img loading='lazy' src='" + url + "?width=200'/>" +
+                "<span>" + (i + 1) + "</span>" +
+                "</a>" +
+                "</li>"
+            );
+        });
+        updateProgress(100);
+        updatePage();
+    }).fail(function() {
+        setImage("error");
+    });
+    initReader();
+}
+
+// Loads the next pages in the background, so they are already cached when turning the page
+function prefetchPages() {
+    prefetched = [];
+    for (var i = currentImage + 1; i <= currentImage + prefetchCount && i < imageFiles.length; i++) {
+        var img = new Image();
+        img.src = imageFiles[i].dataURI;
+        prefetched.push(img);
+    }
+}
+
+function initReader() {
     initProgressClick();
     document.body.className += /AppleWebKit/.test(navigator.userAgent) ? " webkit" : "";
     kthoom.loadSettings();
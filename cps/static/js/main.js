@@ -431,6 +431,38 @@ $(function() {
             }
         });
     });
+    $("#import_books").click(function() {
+        $("#DialogHeader").addClass("hidden");
+        $("#DialogFinished").addClass("hidden");
+        $("#DialogContent").html("");
+        $("#spinner2").show();
+        $.ajax({
+            type: "POST",
+            dataType: "json",
+            url: window.location.pathname + "/../../admin/import_books",
+            complete: function complete(xhr) {
+                $("#spinner2").hide();
+                $("#DialogContent").html(JSON.parse(xhr.responseText).text);
+                $("#DialogFinished").removeClass("hidden");
+            }
+        });
+    });
+    $("#convert_library").click(function() {
+        $("#DialogHeader").addClass("hidden");
+        $("#DialogFinished").addClass("hidden");
+        $("#DialogContent").html("");
+        $("#spinner2").show();
+        $.ajax({
+            type: "POST",
+            dataType: "json",
+            url: window.location.pathname + "/../../admin/convert_library",
+            complete: function complete(xhr) {
+                $("#spinner2").hide();
+                $("#DialogContent").html(JSON.parse(xhr.responseText).text);
+                $("#DialogFinished").removeClass("hidden");
+            }
+        });
+    });
     $("#perform_update").click(function() {
         $("#DialogHeader").removeClass("hidden");
         $("#spinner2").show();
@@ -20,6 +20,8 @@
 
 var selections = [];
 var reload = false;
+// the following page of the books table is requested with the cursor returned with the current page
+var nextPage = {};
 
 $(function() {
     $("#books-table").on("check.bs.table check-all.bs.table uncheck.bs.table uncheck-all.bs.table",
@@ -46,11 +48,15 @@ $(function() {
             if (selections.length < 1) {
                 $("#delete_selection").addClass("disabled");
                 $("#delete_selection").attr("aria-disabled", true);
+                $("#edit_selection").addClass("disabled");
+                $("#edit_selection").attr("aria-disabled", true);
                 $("#table_xchange").addClass("disabled");
                 $("#table_xchange").attr("aria-disabled", true);
             } else {
                 $("#delete_selection").removeClass("disabled");
                 $("#delete_selection").attr("aria-disabled", false);
+                $("#edit_selection").removeClass("disabled");
+                $("#edit_selection").attr("aria-disabled", false);
                 $("#table_xchange").removeClass("disabled");
                 $("#table_xchange").attr("aria-disabled", false);
 
@@ -91,6 +97,44 @@ $(function() {
         });
     });
 
+    $("#edit_selection").click(function() {
+        $("#edit_selected_value").val("");
+        $("#edit_selected_errors").empty();
+    });
+
+    $("#edit_selected_confirm").click(function() {
+        var changes = {};
+        changes[$("#edit_selected_param").val()] = $("#edit_selected_value").val();
+        $.ajax({
+            method:"post",
+            contentType: "application/json; charset=utf-8",
+            dataType: "json",
+            url: window.location.pathname + "/../../ajax/editselectedbooks",
+            data: JSON.stringify({
+                "ids": selections,
+                "changes": changes,
+                "checkA": $("#autoupdate_authorsort").prop("checked"),
+                "checkT": $("#autoupdate_titlesort").prop("checked")
+            }),
+            success: function success(result) {
+                $("#books-table").bootstrapTable("refresh");
+                $("#edit_selected_errors").empty();
+                if (result.success) {
+                    $("#editSelectedModal").modal("hide");
+                    return;
+                }
+                if (result.msg) {
+                    $("<div></div>").text(result.msg).appendTo("#edit_selected_errors");
+                }
+                $.each(result.books || [], function(i, book) {
+                    if (!book.success) {
+                        $("<div></div>").text(book.id + ": " + book.msg).appendTo("#edit_selected_errors");
+                    }
+                });
+            }
+        });
+    });
+
     $("#table_xchange").click(function() {
         $.ajax({
             method:"post",
@@ -589,6 +633,7 @@ function UserActions (value, row) {
 
 /* Function for keeping checked rows */
 function responseHandler(res) {
+    nextPage = {offset: res.nextOffset, cursor: res.nextCursor};
     $.each(res.rows, function (i, row) {
         row.state = $.inArray(row.id, selections) !== -1;
     });
@@ -825,6 +870,9 @@ function deleteUser(a,id){
 function queryParams(params)
 {
     params.state = JSON.stringify(selections);
+    if (nextPage.cursor && params.offset === nextPage.offset) {
+        params.cursor = nextPage.cursor;
+    }
     return params;
 }
 
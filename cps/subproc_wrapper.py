@@ -19,10 +19,40 @@
 from __future__ import division, print_function, unicode_literals
 import sys
 import os
+import re
+import time
+import shutil
+import locale
+import threading
 import subprocess
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-def process_open(command, quotes=(), env=None, sout=subprocess.PIPE, serr=subprocess.PIPE, newlines=True):
+try:
+    import selectors
+    use_selectors = os.name != 'nt'
+except ImportError:
+    use_selectors = False
+
+# waiting for output is interrupted at least this often (seconds) to check for cancelling and the timeout
+WAKEUP_INTERVAL = 1
+READ_SIZE = 4096
+
+
+class ProcessTimeout(Exception):
+    pass
+
+
+def _priority_options(nice):
+    if nice and os.name == 'nt':
+        return {'creationflags': getattr(subprocess, 'BELOW_NORMAL_PRIORITY_CLASS', 0)}
+    return {}
+
+
+def process_open(command, quotes=(), env=None, sout=subprocess.PIPE, serr=subprocess.PIPE, newlines=True, nice=0):
     # Linux py2.7 encode as list without quotes no empty element for parameters
     # linux py3.x no encode and as list without quotes no empty element for parameters
     # windows py2.7 encode as string with quotes empty element for parameters is okay
@@ -41,7 +71,8 @@ def process_open(command, quotes=(), env=None, sout=subprocess.PIPE, serr=subpro
         else:
             exc_command = [x for x in command]
 
-    return subprocess.Popen(exc_command, shell=False, stdout=sout, stderr=serr, universal_newlines=newlines, env=env) # nosec
+    return subprocess.Popen(exc_command, shell=False, stdout=sout, stderr=serr, universal_newlines=newlines, env=env,
+                            **_priority_options(nice))  # nosec
 
 
 def process_wait(command, serr=subprocess.PIPE):
@@ -53,3 +84,116 @@ def process_wait(command, serr=subprocess.PIPE):
         if isinstance(line, bytes):
             line = line.decode('utf-8')
         yield line
+
+
+# the cpu priority is lowered by the nice command, calling os.nice in the child process (preexec_fn) isn't safe in the
+# threaded server
+def _nice_command(command, nice):
+    nice_binary = shutil.which('nice') if nice and os.name != 'nt' and hasattr(shutil, 'which') else None
+    if nice_binary:
+        return [nice_binary, '-n', str(nice)] + command
+    return command
+
+
+# the io priority follows the cpu priority, nice levels 0-19 are mapped to the best effort levels 0-7
+def _ionice_command(command, nice):
+    ionice = shutil.which('ionice') if nice and os.name != 'nt' and hasattr(shutil, 'which') else None
+    if ionice:
+        return [ionice, '-c', '2', '-n', str(min(7, nice * 8 // 20))] + command
+    return command
+
+
+def _read_selectors(p, streams, wakeup):
+    # yields (stream, data) as soon as the process writes something, None if nothing was written till wakeup
+    with selectors.DefaultSelector() as selector:
+        for name, pipe in streams.items():
+            selector.register(pipe, selectors.EVENT_READ, name)
+        while selector.get_map():
+            events = selector.select(wakeup)
+            if not events:
+                yield None
+            for key, __ in events:
+                data = os.read(key.fd, READ_SIZE)
+                if not data:
+                    selector.unregister(key.fileobj)
+                yield key.data, data
+
+
+def _read_threads(p, streams, wakeup):
+    # pipes can't be selected on windows, they are read by one thread each
+    output = queue.Queue()
+
+    def reader(name, pipe):
+        for data in iter(lambda: pipe.read1(READ_SIZE), b''):
+            output.put((name, data))
+        output.put((name, b''))
+
+    for name, pipe in streams.items():
+        thread = threading.Thread(target=reader, args=(name, pipe))
+        thread.daemon = True
+        thread.start()
+    open_streams = len(streams)
+    while open_streams:
+        try:
+            item = output.get(timeout=wakeup)
+        except queue.Empty:
+            yield None
+            continue
+        if not item[1]:
+            open_streams -= 1
+        yield item
+
+
+def process_run(command, quotes=(), on_line=None, timeout=None, cancelled=None, nice=0, env=None):
+    """Runs the command without polling it, every line written to stdout or stderr is handed to
+    on_line(stream, line) as soon as it's complete. The process is killed when cancelled() returns True or when it
+    runs longer than timeout seconds, in the latter case ProcessTimeout is raised.
+    Returns the returncode and the lines written to stderr"""
+    encoding = locale.getpreferredencoding(False) or 'utf-8'
+    command = _ionice_command(_nice_command(list(command), nice), nice)
+    p = process_open(command, quotes, env=env, newlines=False, nice=nice)
+    deadline = time.time() + timeout if timeout else None
+    buffers = {'stdout': b'', 'stderr': b''}
+    errors = list()
+    timed_out = False
+    read = _read_selectors if use_selectors else _read_threads
+    try:
+        for event in read(p, {'stdout': p.stdout, 'stderr': p.stderr}, WAKEUP_INTERVAL):
+            if event:
+                name, data = event
+                # calibre overwrites its progress lines with carriage returns
+                lines = re.split(br'\r\n|\r|\n', buffers[name] + data)
+                buffers[name] = lines.pop() if data else b''
+                for line in lines:
+                    if not line:
+                        continue
+                    line = line.decode(encoding, 'replace')
+                    if name == 'stderr':
+                        errors.append(line)
+                    if on_line:
+                        on_line(name, line)
+            if cancelled and cancelled():
+                break
+            if deadline and time.time() > deadline:
+                timed_out = True
+                break
+        else:
+            # converters may close their output before they finished writing the converted file
+            while p.poll() is None and not (cancelled and cancelled()):
+                if deadline and time.time() > deadline:
+                    timed_out = True
+                    break
+                try:
+                    p.wait(WAKEUP_INTERVAL if not deadline else max(0, min(WAKEUP_INTERVAL, deadline - time.time())))
+                except subprocess.TimeoutExpired:
+                    pass
+    finally:
+        # only a cancelled or timed out process (or one of a failed reader) is still running here
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+        p.stdout.close()
+        p.stderr.close()
+    if timed_out:
+        raise ProcessTimeout(timeout)
+    return p.returncode, errors
@@ -1,17 +1,17 @@
 from __future__ import division, print_function, unicode_literals
-import sys
 import os
 import re
+import threading
 
 from glob import glob
 from shutil import copyfile
 
 from sqlalchemy.exc import SQLAlchemyError
 
-from cps.services.worker import CalibreTask
-from cps import db
-from cps import logger, config
-from cps.subproc_wrapper import process_open
+from cps.services.worker import CalibreTask, STAT_FAIL, STAT_FINISH_SUCCESS, LANE_CONVERT, LANE_BULK
+from cps import db, ub
+from cps import logger, config, file_hash
+from cps.subproc_wrapper import process_run, ProcessTimeout
 from flask_babel import gettext as _
 
 from cps.tasks.mail import TaskEmail
@@ -19,18 +19,90 @@ from cps import gdriveutils
 log = logger.create()
 
 
+# (book id, format) of the conversions waiting or running, so that a conversion is not queued twice
+# -> list of (user, e-mail address, mail settings) the converted book is sent to afterwards
+_pending_conversions = dict()
+_pending_lock = threading.Lock()
+
+
+# Marks a conversion as pending, returns False if it's already pending
+def reserve_conversion(book_id, book_format):
+    with _pending_lock:
+        if (book_id, book_format.upper()) in _pending_conversions:
+            return False
+        _pending_conversions[(book_id, book_format.upper())] = list()
+        return True
+
+
+# returns the e-mails waiting for the result of the conversion
+def release_conversion(book_id, book_format):
+    with _pending_lock:
+        return _pending_conversions.pop((book_id, book_format.upper()), [])
+
+
+# Sends the result of the pending conversion also to the e-mail address instead of converting the book again,
+# returns False if no conversion is pending
+def attach_mail(book_id, book_format, user, kindle_mail, settings):
+    with _pending_lock:
+        if (book_id, book_format.upper()) not in _pending_conversions:
+            return False
+        _pending_conversions[(book_id, book_format.upper())].append((user, kindle_mail, settings))
+        return True
+
+
+# Releases a conversion which didn't produce the book, the e-mails waiting for it are not sent
+def release_failed_conversion(book_id, book_format, reason):
+    for __, kindle_mail, __ in release_conversion(book_id, book_format):
+        log.error("Book id %d not sent to %s, %s", book_id, kindle_mail, reason)
+
+
+def conversion_pending(book_id, book_format):
+    return (book_id, book_format.upper()) in _pending_conversions
+
+
 class TaskConvert(CalibreTask):
-    def __init__(self, file_path, bookid, taskMessage, settings, kindle_mail, user=None):
+    lane = LANE_CONVERT
+
+    def __init__(self, file_path, bookid, taskMessage, settings, kindle_mail, user=None, reserved=False):
         super(TaskConvert, self).__init__(taskMessage)
         self.file_path = file_path
         self.bookid = bookid
         self.settings = settings
         self.kindle_mail = kindle_mail
         self.user = user
+        # the conversion was reserved by the creator of the task and is released after running
+        self.reserved = reserved
 
         self.results = dict()
 
     def run(self, worker_thread):
+        try:
+            return self._run(worker_thread)
+        finally:
+            if self.reserved:
+                for user, kindle_mail, settings in release_conversion(self.bookid, self.settings['new_book_format']):
+                    if self.stat == STAT_FINISH_SUCCESS and self.results.get('filename'):
+                        self._send_result(worker_thread, user, kindle_mail, settings)
+                    else:
+                        log.error("Book id %d not sent to %s, conversion failed", self.bookid, kindle_mail)
+
+    # a task cancelled while waiting never runs, its reservation is released here
+    def _handleCancel(self):
+        super(TaskConvert, self)._handleCancel()
+        if self.reserved:
+            release_failed_conversion(self.bookid, self.settings['new_book_format'], "conversion cancelled")
+
+    def _send_result(self, worker_thread, user, kindle_mail, settings):
+        worker_thread.add(user, TaskEmail(settings['subject'],
+                                          self.results["path"],
+                                          self.results['filename'],
+                                          settings,
+                                          kindle_mail,
+                                          settings['subject'],
+                                          settings['body'],
+                                          internal=True))
+
+    def _run(self, worker_thread):
         self.worker_thread = worker_thread
         if config.config_use_google_drive:
             worker_db = db.CalibreDB(expire_on_commit=False)
@@ -58,6 +130,7 @@ class TaskConvert(CalibreTask):
             os.remove(self.file_path + u'.' + self.settings['old_book_format'].lower())
 
         if filename:
+            self.results['filename'] = filename
             if config.config_use_google_drive:
                 # Upload files to gdrive
                 gdriveutils.updateGdriveCalibreFromLocal()
@@ -66,15 +139,7 @@ class TaskConvert(CalibreTask):
                 # if we're sending to kindle after converting, create a one-off task and run it immediately
                 # todo: figure out how to incorporate this into the progress
                 try:
-                    worker_thread.add(self.user, TaskEmail(self.settings['subject'],
-                                                           self.results["path"],
-                                                           filename,
-                                                           self.settings,
-                                                           self.kindle_mail,
-                                                           self.settings['subject'],
-                                                           self.settings['body'],
-                                                           internal=True)
-                                      )
+                    self._send_result(worker_thread, self.user, self.kindle_mail, self.settings)
                 except Exception as ex:
                     return self._handleError(str(ex))
 
@@ -129,6 +194,12 @@ class TaskConvert(CalibreTask):
                     log.error("Database error: %s", e)
                     local_db.session.close()
                     return
+                hash_session = ub.get_new_session_instance()
+                try:
+                    file_hash.add_file(hash_session, book_id, self.settings['new_book_format'],
+                                       file_path + format_new_ext)
+                finally:
+                    hash_session.close()
                 self.results['path'] = cur_book.path
                 self.results['title'] = cur_book.title
                 if not config.config_use_google_drive:
@@ -146,24 +217,14 @@ class TaskConvert(CalibreTask):
     def _convert_kepubify(self, file_path, format_old_ext, format_new_ext):
         quotes = [1, 3]
         command = [config.config_kepubifypath, (file_path + format_old_ext), '-o', os.path.dirname(file_path)]
+        self.progress = 0.01
         try:
-            p = process_open(command, quotes)
+            check, __ = self._run_converter(command, quotes)
         except OSError as e:
             return 1, _(u"Kepubify-converter failed: %(error)s", error=e)
-        self.progress = 0.01
-        while True:
-            nextline = p.stdout.readlines()
-            nextline = [x.strip('\n') for x in nextline if x != '\n']
-            if sys.version_info < (3, 0):
-                nextline = [x.decode('utf-8') for x in nextline]
-            for line in nextline:
-                log.debug(line)
-            if p.poll() is not None:
-                break
-
-        # ToD Handle
-        # process returncode
-        check = p.returncode
+        except ProcessTimeout:
+            return 1, _(u"Kepubify-converter was stopped after %(minutes)d minutes",
+                        minutes=config.config_converter_timeout)
 
         # move file
         if check == 0:
@@ -194,36 +255,92 @@ class TaskConvert(CalibreTask):
                     quotes.append(quotes_index)
                     quotes_index += 1
 
-            p = process_open(command, quotes)
+            check, calibre_traceback = self._run_converter(command, quotes, self._parse_calibre_progress)
         except OSError as e:
             return 1, _(u"Ebook-converter failed: %(error)s", error=e)
+        except ProcessTimeout:
+            return 1, _(u"Ebook-converter was stopped after %(minutes)d minutes",
+                        minutes=config.config_converter_timeout)
 
-        while p.poll() is None:
-            nextline = p.stdout.readline()
-            if os.name == 'nt' and sys.version_info < (3, 0):
-                nextline = nextline.decode('windows-1252')
-            elif os.name == 'posix' and sys.version_info < (3, 0):
-                nextline = nextline.decode('utf-8')
-            log.debug(nextline.strip('\r\n'))
-            # parse progress string from calibre-converter
-            progress = re.search(r"(\d+)%\s.*", nextline)
-            if progress:
-                self.progress = int(progress.group(1)) / 100
-                if config.config_use_google_drive:
-                    self.progress *= 0.9
-
-        # process returncode
-        check = p.returncode
-        calibre_traceback = p.stderr.readlines()
         error_message = ""
         for ele in calibre_traceback:
-            if sys.version_info < (3, 0):
-                ele = ele.decode('utf-8')
-            log.debug(ele.strip('\n'))
             if not ele.startswith('Traceback') and not ele.startswith('  File'):
-                error_message = _("Calibre failed with error: %(error)s", error=ele.strip('\n'))
+                error_message = _("Calibre failed with error: %(error)s", error=ele)
         return check, error_message
 
+    # parse progress string from calibre-converter
+    def _parse_calibre_progress(self, stream, line):
+        progress = re.search(r"(\d+)%\s.*", line)
+        if stream == 'stdout' and progress:
+            self.progress = int(progress.group(1)) / 100
+            if config.config_use_google_drive:
+                self.progress *= 0.9
+
+    # the converter runs with the configured priority, it's killed when the task is cancelled or takes too long
+    def _run_converter(self, command, quotes, on_line=None):
+        def handle_line(stream, line):
+            log.debug(line)
+            if on_line:
+                on_line(stream, line)
+
+        timeout = (config.config_converter_timeout or 0) * 60
+        return process_run(command, quotes, handle_line, timeout=timeout or None,
+                           cancelled=lambda: self.cancelled, nice=config.config_converter_nice or 0)
+
+    @property
+    def name(self):
+        return "Convert"
+
+
+# Converts many books one after another, the progress is reported over all books
+class TaskConvertLibrary(CalibreTask):
+    lane = LANE_BULK
+
+    def __init__(self, book_ids, taskMessage, settings, user=None):
+        super(TaskConvertLibrary, self).__init__(taskMessage)
+        self.book_ids = list(book_ids)
+        self.settings = settings
+        self.user = user
+        self.failed = 0
+
+    def run(self, worker_thread):
+        local_db = db.CalibreDB(expire_on_commit=False)
+        try:
+            for count, book_id in enumerate(self.book_ids):
+                if self.cancelled:
+                    break
+                book = local_db.get_book(book_id)
+                data = local_db.get_book_format(book_id, self.settings['old_book_format'])
+                if book and data:
+                    task = TaskConvert(os.path.join(config.config_calibre_dir, book.path, data.name), book_id,
+                                       self.message, dict(self.settings), None, self.user, reserved=True)
+                    task.start(worker_thread)
+                    if task.stat == STAT_FAIL:
+                        self.failed += 1
+                        log.error("Converting book %d failed: %s", book_id, task.error)
+                else:
+                    release_failed_conversion(book_id, self.settings['new_book_format'],
+                                              "{} format not found".format(self.settings['old_book_format']))
+                self.progress = (count + 1) / len(self.book_ids)
+        finally:
+            # books not reached after cancelling or an error
+            for book_id in self.book_ids:
+                release_failed_conversion(book_id, self.settings['new_book_format'], "conversion stopped")
+            local_db.session.close()
+        if self.cancelled:
+            return
+        if self.failed:
+            self._handleError(_(u"%(count)d of %(total)d books could not be converted",
+                                count=self.failed, total=len(self.book_ids)))
+        else:
+            self._handleSuccess()
+
+    # a library conversion cancelled while waiting never runs, the reservations of all books are released here
+    def _handleCancel(self):
+        super(TaskConvertLibrary, self)._handleCancel()
+        for book_id in self.book_ids:
+            release_failed_conversion(book_id, self.settings['new_book_format'], "conversion cancelled")
+
     @property
     def name(self):
         return "Convert"
@@ -0,0 +1,61 @@
+from __future__ import division, print_function, unicode_literals
+import os
+
+from cps.services.worker import CalibreTask, LANE_BULK
+from cps import db, ub, logger, config, file_hash
+
+log = logger.create()
+
+# number of hashes stored with one commit
+BATCH_SIZE = 100
+
+
+class TaskHashLibrary(CalibreTask):
+    lane = LANE_BULK
+    priority = 10
+
+    def __init__(self, taskMessage=u'Hash library files'):
+        super(TaskHashLibrary, self).__init__(taskMessage)
+
+    def run(self, worker_thread):
+        if config.config_use_google_drive:
+            # files on Google Drive are only hashed when they are uploaded
+            self._handleSuccess()
+            return
+        local_db = db.CalibreDB(expire_on_commit=False)
+        hash_session = ub.get_new_session_instance()
+        try:
+            hashed = file_hash.hashed_files(hash_session)
+            library = dict(((book_id, book_format), (os.path.join(config.config_calibre_dir, path, name + '.' +
+                                                                  book_format.lower()), size))
+                           for book_id, book_format, name, size, path in
+                           local_db.session.query(db.Data.book, db.Data.format, db.Data.name,
+                                                  db.Data.uncompressed_size, db.Books.path)
+                           .join(db.Books, db.Books.id == db.Data.book))
+            # files deleted outside of Calibre-Web
+            for book_id, book_format in set(hashed) - set(library):
+                file_hash.remove(hash_session, book_id, book_format, commit=False)
+            files = [(key, path) for key, (path, size) in library.items() if hashed.get(key) != size]
+            for count, ((book_id, book_format), path) in enumerate(files):
+                if self.cancelled:
+                    break
+                try:
+                    file_hash.add(hash_session, book_id, book_format, file_hash.hash_file(path),
+                                  os.path.getsize(path), commit=False)
+                except OSError as ex:
+                    log.error("File %s could not be hashed: %s", path, ex)
+                if (count + 1) % BATCH_SIZE == 0:
+                    file_hash.commit_session(hash_session)
+                self.progress = (count + 1) / len(files)
+            file_hash.commit_session(hash_session)
+        finally:
+            hash_session.close()
+            local_db.session.close()
+        if self.cancelled:
+            return
+        file_hash.index_built = True
+        self._handleSuccess()
+
+    @property
+    def name(self):
+        return "Hash Library"
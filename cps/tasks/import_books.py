@@ -0,0 +1,49 @@
+from __future__ import division, print_function, unicode_literals
+
+from flask_babel import gettext as _
+
+from cps.services.worker import CalibreTask, LANE_BULK
+from cps import db, logger, bulk_import
+
+log = logger.create()
+
+
+class TaskImportBooks(CalibreTask):
+    lane = LANE_BULK
+
+    def __init__(self, directory, taskMessage, workers=None):
+        super(TaskImportBooks, self).__init__(taskMessage)
+        self.directory = directory
+        self.workers = workers
+        self.title = taskMessage
+
+    def run(self, worker_thread):
+        files = bulk_import.scan(self.directory)
+        local_db = db.CalibreDB(expire_on_commit=False)
+        importer = bulk_import.BookImporter(local_db, self.workers, cancelled=lambda: self.cancelled)
+
+        # throughput is shown in the task list next to the directory
+        def progress(done, total):
+            self.progress = done / total
+            self.message = u"{} ({}/{}, {:.1f}/s)".format(self.title, done, total, importer.rate)
+
+        importer.progress = progress
+        try:
+            importer.run(files)
+        finally:
+            local_db.session.close()
+        log.info("Import of %s: %d books imported, %d duplicates, %d failed, %.1f files/s", self.directory,
+                 importer.imported, importer.duplicates, importer.failed, importer.rate)
+        if self.cancelled:
+            return
+        self.message = _(u"%(title)s: %(imported)d imported, %(duplicates)d duplicates skipped", title=self.title,
+                         imported=importer.imported, duplicates=importer.duplicates)
+        if importer.failed:
+            self._handleError(_(u"%(count)d of %(total)d files could not be imported",
+                                count=importer.failed, total=len(files)))
+        else:
+            self._handleSuccess()
+
+    @property
+    def name(self):
+        return "Import"
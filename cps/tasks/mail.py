@@ -6,6 +6,8 @@ import threading
 import socket
 import mimetypes
 import base64
+import tempfile
+from uuid import uuid4
 
 try:
     from StringIO import StringIO
@@ -24,7 +26,7 @@ from email import encoders
 from email.utils import formatdate, make_msgid
 from email.generator import Generator
 
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, LANE_EMAIL
 from cps.services import gmail
 from cps import logger, config
 
@@ -33,6 +35,57 @@ from cps import gdriveutils
 log = logger.create()
 
 CHUNKSIZE = 8192
+# base64 encodes 57 bytes to one line of 76 characters, attachments are read in multiples of it
+ATTACHMENT_CHUNKSIZE = 57 * 1024
+
+
+# Attachment whose content stays on disk, it's encoded in chunks while the message is written
+class FileAttachment(MIMEBase):
+
+    def __init__(self, path, filename, remove=False):
+        content_type, encoding = mimetypes.guess_type(filename)
+        if content_type is None or encoding is not None:
+            content_type = 'application/octet-stream'
+        main_type, sub_type = content_type.split('/', 1)
+        MIMEBase.__init__(self, main_type, sub_type)
+        self.path = path
+        # files downloaded from Google Drive are removed after sending
+        self.remove = remove
+        self.marker = 'attachment-' + uuid4().hex
+        self.set_payload(self.marker)
+        self['Content-Transfer-Encoding'] = 'base64'
+        self.add_header('Content-Disposition', 'attachment', filename=filename)
+
+    def load(self):
+        """Reads the content into the message for services which need the whole message at once"""
+        with open(self.path, 'rb') as f:
+            self.set_payload(f.read())
+        del self['Content-Transfer-Encoding']
+        encoders.encode_base64(self)
+
+    def write_base64(self, fp):
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(ATTACHMENT_CHUNKSIZE), b''):
+                fp.write(base64.encodebytes(chunk).replace(b'\n', b'\r\n'))
+
+    def cleanup(self):
+        if self.remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def write_message(msg, fp):
+    """Writes the message as sent with the smtp DATA command to fp, the content of attachments is streamed from
+    their files, so neither the file nor its encoded form is held in memory"""
+    fp_text = StringIO()
+    Generator(fp_text, mangle_from_=False).flatten(msg)
+    text = fp_text.getvalue()
+    for attachment in [part for part in msg.walk() if isinstance(part, FileAttachment)]:
+        head, text = text.split(attachment.marker, 1)
+        fp.write(smtplib.quotedata(head).encode('ascii'))
+        attachment.write_base64(fp)
+        # the line break after the marker is already written with the encoded content
+        text = text[1:] if text.startswith('\n') else text
+    fp.write(smtplib.quotedata(text).encode('ascii'))
 
 
 # Class for sending email with ability to get current progress
@@ -47,6 +100,41 @@ class EmailBase:
         self.progress = 0
         return (code, resp)
 
+    def send_message_file(self, from_addr, to_addr, fp, size):
+        """Sends the message written by write_message to fp"""
+        self.ehlo_or_helo_if_needed()
+        (code, resp) = self.mail(from_addr)
+        if code != 250:
+            self._rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        (code, resp) = self.rcpt(to_addr)
+        if code not in (250, 251):
+            self._rset()
+            raise smtplib.SMTPRecipientsRefused({to_addr: (code, resp)})
+        (code, resp) = self.docmd("data")
+        if code != 354:
+            self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        self.transferSize = size
+        self.progress = 0
+        fp.seek(0)
+        last_chunk = b''
+        try:
+            for chunk in iter(lambda: fp.read(CHUNKSIZE), b''):
+                self.sock.sendall(chunk)
+                self.progress += len(chunk)
+                last_chunk = chunk
+            self.sock.sendall(b'.\r\n' if last_chunk.endswith(b'\r\n') else b'\r\n.\r\n')
+        except socket.error:
+            self.close()
+            raise smtplib.SMTPServerDisconnected('Server not connected')
+        (code, resp) = self.getreply()
+        if code != 250:
+            self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        self.progress = 0
+        return code, resp
+
     def send(self, strg):
         """Send `strg' to the server."""
         log.debug_no_auth('send: {}'.format(strg[:300]))
@@ -103,6 +191,8 @@ class EmailSSL(EmailBase, smtplib.SMTP_SSL):
 
 
 class TaskEmail(CalibreTask):
+    lane = LANE_EMAIL
+
     def __init__(self, subject, filepath, attachment, settings, recipient, taskMessage, text, internal=False):
         super(TaskEmail, self).__init__(taskMessage)
         self.subject = subject
@@ -134,9 +224,12 @@ class TaskEmail(CalibreTask):
         return message
 
     def run(self, worker_thread):
+        msg = None
         try:
             # create MIME message
             msg = self.prepare_message()
+            if not msg:
+                return
             if self.settings['mail_server_type'] == 0:
                 self.send_standard_email(msg)
             else:
@@ -161,6 +254,10 @@ class TaskEmail(CalibreTask):
         except Exception as ex:
             log.debug_or_exception(ex)
             self._handleError(u'Error sending email: {}'.format(ex))
+        finally:
+            for part in (msg.walk() if msg else []):
+                if isinstance(part, FileAttachment):
+                    part.cleanup()
 
 
     def send_standard_email(self, msg):
@@ -188,12 +285,10 @@ class TaskEmail(CalibreTask):
         if self.settings["mail_password"]:
             self.asyncSMTP.login(str(self.settings["mail_login"]), str(self.settings["mail_password"]))
 
-        # Convert message to something to send
-        fp = StringIO()
-        gen = Generator(fp, mangle_from_=False)
-        gen.flatten(msg)
-
-        self.asyncSMTP.sendmail(self.settings["mail_from"], self.recipent, fp.getvalue())
+        # Convert message to something to send, attachments are encoded into a temporary file instead of memory
+        with tempfile.TemporaryFile() as fp:
+            write_message(msg, fp)
+            self.asyncSMTP.send_message_file(self.settings["mail_from"], self.recipent, fp, fp.tell())
         self.asyncSMTP.quit()
         self._handleSuccess()
         log.debug("Email send successfully")
@@ -202,6 +297,10 @@ class TaskEmail(CalibreTask):
             smtplib.stderr = org_smtpstderr
 
     def send_gmail_email(self, message):
+        # the Gmail api takes the whole message at once
+        for part in message.walk():
+            if isinstance(part, FileAttachment):
+                part.load()
         return gmail.send_messsage(self.settings.get('mail_gmail_token', None), message)
 
     @property
@@ -232,29 +331,16 @@ class TaskEmail(CalibreTask):
                 df.GetContentFile(datafile)
             else:
                 return None
-            file_ = open(datafile, 'rb')
-            data = file_.read()
-            file_.close()
-            os.remove(datafile)
-        else:
-            try:
-                file_ = open(os.path.join(calibre_path, bookpath, filename), 'rb')
-                data = file_.read()
-                file_.close()
-            except IOError as e:
-                log.debug_or_exception(e)
-                log.error(u'The requested file could not be read. Maybe wrong permissions?')
-                return None
-        # Set mimetype
-        content_type, encoding = mimetypes.guess_type(filename)
-        if content_type is None or encoding is not None:
-            content_type = 'application/octet-stream'
-        main_type, sub_type = content_type.split('/', 1)
-        attachment = MIMEBase(main_type, sub_type)
-        attachment.set_payload(data)
-        encoders.encode_base64(attachment)
-        attachment.add_header('Content-Disposition', 'attachment', filename=filename)
-        return attachment
+            return FileAttachment(datafile, filename, remove=True)
+        datafile = os.path.join(calibre_path, bookpath, filename)
+        try:
+            # the file is only read while sending, unreadable files are reported now
+            open(datafile, 'rb').close()
+        except IOError as e:
+            log.debug_or_exception(e)
+            log.error(u'The requested file could not be read. Maybe wrong permissions?')
+            return None
+        return FileAttachment(datafile, filename)
 
     @property
     def name(self):
@@ -0,0 +1,30 @@
+from __future__ import division, print_function, unicode_literals
+
+from cps.services.worker import CalibreTask
+from cps import db
+from cps import logger, thumbnails
+
+
+log = logger.create()
+
+
+class TaskGenerateCoverThumbnails(CalibreTask):
+    def __init__(self, book_ids, taskMessage=u'Generate cover thumbnails'):
+        super(TaskGenerateCoverThumbnails, self).__init__(taskMessage)
+        self.book_ids = list(book_ids)
+
+    def run(self, worker_thread):
+        worker_db = db.CalibreDB(expire_on_commit=False)
+        try:
+            for count, book_id in enumerate(self.book_ids):
+                book = worker_db.get_book(book_id)
+                if book:
+                    thumbnails.generate_thumbnails(book)
+                self.progress = (count + 1) / len(self.book_ids)
+        finally:
+            worker_db.session.close()
+        self._handleSuccess()
+
+    @property
+    def name(self):
+        return "Thumbnails"
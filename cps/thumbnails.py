@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function, unicode_literals
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from . import logger, config, ub
+
+log = logger.create()
+
+try:
+    from wand.image import Image
+    from wand.version import formats as wand_formats
+    use_IM = True
+except (ImportError, RuntimeError) as e:
+    log.debug('Cannot import Image, cover thumbnails will not be generated: %s', e)
+    use_IM = False
+
+THUMBNAIL_DIR = "thumbnails"
+# named resolutions used by the templates
+RESOLUTIONS = {'sm': (300, 450)}
+# resolutions generated in the background after a cover changed: grid pages and opds thumbnails
+PREGENERATED = ((300, 450), (240, 240))
+# arbitrary requested sizes (kobo) are rounded up to this raster to limit the number of cached variants
+SIZE_STEP = 50
+MAX_SIZE = 1500
+MIME_TYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+_webp_supported = None
+
+
+def cache_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(ub.app_DB_path)), THUMBNAIL_DIR)
+
+
+def webp_supported():
+    global _webp_supported
+    if _webp_supported is None:
+        try:
+            _webp_supported = use_IM and bool(wand_formats('WEBP'))
+        except Exception as ex:
+            log.debug_or_exception(ex)
+            _webp_supported = False
+    return _webp_supported
+
+
+def snap_size(width, height):
+    def snap(value):
+        return min(max(SIZE_STEP, -(-int(value) // SIZE_STEP) * SIZE_STEP), MAX_SIZE)
+    return snap(width), snap(height)
+
+
+def _cover_file(book):
+    return os.path.join(config.config_calibre_dir, book.path, "cover.jpg")
+
+
+# modification time and size of the cover file, the mtime is zero padded to keep the stamps sortable
+def _stamp(book):
+    try:
+        stat = os.stat(_cover_file(book))
+    except OSError:
+        return '0'
+    return '{:020d}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+
+# modification time of the cover file for the Last-Modified header of the thumbnails
+def cover_last_modified(book):
+    try:
+        return datetime.utcfromtimestamp(int(os.stat(_cover_file(book)).st_mtime))
+    except OSError:
+        return None
+
+
+# cache key of a thumbnail, changes whenever the cover file is replaced or modified
+def thumbnail_key(book, width, height, greyscale=False, image_format='jpeg'):
+    return '{}_{}_{}x{}{}.{}'.format(book.id, _stamp(book), width, height, '_grey' if greyscale else '',
+                                     image_format)
+
+
+def _thumbnail_path(book, key):
+    return os.path.join(cache_dir(), str(book.id), key)
+
+
+# removes thumbnails of older versions of the cover, files still written by concurrent requests (.tmp) and
+# thumbnails of a newer cover generated by another request meanwhile are kept
+def _prune(book):
+    book_dir = os.path.join(cache_dir(), str(book.id))
+    stamp = _stamp(book)
+    mtime = stamp.split('-')[0]
+    for name in os.listdir(book_dir):
+        parts = name.split('_')
+        if not name.endswith('.tmp') and len(parts) > 2 and parts[0] == str(book.id) and parts[1] != stamp \
+                and parts[1].split('-')[0] <= mtime:
+            try:
+                os.remove(os.path.join(book_dir, name))
+            except OSError:
+                pass
+
+
+def clear(book_id):
+    shutil.rmtree(os.path.join(cache_dir(), str(book_id)), ignore_errors=True)
+
+
+def _generate(cover_file, path, width, height, greyscale, image_format):
+    book_dir = os.path.dirname(path)
+    if not os.path.isdir(book_dir):
+        try:
+            os.makedirs(book_dir)
+        except OSError:
+            # created in the meantime by a concurrent request
+            if not os.path.isdir(book_dir):
+                raise
+    with Image(filename=cover_file) as img:
+        # only shrink, smaller covers are kept in their size
+        img.transform(resize='{}x{}>'.format(width, height))
+        if greyscale:
+            img.type = 'grayscale'
+        img.format = image_format
+        img.compression_quality = 85
+        img.strip()
+        # concurrent requests for the same thumbnail write to own files, the last rename wins
+        fd, tmp_path = tempfile.mkstemp(dir=book_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img.save(file=f)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def get_thumbnail(book, width, height, greyscale=False, image_format='jpeg'):
+    """Returns the path and key of the cached thumbnail of the book's cover, generating it if needed.
+    None is returned if no thumbnail can be generated, the full cover has to be used in that case"""
+    if not use_IM or config.config_use_google_drive or not book or not book.has_cover:
+        return None
+    cover_file = _cover_file(book)
+    key = thumbnail_key(book, width, height, greyscale, image_format)
+    path = _thumbnail_path(book, key)
+    if not os.path.isfile(path):
+        if not os.path.isfile(cover_file):
+            return None
+        try:
+            _generate(cover_file, path, width, height, greyscale, image_format)
+            _prune(book)
+        except Exception as ex:
+            log.error("Thumbnail for book %s could not be generated: %s", book.id, ex)
+            return None
+    return path, key
+
+
+def generate_thumbnails(book):
+    for width, height in PREGENERATED:
+        get_thumbnail(book, width, height)
+        if webp_supported():
+            get_thumbnail(book, width, height, image_format='webp')
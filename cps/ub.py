@@ -26,7 +26,7 @@ import uuid
 from flask import session as flask_session
 from binascii import hexlify
 
-from flask_login import AnonymousUserMixin, current_user
+from flask_login import AnonymousUserMixin
 
 try:
     from flask_dance.consumer.backend.sqla import OAuthConsumerMixin
@@ -38,7 +38,7 @@ except ImportError as e:
         oauth_support = True
     except ImportError as e:
         oauth_support = False
-from sqlalchemy import create_engine, exc, exists, event, text
+from sqlalchemy import exc, exists, event, text
 from sqlalchemy import Column, ForeignKey
 from sqlalchemy import String, Integer, SmallInteger, Boolean, DateTime, Float, JSON
 from sqlalchemy.orm.attributes import flag_modified
@@ -51,23 +51,19 @@ except ImportError:
 from sqlalchemy.orm import backref, relationship, sessionmaker, Session, scoped_session
 from werkzeug.security import generate_password_hash
 
-from . import constants, logger, cli
+from . import constants, logger, cli, db_pool
 
 log = logger.create()
 
+# Session of the current request or thread, the sessions are created from session_maker
 session = None
+session_maker = None
 app_DB_path = None
 Base = declarative_base()
+# ids of the last search results per user, for adding them to a shelf
 searched_ids = {}
 
 
-def store_ids(result):
-    ids = list()
-    for element in result:
-        ids.append(element.id)
-    searched_ids[current_user.id] = ids
-
-
 class UserBase:
 
     @property
@@ -411,6 +407,28 @@ class Downloads(Base):
         return '<Download %r' % self.book_id
 
 
+# Number of users who downloaded a book, maintained together with the downloads for the hot books list
+class DownloadCount(Base):
+    __tablename__ = 'download_count'
+
+    book_id = Column(Integer, primary_key=True)
+    count = Column(Integer, index=True, default=0)
+
+
+# Content hash of a file of the library, to find identical files
+class BookFileHash(Base):
+    __tablename__ = 'book_file_hash'
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, index=True)
+    format = Column(String)
+    hash = Column(String, index=True)
+    size = Column(Integer)
+
+    def __repr__(self):
+        return u"<BookFileHash('{0}, {1}, {2}')>".format(self.book_id, self.format, self.hash)
+
+
 # Baseclass representing allowed domains for registration
 class Registration(Base):
     __tablename__ = 'registration'
@@ -462,6 +480,19 @@ def add_missing_tables(engine, session):
         session.commit()
 
 
+# Counts the existing downloads once after the download counter was added
+def migrate_download_count(session):
+    try:
+        if not session.query(exists().where(DownloadCount.book_id)).scalar() \
+                and session.query(exists().where(Downloads.book_id)).scalar():
+            session.execute(DownloadCount.__table__.insert().from_select(
+                ['book_id', 'count'],
+                session.query(Downloads.book_id, func.count(Downloads.id)).group_by(Downloads.book_id)))
+            session.commit()
+    except exc.OperationalError:
+        session.rollback()
+
+
 # migrate all settings missing in registration table
 def migrate_registration_table(engine, session):
     try:
@@ -566,6 +597,7 @@ def migrate_Database(session):
     migrate_readBook(engine, session)
     migrate_remoteAuthToken(engine, session)
     migrate_shelfs(engine, session)
+    migrate_download_count(session)
     try:
         create = False
         session.query(exists().where(User.sidebar_view)).scalar()
@@ -661,20 +693,31 @@ def clean_database(session):
 
 # Save downloaded books per user in calibre-web's own database
 def update_download(book_id, user_id):
-    check = session.query(Downloads).filter(Downloads.user_id == user_id).filter(Downloads.book_id == book_id).first()
-
-    if not check:
+    # a concurrent first download of the book adds its count as well, then the count is increased in a second try
+    for __ in range(2):
+        check = session.query(Downloads).filter(Downloads.user_id == user_id)\
+            .filter(Downloads.book_id == book_id).first()
+        if check:
+            return
         new_download = Downloads(user_id=user_id, book_id=book_id)
         session.add(new_download)
+        if not session.query(DownloadCount).filter(DownloadCount.book_id == book_id)\
+                .update({DownloadCount.count: DownloadCount.count + 1}, synchronize_session=False):
+            session.add(DownloadCount(book_id=book_id, count=1))
         try:
             session.commit()
+            return
+        except exc.IntegrityError:
+            session.rollback()
         except exc.OperationalError:
             session.rollback()
+            return
 
 
 # Delete non exisiting downloaded books in calibre-web's own database
 def delete_download(book_id):
     session.query(Downloads).filter(book_id == Downloads.book_id).delete()
+    session.query(DownloadCount).filter(book_id == DownloadCount.book_id).delete()
     try:
         session.commit()
     except exc.OperationalError:
@@ -711,17 +754,22 @@ def create_admin_user(session):
         session.rollback()
 
 
+# Own session for background tasks, the global session belongs to the request threads
+def get_new_session_instance():
+    return session_maker()
+
+
 def init_db(app_db_path):
     # Open session for database connection
     global session
+    global session_maker
     global app_DB_path
 
     app_DB_path = app_db_path
-    engine = create_engine(u'sqlite:///{0}'.format(app_db_path), echo=False)
+    engine = db_pool.create_engine(u'sqlite:///{0}'.format(app_db_path))
 
-    Session = scoped_session(sessionmaker())
-    Session.configure(bind=engine)
-    session = Session()
+    session_maker = sessionmaker(bind=engine)
+    session = scoped_session(session_maker, scopefunc=db_pool.session_scope)
 
     if os.path.exists(app_db_path):
         Base.metadata.create_all(engine)
@@ -758,15 +806,25 @@ def dispose():
     session = None
     if old_session:
         try:
-            old_session.close()
+            old_session.remove()
         except Exception:
             pass
-        if old_session.bind:
+        if session_maker.kw.get('bind'):
             try:
-                old_session.bind.dispose()
+                session_maker.kw['bind'].dispose()
             except Exception:
                 pass
 
+
+# Closes the session of the current request, its connection returns to the pool
+def remove_session():
+    if session is not None:
+        session.remove()
+
+
+def pool_stats():
+    return db_pool.stats(session_maker.kw.get('bind')) if session_maker else None
+
 def session_commit(success=None):
     try:
         session.commit()
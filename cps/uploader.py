@@ -18,11 +18,9 @@
 
 from __future__ import division, print_function, unicode_literals
 import os
-import hashlib
-from tempfile import gettempdir
 from flask_babel import gettext as _
 
-from . import logger, comic, isoLanguages
+from . import logger, comic, isoLanguages, staging
 from .constants import BookMeta
 from .helper import split_authors
 
@@ -303,15 +301,13 @@ def get_versions():
 
 
 def upload(uploadfile, rarExcecutable):
-    tmp_dir = os.path.join(gettempdir(), 'calibre_web')
-
-    if not os.path.isdir(tmp_dir):
-        os.mkdir(tmp_dir)
-
-    filename = uploadfile.filename
-    filename_root, file_extension = os.path.splitext(filename)
-    md5 = hashlib.md5(filename.encode('utf-8')).hexdigest()  # nosec
-    tmp_file_path = os.path.join(tmp_dir, md5)
+    filename_root, file_extension = os.path.splitext(uploadfile.filename)
+    # metadata and cover are extracted from the staged file, which is later moved into the library
+    tmp_file_path, file_hash = staging.stage(uploadfile)
     log.debug("Temporary file: %s", tmp_file_path)
-    uploadfile.save(tmp_file_path)
-    return process(tmp_file_path, filename_root, file_extension, rarExcecutable)
+    try:
+        meta = process(tmp_file_path, filename_root, file_extension, rarExcecutable)
+    except Exception:
+        os.remove(tmp_file_path)
+        raise
+    return meta._replace(file_hash=file_hash)
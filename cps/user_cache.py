@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2021 OzzieIsaacs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Values needed by (nearly) every page like the shelves of the user and the read books. They are cached per user
+# together with a version, which changes with each write of the underlying table
+from __future__ import division, print_function, unicode_literals
+import threading
+
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import or_
+
+from . import ub
+from .category_cache import CachedEntity
+
+SHELVES = 'shelves'
+READ_BOOKS = 'read_books'
+# the cache is cleared if it grows above this number of values
+MAX_ENTRIES = 1024
+
+_versions = {SHELVES: 0, READ_BOOKS: 0}
+_lock = threading.Lock()
+_entries = dict()
+
+
+# the changed tables are collected while flushing and their versions increased after the commit, before the commit
+# other sessions would still read the old rows for the new version
+@event.listens_for(Session, 'before_flush')
+def _collect_changes(session, flush_context, instances):
+    for change in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(change, (ub.Shelf, ub.BookShelf)):
+            session.info.setdefault('user_cache_changes', set()).add(SHELVES)
+        elif isinstance(change, ub.ReadBook):
+            session.info.setdefault('user_cache_changes', set()).add(READ_BOOKS)
+
+
+# bulk deletes and updates don't report the changed objects
+@event.listens_for(Session, 'after_bulk_delete')
+@event.listens_for(Session, 'after_bulk_update')
+def _collect_bulk_changes(context):
+    if context.mapper.class_ in (ub.Shelf, ub.BookShelf, ub.ReadBook):
+        context.session.info.setdefault('user_cache_changes', set()).update((SHELVES, READ_BOOKS))
+
+
+@event.listens_for(Session, 'after_commit')
+def _count_changes(session):
+    changes = session.info.pop('user_cache_changes', None)
+    if changes:
+        with _lock:
+            for kind in changes:
+                _versions[kind] += 1
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('user_cache_changes', None)
+
+
+def version(kind):
+    return _versions[kind]
+
+
+def cached(key, value_version, build):
+    """Returns the value stored for key if it was built for value_version, otherwise the new value of build()"""
+    with _lock:
+        entry = _entries.get(key)
+        if entry and entry[0] == value_version:
+            return entry[1]
+    value = build()
+    with _lock:
+        if len(_entries) >= MAX_ENTRIES:
+            _entries.clear()
+        _entries[key] = (value_version, value)
+    return value
+
+
+def _shelves(user_id):
+    return [CachedEntity(shelf) for shelf in ub.session.query(ub.Shelf)
+            .filter(or_(ub.Shelf.is_public == 1, ub.Shelf.user_id == user_id)).order_by(ub.Shelf.name)]
+
+
+# Public shelves and the shelves of the current user
+def shelves():
+    user_id = int(current_user.id)
+    return cached((SHELVES, user_id), version(SHELVES), lambda: _shelves(user_id))
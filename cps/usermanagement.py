@@ -18,7 +18,13 @@
 
 import base64
 import binascii
+import hashlib
+import hmac
+import os
+import threading
+import time
 
+from sqlalchemy import event
 from sqlalchemy.sql.expression import func
 from werkzeug.security import check_password_hash
 from flask_login import login_required
@@ -30,6 +36,83 @@ try:
 except ImportError:
     pass  # We're not using Python 3
 
+# seconds a verified basic auth credential is accepted without checking the password hash again
+CREDENTIAL_TTL = 300
+MAX_CREDENTIALS = 1000
+
+
+class CredentialCache(object):
+    """Basic auth credentials which were verified recently. OPDS readers and other clients send the credentials with
+    every request, without the cache each request would check the (deliberately slow) password hash again.
+    Only a keyed digest of the credentials is kept, it contains the stored password hash, so changing the password
+    invalidates the entry as well"""
+
+    def __init__(self, ttl=CREDENTIAL_TTL, max_entries=MAX_CREDENTIALS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._secret = os.urandom(32)
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def _key(self, user, password):
+        credential = u'\0'.join((user.name.lower(), password, str(user.password))).encode('utf-8')
+        return hmac.new(self._secret, credential, hashlib.sha256).digest()
+
+    def verify(self, user, password, check):
+        """Returns if the password of the user is valid, check(user, password) is only called on a cache miss"""
+        key = self._key(user, password)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == user.id and entry[1] > now:
+                self.hits += 1
+                return True
+            self.misses += 1
+        if not check(user, password):
+            return False
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries = dict((k, v) for k, v in self._entries.items() if v[1] > now)
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[key] = (user.id, now + self.ttl)
+        return True
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries = dict((k, v) for k, v in self._entries.items() if v[0] != user_id)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+credential_cache = CredentialCache()
+
+
+@event.listens_for(ub.User.password, 'set')
+@event.listens_for(ub.User.role, 'set')
+def _invalidate_credentials(target, value, oldvalue, initiator):
+    if target.id is not None and value != oldvalue:
+        credential_cache.invalidate(target.id)
+
+
+def _check_password(user, password):
+    if config.config_login_type == constants.LOGIN_LDAP and services.ldap:
+        if services.ldap.bind_user(str(user.password), password):
+            return True
+    return check_password_hash(str(user.password), password)
+
+
+# Checks the password of basic auth requests, successful checks are cached for a short time
+def check_basic_auth_password(user, password):
+    return credential_cache.verify(user, password, _check_password)
+
 def login_required_if_no_ano(func):
     @wraps(func)
     def decorated_view(*args, **kwargs):
@@ -81,9 +164,6 @@ def load_user_from_auth_header(header_val):
     except (TypeError, UnicodeDecodeError, binascii.Error):
         pass
     user = _fetch_user_by_name(basic_username)
-    if user and config.config_login_type == constants.LOGIN_LDAP and services.ldap:
-        if services.ldap.bind_user(str(user.password), basic_password):
-            return user
-    if user and check_password_hash(str(user.password), basic_password):
+    if user and check_basic_auth_password(user, basic_password):
         return user
     return
@@ -26,7 +26,6 @@ from datetime import datetime
 import json
 import mimetypes
 import chardet  # dependency of requests
-import copy
 
 from babel.dates import format_date
 from babel import Locale as LC
@@ -48,15 +47,17 @@ from werkzeug.security import generate_password_hash, check_password_hash
 
 from . import constants, logger, isoLanguages, services
 from . import babel, db, ub, config, get_locale, app
-from . import calibre_db
+from . import calibre_db, comic_reader, category_cache, user_cache
 from .gdriveutils import getFileFromEbooksFolder, do_gdrive_download
 from .helper import check_valid_domain, render_task_status, check_email, check_username, \
     get_cc_columns, get_book_cover, get_download_link, send_mail, generate_random_password, \
-    send_registration_mail, check_send_to_kindle, check_read_formats, tags_filters, reset_password, valid_email
+    send_registration_mail, check_send_to_kindle, check_read_formats, tags_filters, reset_password, valid_email, \
+    book_validators, not_modified_response, add_validators, send_library_file
 from .pagination import Pagination
 from .redirect import redirect_back
 from .usermanagement import login_required_if_no_ano
 from .render_template import render_title_template
+from .search_index import search_index
 
 feature_support = {
     'ldap': bool(services.ldap),
@@ -128,6 +129,15 @@ def get_email_status_json():
     return jsonify(render_task_status(tasks))
 
 
+@web.route("/ajax/canceltask/<task_id>", methods=['POST'])
+@login_required
+def cancel_task(task_id):
+    user = None if current_user.role_admin() else current_user.name
+    if WorkerThread.getInstance().cancel(task_id, user):
+        return "", 204
+    abort(404)
+
+
 @web.route("/ajax/bookmark/<int:book_id>/<book_format>", methods=['POST'])
 @login_required
 def bookmark(book_id, book_format):
@@ -222,56 +232,70 @@ def update_view():
     return "1", 200
 
 
-'''
-@web.route("/ajax/getcomic/<int:book_id>/<book_format>/<int:page>")
-@login_required
-def get_comic_book(book_id, book_format, page):
-    book = calibre_db.get_book(book_id)
+# returns the local file of a comic or None if the pages can't be read on the server
+def _get_comic_file(book_id, book_format):
+    if not comic_reader.supported(book_format):
+        return None, None
+    book = calibre_db.get_filtered_book(book_id)
+    data = calibre_db.get_book_format(book_id, book_format.upper())
+    if not book or not data:
+        return None, None
+    file_path = os.path.join(config.config_calibre_dir, book.path, data.name + "." + book_format.lower())
+    if not os.path.isfile(file_path):
+        return None, None
+    return book, file_path
+
+
+@web.route("/ajax/comic/<int:book_id>/<book_format>")
+@login_required_if_no_ano
+@viewer_required
+def get_comic_pages(book_id, book_format):
+    book, file_path = _get_comic_file(book_id, book_format)
     if not book:
-        return "", 204
-    else:
-        for bookformat in book.data:
-            if bookformat.format.lower() == book_format.lower():
-                cbr_file = os.path.join(config.config_calibre_dir, book.path, bookformat.name) + "." + book_format
-                if book_format in ("cbr", "rar"):
-                    if feature_support['rar'] == True:
-                        rarfile.UNRAR_TOOL = config.config_rarfile_location
-                        try:
-                            rf = rarfile.RarFile(cbr_file)
-                            names = sort(rf.namelist())
-                            extract = lambda page: rf.read(names[page])
-                        except:
-                            # rarfile not valid
-                            log.error('Unrar binary not found, or unable to decompress file %s', cbr_file)
-                            return "", 204
-                    else:
-                        log.info('Unrar is not supported please install python rarfile extension')
-                        # no support means return nothing
-                        return "", 204
-                elif book_format in ("cbz", "zip"):
-                    zf = zipfile.ZipFile(cbr_file)
-                    names=sort(zf.namelist())
-                    extract = lambda page: zf.read(names[page])
-                elif book_format in ("cbt", "tar"):
-                    tf = tarfile.TarFile(cbr_file)
-                    names=sort(tf.getnames())
-                    extract = lambda page: tf.extractfile(names[page]).read()
-                else:
-                    log.error('unsupported comic format')
-                    return "", 204
+        abort(404)
+    try:
+        pages = comic_reader.get_pages(book_id, file_path, book_format)
+    except Exception as ex:
+        log.error("Pages of %s could not be read: %s", file_path, ex)
+        abort(404)
+    return jsonify(pages=[os.path.basename(name) for name in pages], prefetch=comic_reader.PREFETCH_PAGES)
 
-                if sys.version_info.major >= 3:
-                    b64 = codecs.encode(extract(page), 'base64').decode()
-                else:
-                    b64 = extract(page).encode('base64')
-                ext = names[page].rpartition('.')[-1]
-                if ext not in ('png', 'gif', 'jpg', 'jpeg', 'webp'):
-                    ext = 'png'
-                extractedfile="data:image/" + ext + ";base64," + b64
-                fileData={"name": names[page], "page":page, "last":len(names)-1, "content": extractedfile}
-                return make_response(json.dumps(fileData))
-        return "", 204
-'''
+
+@web.route("/ajax/comic/<int:book_id>/<book_format>/<int:page>")
+@login_required_if_no_ano
+@viewer_required
+def get_comic_page(book_id, book_format, page):
+    book, file_path = _get_comic_file(book_id, book_format)
+    if not book:
+        abort(404)
+    width = request.args.get('width', type=int)
+    height = request.args.get('height', type=int)
+    size = None
+    if width or height:
+        size = (comic_reader.snap_size(width or comic_reader.MAX_SIZE),
+                comic_reader.snap_size(height or comic_reader.MAX_SIZE))
+    etag, last_modified = book_validators(book, book_format, "{}-{}-{}".format(
+        int(os.path.getmtime(file_path)), page, "{}x{}".format(*size) if size else "full"))
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+    try:
+        result = comic_reader.read_page(book_id, file_path, book_format, page)
+    except Exception as ex:
+        log.error("Page %s of %s could not be read: %s", page, file_path, ex)
+        abort(404)
+    if not result:
+        abort(404)
+    name, content = result
+    if size:
+        content, mimetype = comic_reader.resize_page(content, name, *size)
+    else:
+        mimetype = comic_reader.page_mimetype(name)
+    response = add_validators(make_response(content), etag, last_modified)
+    response.headers["Content-Type"] = mimetype
+    # pages of a file never change, the reader can keep them while reading
+    response.headers["Cache-Control"] = "private, max-age=3600"
+    return response
 
 
 # ################################### Typeahead ##################################################################
@@ -444,18 +468,7 @@ def render_hot_books(page):
         else:
             random = false()
         off = int(int(config.config_books_per_page) * (page - 1))
-        all_books = ub.session.query(ub.Downloads, func.count(ub.Downloads.book_id)).order_by(
-            func.count(ub.Downloads.book_id).desc()).group_by(ub.Downloads.book_id)
-        hot_books = all_books.offset(off).limit(config.config_books_per_page)
-        entries = list()
-        for book in hot_books:
-            downloadBook = calibre_db.session.query(db.Books).filter(calibre_db.common_filters()).filter(
-                db.Books.id == book.Downloads.book_id).first()
-            if downloadBook:
-                entries.append(downloadBook)
-            else:
-                ub.delete_download(book.Downloads.book_id)
-        numBooks = entries.__len__()
+        entries, numBooks = calibre_db.get_hot_books(off, config.config_books_per_page)
         pagination = Pagination(page, config.config_books_per_page, numBooks)
         return render_title_template('index.html', random=random, entries=entries, pagination=pagination,
                                      title=_(u"Hot Books (Most Downloaded)"), page="hot")
@@ -762,6 +775,8 @@ def list_books():
     order = request.args.get("order", "").lower()
     state = None
     join = tuple()
+    # books sorted by a column of the books table are paged with the cursor of the previous page if it's given
+    keyset = None
 
     if sort == "state":
         state = json.loads(request.args.get("state", "[]"))
@@ -781,21 +796,28 @@ def list_books():
         order = [db.Languages.lang_code.asc()] if order == "asc" else [db.Languages.lang_code.desc()]
         join = db.books_languages_link,db.Books.id == db.books_languages_link.c.book, db.Languages
     elif order and sort in ["sort", "title", "authors_sort", "series_index"]:
+        if sort != "authors_sort":
+            keyset = getattr(db.Books, sort), order == "desc"
         order = [text(sort + " " + order)]
     elif not state:
         order = [db.Books.timestamp.desc()]
+        keyset = db.Books.timestamp, True
 
     total_count = filtered_count = calibre_db.session.query(db.Books).count()
+    cursor = request.args.get("cursor")
+    next_cursor = None
 
-    if state:
+    if state is not None:
+        # the selected books are sorted first by the database, only the requested page is loaded
+        query = calibre_db.search_query(search) if search else \
+            calibre_db.session.query(db.Books).filter(calibre_db.common_filters())
         if search:
-            books = calibre_db.search_query(search).all()
-            filtered_count = len(books)
-        else:
-            books = calibre_db.session.query(db.Books).filter(calibre_db.common_filters()).all()
-        entries = calibre_db.get_checkbox_sorted(books, state, off, limit,order)
+            filtered_count = calibre_db.count_entries(query, db.Books)
+        entries = query.order_by(*calibre_db.checkbox_order(state, order)).offset(off).limit(limit).all()
     elif search:
         entries, filtered_count, __ = calibre_db.get_search_results(search, off, order, limit, *join)
+    elif keyset and (not off or calibre_db.parse_keyset_cursor(cursor, *keyset)):
+        entries, next_cursor, __ = calibre_db.fill_keyset_page(limit, True, keyset[0], keyset[1], cursor)
     else:
         entries, __, __ = calibre_db.fill_indexpage((int(off) / (int(limit)) + 1), limit, db.Books, True, order, *join)
 
@@ -807,7 +829,8 @@ def list_books():
             except UnknownLocaleError:
                 entry.languages[index].language_name = _(
                     isoLanguages.get(part3=entry.languages[index].lang_code).name)
-    table_entries = {'totalNotFiltered': total_count, 'total': filtered_count, "rows": entries}
+    table_entries = {'totalNotFiltered': total_count, 'total': filtered_count, "rows": entries,
+                     "nextOffset": off + limit, "nextCursor": next_cursor}
     js_list = json.dumps(table_entries, cls=db.AlchemyEncoder)
 
     response = make_response(js_list)
@@ -836,24 +859,10 @@ def update_table_settings():
 @login_required_if_no_ano
 def author_list():
     if current_user.check_visibility(constants.SIDEBAR_AUTHOR):
-        if current_user.get_view_property('author', 'dir') == 'desc':
-            order = db.Authors.sort.desc()
-            order_no = 0
-        else:
-            order = db.Authors.sort.asc()
-            order_no = 1
-        entries = calibre_db.session.query(db.Authors, func.count('books_authors_link.book').label('count')) \
-            .join(db.books_authors_link).join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(text('books_authors_link.author')).order_by(order).all()
-        charlist = calibre_db.session.query(func.upper(func.substr(db.Authors.sort, 1, 1)).label('char')) \
-            .join(db.books_authors_link).join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(func.upper(func.substr(db.Authors.sort, 1, 1))).all()
-        # If not creating a copy, readonly databases can not display authornames with "|" in it as changing the name
-        # starts a change session
-        autor_copy = copy.deepcopy(entries)
-        for entry in autor_copy:
-            entry.Authors.name = entry.Authors.name.replace('|', ',')
-        return render_title_template('list.html', entries=autor_copy, folder='web.books_list', charlist=charlist,
+        order_no = 0 if current_user.get_view_property('author', 'dir') == 'desc' else 1
+        entries = category_cache.authors(order_no == 0)
+        charlist = category_cache.letters('author')
+        return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=charlist,
                                      title=u"Authors", page="authorlist", data='author', order=order_no)
     else:
         abort(404)
@@ -882,19 +891,10 @@ def download_list():
 @web.route("/publisher")
 @login_required_if_no_ano
 def publisher_list():
-    if current_user.get_view_property('publisher', 'dir') == 'desc':
-        order = db.Publishers.name.desc()
-        order_no = 0
-    else:
-        order = db.Publishers.name.asc()
-        order_no = 1
+    order_no = 0 if current_user.get_view_property('publisher', 'dir') == 'desc' else 1
     if current_user.check_visibility(constants.SIDEBAR_PUBLISHER):
-        entries = calibre_db.session.query(db.Publishers, func.count('books_publishers_link.book').label('count')) \
-            .join(db.books_publishers_link).join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(text('books_publishers_link.publisher')).order_by(order).all()
-        charlist = calibre_db.session.query(func.upper(func.substr(db.Publishers.name, 1, 1)).label('char')) \
-            .join(db.books_publishers_link).join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(func.upper(func.substr(db.Publishers.name, 1, 1))).all()
+        entries = category_cache.publishers(order_no == 0)
+        charlist = category_cache.letters('publisher')
         return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=charlist,
                                      title=_(u"Publishers"), page="publisherlist", data="publisher", order=order_no)
     else:
@@ -905,29 +905,15 @@ def publisher_list():
 @login_required_if_no_ano
 def series_list():
     if current_user.check_visibility(constants.SIDEBAR_SERIES):
-        if current_user.get_view_property('series', 'dir') == 'desc':
-            order = db.Series.sort.desc()
-            order_no = 0
-        else:
-            order = db.Series.sort.asc()
-            order_no = 1
+        order_no = 0 if current_user.get_view_property('series', 'dir') == 'desc' else 1
         if current_user.get_view_property('series', 'series_view') == 'list':
-            entries = calibre_db.session.query(db.Series, func.count('books_series_link.book').label('count')) \
-                .join(db.books_series_link).join(db.Books).filter(calibre_db.common_filters()) \
-                .group_by(text('books_series_link.series')).order_by(order).all()
-            charlist = calibre_db.session.query(func.upper(func.substr(db.Series.sort, 1, 1)).label('char')) \
-                .join(db.books_series_link).join(db.Books).filter(calibre_db.common_filters()) \
-                .group_by(func.upper(func.substr(db.Series.sort, 1, 1))).all()
+            entries = category_cache.series(order_no == 0)
+            charlist = category_cache.letters('series')
             return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=charlist,
                                          title=_(u"Series"), page="serieslist", data="series")
         else:
-            entries = calibre_db.session.query(db.Books, func.count('books_series_link').label('count')) \
-                .join(db.books_series_link).join(db.Series).filter(calibre_db.common_filters()) \
-                .group_by(text('books_series_link.series')).order_by(order).all()
-            charlist = calibre_db.session.query(func.upper(func.substr(db.Series.sort, 1, 1)).label('char')) \
-                .join(db.books_series_link).join(db.Books).filter(calibre_db.common_filters()) \
-                .group_by(func.upper(func.substr(db.Series.sort, 1, 1))).all()
-
+            entries = category_cache.series_books(order_no == 0)
+            charlist = category_cache.letters('series')
             return render_title_template('grid.html', entries=entries, folder='web.books_list', charlist=charlist,
                                          title=_(u"Series"), page="serieslist", data="series", bodyClass="grid-view",
                                          order=order_no)
@@ -939,16 +925,8 @@ def series_list():
 @login_required_if_no_ano
 def ratings_list():
     if current_user.check_visibility(constants.SIDEBAR_RATING):
-        if current_user.get_view_property('ratings', 'dir') == 'desc':
-            order = db.Ratings.rating.desc()
-            order_no = 0
-        else:
-            order = db.Ratings.rating.asc()
-            order_no = 1
-        entries = calibre_db.session.query(db.Ratings, func.count('books_ratings_link.book').label('count'),
-                                   (db.Ratings.rating / 2).label('name')) \
-            .join(db.books_ratings_link).join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(text('books_ratings_link.rating')).order_by(order).all()
+        order_no = 0 if current_user.get_view_property('ratings', 'dir') == 'desc' else 1
+        entries = category_cache.ratings(order_no == 0)
         return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=list(),
                                      title=_(u"Ratings list"), page="ratingslist", data="ratings", order=order_no)
     else:
@@ -959,17 +937,8 @@ def ratings_list():
 @login_required_if_no_ano
 def formats_list():
     if current_user.check_visibility(constants.SIDEBAR_FORMAT):
-        if current_user.get_view_property('ratings', 'dir') == 'desc':
-            order = db.Data.format.desc()
-            order_no = 0
-        else:
-            order = db.Data.format.asc()
-            order_no = 1
-        entries = calibre_db.session.query(db.Data,
-                                           func.count('data.book').label('count'),
-                                           db.Data.format.label('format')) \
-            .join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(db.Data.format).order_by(order).all()
+        order_no = 0 if current_user.get_view_property('ratings', 'dir') == 'desc' else 1
+        entries = category_cache.formats(order_no == 0)
         return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=list(),
                                      title=_(u"File formats list"), page="formatslist", data="formats", order=order_no)
     else:
@@ -980,24 +949,9 @@ def formats_list():
 @login_required_if_no_ano
 def language_overview():
     if current_user.check_visibility(constants.SIDEBAR_LANGUAGE):
+        # ToDo: generate first character list for languages
         charlist = list()
-        if current_user.filter_language() == u"all":
-            languages = calibre_db.speaking_language()
-            # ToDo: generate first character list for languages
-        else:
-            try:
-                cur_l = LC.parse(current_user.filter_language())
-            except UnknownLocaleError:
-                cur_l = None
-            languages = calibre_db.session.query(db.Languages).filter(
-                db.Languages.lang_code == current_user.filter_language()).all()
-            if cur_l:
-                languages[0].name = cur_l.get_language_name(get_locale())
-            else:
-                languages[0].name = _(isoLanguages.get(part3=languages[0].lang_code).name)
-        lang_counter = calibre_db.session.query(db.books_languages_link,
-                                        func.count('books_languages_link.book').label('bookcount')).group_by(
-            text('books_languages_link.lang_code')).all()
+        languages, lang_counter = category_cache.languages()
         return render_title_template('languages.html', languages=languages, lang_counter=lang_counter,
                                      charlist=charlist, title=_(u"Languages"), page="langlist",
                                      data="language")
@@ -1009,18 +963,9 @@ def language_overview():
 @login_required_if_no_ano
 def category_list():
     if current_user.check_visibility(constants.SIDEBAR_CATEGORY):
-        if current_user.get_view_property('category', 'dir') == 'desc':
-            order = db.Tags.name.desc()
-            order_no = 0
-        else:
-            order = db.Tags.name.asc()
-            order_no = 1
-        entries = calibre_db.session.query(db.Tags, func.count('books_tags_link.book').label('count')) \
-            .join(db.books_tags_link).join(db.Books).order_by(order).filter(calibre_db.common_filters()) \
-            .group_by(text('books_tags_link.tag')).all()
-        charlist = calibre_db.session.query(func.upper(func.substr(db.Tags.name, 1, 1)).label('char')) \
-            .join(db.books_tags_link).join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(func.upper(func.substr(db.Tags.name, 1, 1))).all()
+        order_no = 0 if current_user.get_view_property('category', 'dir') == 'desc' else 1
+        entries = category_cache.tags(order_no == 0)
+        charlist = category_cache.letters('category')
         return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=charlist,
                                      title=_(u"Categories"), page="catlist", data="category", order=order_no)
     else:
@@ -1238,7 +1183,7 @@ def extend_search_term(searchterm,
 
 def render_adv_search_results(term, offset=None, order=None, limit=None):
     order = order or [db.Books.sort]
-    pagination = None
+    rank = None
 
     cc = get_cc_columns(filter_config_custom_read=True)
     calibre_db.session.connection().connection.connection.create_function("lower", 1, db.lcase)
@@ -1305,17 +1250,29 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
                                                             rating_low,
                                                             read_status)
         q = q.filter()
-        if author_name:
-            q = q.filter(db.Books.authors.any(func.lower(db.Authors.name).ilike("%" + author_name + "%")))
-        if book_title:
-            q = q.filter(func.lower(db.Books.title).ilike("%" + book_title + "%"))
+        fts_expression = ' AND '.join(filter(None, (
+            search_index.match_expression(author_name or '', 'authors'),
+            search_index.match_expression(book_title or '', 'title'),
+            search_index.match_expression(publisher or '', 'publishers'),
+            search_index.match_expression(description or '', 'comments'))))
+        matches = calibre_db.fts_matches(fts_expression)
+        if matches is not None:
+            q = q.join(matches, db.Books.id == matches.c.rowid)
+            rank = matches.c.rank
+        else:
+            if author_name:
+                q = q.filter(db.Books.authors.any(func.lower(db.Authors.name).ilike("%" + author_name + "%")))
+            if book_title:
+                q = q.filter(func.lower(db.Books.title).ilike("%" + book_title + "%"))
+            if publisher:
+                q = q.filter(db.Books.publishers.any(func.lower(db.Publishers.name).ilike("%" + publisher + "%")))
+            if description:
+                q = q.filter(db.Books.comments.any(func.lower(db.Comments.text).ilike("%" + description + "%")))
         if pub_start:
             q = q.filter(func.datetime(db.Books.pubdate) > func.datetime(pub_start))
         if pub_end:
             q = q.filter(func.datetime(db.Books.pubdate) < func.datetime(pub_end))
         q = adv_search_read_status(q, read_status)
-        if publisher:
-            q = q.filter(db.Books.publishers.any(func.lower(db.Publishers.name).ilike("%" + publisher + "%")))
         q = adv_search_tag(q, tags['include_tag'], tags['exclude_tag'])
         q = adv_search_serie(q, tags['include_serie'], tags['exclude_serie'])
         q = adv_search_shelf(q, tags['include_shelf'], tags['exclude_shelf'])
@@ -1323,9 +1280,6 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
         q = adv_search_language(q, tags['include_language'], tags['exclude_language'])
         q = adv_search_ratings(q, rating_high, rating_low)
 
-        if description:
-            q = q.filter(db.Books.comments.any(func.lower(db.Comments.text).ilike("%" + description + "%")))
-
         # search custom culumns
         try:
             q = adv_search_custom_columns(cc, term, q)
@@ -1333,21 +1287,17 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
             log.debug_or_exception(ex)
             flash(_("Error on search for custom columns, please restart Calibre-Web"), category="error")
 
-    q = q.order_by(*order).all()
     flask_session['query'] = json.dumps(term)
-    ub.store_ids(q)
-    result_count = len(q)
-    if offset != None and limit != None:
-        offset = int(offset)
-        limit_all = offset + int(limit)
-        pagination = Pagination((offset / (int(limit)) + 1), limit, result_count)
-    else:
-        offset = 0
-        limit_all = result_count
+    # the best matches first like in the simple search
+    order = [rank] + list(order) if rank is not None else list(order)
+    # the shelf and read status filters depend on the shelves and read books of the user
+    key = ('advsearch', json.dumps(term, sort_keys=True), tuple(str(element) for element in order),
+           user_cache.version(user_cache.SHELVES), user_cache.version(user_cache.READ_BOOKS))
+    entries, result_count, pagination = calibre_db.get_search_page(key, q.order_by(*order), offset, limit)
     return render_title_template('search.html',
                                  adv_searchterm=searchterm,
                                  pagination=pagination,
-                                 entries=q[offset:limit_all],
+                                 entries=entries,
                                  result_count=result_count,
                                  title=_(u"Advanced Search"), page="advsearch")
 
@@ -1365,9 +1315,10 @@ def advanced_search_form():
 
 
 @web.route("/cover/<int:book_id>")
+@web.route("/cover/<int:book_id>/<string:resolution>")
 @login_required_if_no_ano
-def get_cover(book_id):
-    return get_book_cover(book_id)
+def get_cover(book_id, resolution=None):
+    return get_book_cover(book_id, resolution)
 
 @web.route("/robots.txt")
 def get_robots():
@@ -1384,27 +1335,34 @@ def serve_book(book_id, book_format, anyname):
     if not data:
         return "File not in Database"
     log.info('Serving book: %s', data.name)
+    etag, last_modified = book_validators(book, book_format, data.uncompressed_size)
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
     if config.config_use_google_drive:
         try:
             headers = Headers()
             headers["Content-Type"] = mimetypes.types_map.get('.' + book_format, "application/octet-stream")
             df = getFileFromEbooksFolder(book.path, data.name + "." + book_format)
-            return do_gdrive_download(df, headers, (book_format.upper() == 'TXT'))
+            return add_validators(do_gdrive_download(df, headers, (book_format.upper() == 'TXT')),
+                                  etag, last_modified)
         except AttributeError as ex:
             log.debug_or_exception(ex)
             return "File Not Found"
     else:
+        file_path = os.path.join(config.config_calibre_dir, book.path, data.name + "." + book_format)
         if book_format.upper() == 'TXT':
             try:
-                rawdata = open(os.path.join(config.config_calibre_dir, book.path, data.name + "." + book_format),
-                               "rb").read()
+                rawdata = open(file_path, "rb").read()
                 result = chardet.detect(rawdata)
-                return make_response(
-                    rawdata.decode(result['encoding']).encode('utf-8'))
+                return add_validators(make_response(rawdata.decode(result['encoding']).encode('utf-8')),
+                                      etag, last_modified)
             except FileNotFoundError:
                 log.error("File Not Found")
                 return "File Not Found"
-        return send_from_directory(os.path.join(config.config_calibre_dir, book.path), data.name + "." + book_format)
+        if not os.path.isfile(file_path):
+            abort(404)
+        return send_library_file(file_path, etag, last_modified)
 
 
 @web.route("/download/<int:book_id>/<book_format>", defaults={'anyname': 'None'})
@@ -1702,7 +1660,7 @@ def read_book(book_id, book_format):
                 all_name = str(book_id)
                 log.debug(u"Start comic reader for %d", book_id)
                 return render_title_template('readcbr.html', comicfile=all_name, title=_(u"Read a Book"),
-                                             extension=fileExt)
+                                             extension=fileExt, stream_pages=comic_reader.supported(fileExt))
         log.debug(u"Oops! Selected book title is unavailable. File does not exist or is not accessible")
         flash(_(u"Oops! Selected book title is unavailable. File does not exist or is not accessible"), category="error")
         return redirect(url_for("web.index"))